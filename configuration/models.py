@@ -23,8 +23,10 @@ from django.utils.translation import gettext_lazy as _
 from django.db import models
 from inventory.models import entity
 from django.contrib.auth.models import User
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
+from updatengine.cache import ProcessCache
+import copy
 from django.core.validators import MaxValueValidator, MinValueValidator
 
 
@@ -79,6 +81,34 @@ class globalconfig(models.Model):
         return str(_('header|settings'))
 
 
+# Configuration singletons are read on each client request: they are cached in
+# the process and refreshed when they are saved (in any process)
+deployconfig_cache = ProcessCache('deployconfig', lambda: deployconfig.objects.get(pk=1))
+globalconfig_cache = ProcessCache('globalconfig', lambda: globalconfig.objects.get(pk=1))
+
+
+def get_deployconfig():
+    '''Return the deployment configuration'''
+    return copy.copy(deployconfig_cache.get())
+
+
+def get_globalconfig():
+    '''Return the global configuration'''
+    return copy.copy(globalconfig_cache.get())
+
+
+@receiver(post_save, sender=deployconfig)
+@receiver(post_delete, sender=deployconfig)
+def invalidate_deployconfig(sender, instance, **kwargs):
+    deployconfig_cache.invalidate()
+
+
+@receiver(post_save, sender=globalconfig)
+@receiver(post_delete, sender=globalconfig)
+def invalidate_globalconfig(sender, instance, **kwargs):
+    globalconfig_cache.invalidate()
+
+
 # Create subuser to extend default django user
 class subuser(models.Model):
     user = models.OneToOneField(User, related_name='subuser', on_delete=models.CASCADE)
@@ -20,7 +20,8 @@
 ###############################################################################
 
 from deploy.models import (package, packagehistory, packageprofile, packagecondition, timeprofile, packagewakeonlan,
-                           impex, packagecustomvar)
+                           impex, packagecustomvar, packageupload, refresh_latest_statuses, refresh_packagecounters)
+from deploy.views import upload_start, upload_chunk
 from django.contrib import admin
 from django.contrib.admin import DateFieldListFilter
 from deploy.filters import entityFilter, machineFilter, statusFilter,\
@@ -28,10 +29,11 @@ from deploy.filters import entityFilter, machineFilter, statusFilter,\
         myPackagesFilter, myConditionsFilter
 from inventory.models import entity, machine
 from django.utils.translation import gettext_lazy as _
-from django.forms import ModelForm
+from django.forms import ModelForm, CharField, HiddenInput, ValidationError
 from django.contrib import messages
 from django.utils.safestring import mark_safe
-from django.urls import reverse
+from django.utils.html import escape
+from django.urls import reverse, path
 from updatengine.utils import FieldsetsInlineMixin
 from datetime import datetime
 import copy
@@ -55,6 +57,9 @@ class customvarInline(admin.TabularInline):
 
 
 class packageForm(ModelForm):
+    # Token of a file uploaded by chunks (replaces the filename field)
+    upload = CharField(required=False, widget=HiddenInput)
+
     class Meta:
         model = package
         fields = '__all__'
@@ -76,10 +81,21 @@ class packageForm(ModelForm):
                     order_by('name').distinct()
         if 'entity' in self.fields:
             self.fields['entity'].widget.can_add_related = False
+        if 'upload' in self.fields:
+            self.fields['upload'].widget.attrs['data-url'] = reverse('admin:deploy_package_upload')
 
     def clean_editor(self):
         return self.my_user
 
+    def clean(self):
+        cleaned_data = super(packageForm, self).clean()
+        if cleaned_data.get('upload'):
+            upload = packageupload.objects.filter(token=cleaned_data['upload'], user=self.my_user).first()
+            if upload is None or not upload.completed:
+                raise ValidationError(_('package|upload not completed'))
+            cleaned_data['filename'] = upload.filename
+        return cleaned_data
+
 
 class packageAdmin(FieldsetsInlineMixin, ueAdmin):
 #class packageAdmin(ueAdmin):
@@ -90,7 +106,10 @@ class packageAdmin(FieldsetsInlineMixin, ueAdmin):
     list_filter = ('ignoreperiod',packageEntityFilter,conditionFilter, myPackagesFilter)
     filter_horizontal = ('conditions','entity','timeprofiles')
     form = packageForm
-    actions = ['duplicate']
+    actions = ['duplicate', 'simulate']
+
+    class Media:
+        js = ('js/chunked_upload.js',)
     # inlines = (variableInline,)
     # readonly_fields = ('variableInline')
     # fieldsets = (
@@ -105,7 +124,7 @@ class packageAdmin(FieldsetsInlineMixin, ueAdmin):
         (_('package|general information'), {'fields': ('name', 'description')}),
         customvarInline,
         (_('package|package edition'),
-         {'fields': ('use_global_variables', 'conditions', 'command', 'filename')}),
+         {'fields': ('use_global_variables', 'conditions', 'command', 'filename', 'upload')}),
         (_('package|deployment options'), {'fields': ('public', 'no_break_on_error', 'download_no_restart', 'install_timeout')}),
         (_('package|timeprofiles options'), {'fields': ('ignoreperiod', 'timeprofiles')}),
         (_('package|permissions'), {
@@ -178,6 +197,27 @@ class packageAdmin(FieldsetsInlineMixin, ueAdmin):
             messages.success(request, mark_safe(msg))
     duplicate.short_description = _('package|deployment packages duplicate')
 
+    def simulate(modeladmin, request, queryset):
+        from inventory.simulate import simulate_package
+        machines = machine.objects.all()
+        if not request.user.is_superuser:
+            machines = machines.filter(entity__pk__in=request.user.subuser.id_entities_allowed())
+        for obj in queryset:
+            results = simulate_package(obj, machines)
+            retval = '%s :<ul class="grp-list-options">' % escape(obj.name)
+            for entity_name in sorted(results):
+                counts = results[entity_name]
+                retval += '<li>%s : %s</li>' % (escape(entity_name or '-'), _('package|simulate %(install)d install, %(extended)d depend on extended conditions, %(skip)d skip') % {
+                    'install': counts['install'], 'extended': counts['extended'], 'skip': sum(counts['skip'].values())})
+                if counts['skip']:
+                    retval += '<ul>'
+                    for condition_name, count in counts['skip'].most_common():
+                        retval += '<li>%s : %d</li>' % (escape(condition_name), count)
+                    retval += '</ul>'
+            retval += '</ul>'
+            messages.info(request, mark_safe(retval))
+    simulate.short_description = _('package|deployment packages simulate')
+
     def changelist_view(self, request, extra_context=None):
         # Show a warning if user is not superuser
         if not request.user.is_superuser:
@@ -197,6 +237,18 @@ class packageAdmin(FieldsetsInlineMixin, ueAdmin):
         else:
             return request.user.is_superuser or request.user.has_perm('deploy.change_package')
 
+    def get_urls(self):
+        return [
+            path('upload/', self.admin_site.admin_view(upload_start), name='deploy_package_upload'),
+            path('upload/<str:token>/', self.admin_site.admin_view(upload_chunk), name='deploy_package_upload_chunk'),
+        ] + super(packageAdmin, self).get_urls()
+
+    def save_model(self, request, obj, form, change):
+        super(packageAdmin, self).save_model(request, obj, form, change)
+        # The uploaded file belongs to the package now
+        if form.cleaned_data.get('upload'):
+            packageupload.objects.filter(token=form.cleaned_data['upload']).delete()
+
     def get_form(self, request, obj=None, **kwargs):
         form = super(packageAdmin, self).get_form(request, obj, **kwargs)
         # Custom form to be able to use request in clean method
@@ -226,7 +278,7 @@ class packageAdmin(FieldsetsInlineMixin, ueAdmin):
 
 class packagehistoryAdmin(ueAdmin):
     list_display = ('date','get_machine','get_status','name','description','get_command','filename','get_package')
-    search_fields = ('status','name','description','command')
+    search_fields = ('status','revision__name','revision__description','revision__command')
     list_filter = (entityFilter, machineFilter,packageHistoryFilter,statusFilter,
             ('date', DateFieldListFilter))
     ordering =('-date',)
@@ -252,7 +304,7 @@ class packagehistoryAdmin(ueAdmin):
     def get_command(self, obj):
         return mark_safe(obj.command.replace('\r', '').replace('\n', '<br>'))
     get_command.short_description = _('packagehistory|command')
-    get_command.admin_order_field = 'command'
+    get_command.admin_order_field = 'revision__command'
 
     def get_machine(self, obj):
         if obj.machine is not None:
@@ -271,9 +323,23 @@ class packagehistoryAdmin(ueAdmin):
     def get_queryset(self, request):
         # Re-create queryset with entity list returned by list_entities_allowed
         if request.user.is_superuser:
-            return packagehistory.objects.all()
+            return packagehistory.objects.select_related('revision')
         else:
-            return packagehistory.objects.filter(machine__entity__pk__in = request.user.subuser.id_entities_allowed()).distinct()
+            return packagehistory.objects.select_related('revision').filter(machine__entity__pk__in = request.user.subuser.id_entities_allowed()).distinct()
+
+    def delete_model(self, request, obj):
+        super(packagehistoryAdmin, self).delete_model(request, obj)
+        self.refresh_pairs([(obj.machine_id, obj.package_id)])
+
+    def delete_queryset(self, request, queryset):
+        pairs = set(queryset.values_list('machine_id', 'package_id'))
+        super(packagehistoryAdmin, self).delete_queryset(request, queryset)
+        self.refresh_pairs(pairs)
+
+    def refresh_pairs(self, pairs):
+        # Deleted records no longer count for executetimes/installtimes
+        refresh_packagecounters(pairs)
+        refresh_latest_statuses(pairs)
 
     def get_actions(self, request):
         actions = super(packagehistoryAdmin, self).get_actions(request)
@@ -363,10 +429,11 @@ class packageprofileAdmin(ueAdmin):
 
     def get_queryset(self, request):
         # Re-create queryset with entity list returned by list_entities_allowed
+        # effective packages are prefetched for get_packages column
         if request.user.is_superuser:
-            return packageprofile.objects.all()
+            return packageprofile.objects.all().prefetch_related('effective_packages')
         else:
-            return packageprofile.objects.filter(entity__pk__in = request.user.subuser.id_entities_allowed()).distinct()
+            return packageprofile.objects.filter(entity__pk__in = request.user.subuser.id_entities_allowed()).distinct().prefetch_related('effective_packages')
 
 
 class timeprofileForm(ModelForm):
@@ -1,7 +1,7 @@
 from django.contrib.admin import SimpleListFilter
 from django.utils.translation import gettext_lazy as _
 from inventory.models import entity
-from deploy.models import packagehistory, packagecondition
+from deploy.models import packagehistory, packagecondition, packagerevision
 from django.utils.encoding import force_str
 from configuration.models import globalconfig
 
@@ -49,18 +49,18 @@ class statusFilter(SimpleListFilter):
     parameter_name = 'status'
 
     def lookups(self, request, model_admin):
-        if request.user.is_superuser:
-            return packagehistory.objects.all().order_by('status').values_list('status','status').distinct()
-        else:
-            return packagehistory.objects.filter(machine__entity__pk__in = request.user.subuser.id_entities_allowed()).order_by('status').values_list('status','status').distinct()
+        return packagehistory.choice_status_code
 
     def queryset(self, request, queryset):
          main_config = globalconfig.objects.get(pk=1)
          if self.value() is not None:
              if 'status' in request.GET:
+                 # Status class, or full status text of the former links
+                 if self.value().isdigit():
+                     return queryset.filter(status_code=int(self.value()))
                  return queryset.filter(status__iexact=self.value())
          elif main_config.show_warning == 'no':
-             return queryset.exclude(status__startswith='Warning')
+             return queryset.exclude(status_code=packagehistory.WARNING)
          else:
              return queryset
 
@@ -74,14 +74,14 @@ class packageHistoryFilter(SimpleListFilter):
 
     def lookups(self, request, model_admin):
         if request.user.is_superuser:
-            return packagehistory.objects.all().order_by('name').distinct().values_list('name','name')
+            return packagerevision.objects.all().order_by('name').distinct().values_list('name','name')
         else:
-            return packagehistory.objects.filter(machine__entity__pk__in = request.user.subuser.id_entities_allowed()).order_by('name').distinct().values_list('name','name')
+            return packagehistory.objects.filter(machine__entity__pk__in = request.user.subuser.id_entities_allowed()).order_by('revision__name').distinct().values_list('revision__name','revision__name')
 
     def queryset(self, request, queryset):
          if self.value() is not None:
             if 'package_name' in request.GET:
-                return queryset.filter(name__iexact=self.value())
+                return queryset.filter(revision__name__iexact=self.value())
          else:
              return queryset
 
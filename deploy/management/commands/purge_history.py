@@ -0,0 +1,182 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from deploy.models import packagehistory, packagerevision
+from datetime import datetime, timedelta, timezone
+import csv
+import gzip
+import io
+import json
+import os
+import time
+
+# Status classes of the retention policy
+STATUS_CLASSES = {
+    'programmed': Q(status_code=packagehistory.PROGRAMMED),
+    'progress': Q(status_code__in=(packagehistory.READY, packagehistory.PROGRESS)),
+    'completed': Q(status_code=packagehistory.COMPLETED),
+    'warning': Q(status_code=packagehistory.WARNING),
+    'error': Q(status_code=packagehistory.ERROR),
+    'other': Q(status_code=packagehistory.OTHER),
+}
+ARCHIVE_FIELDS = ('id', 'date', 'machine_id', 'machine__name', 'package_id', 'name', 'description', 'command',
+                  'packagesum', 'packagehash', 'filename', 'status', 'status_code')
+ARCHIVE_LOOKUPS = tuple('revision__' + f if f in packagerevision.FIELDS else f for f in ARCHIVE_FIELDS)
+
+
+class Command(BaseCommand):
+    help = ('Delete the package history older than the retention period of its status class, by chunks ordered by id '
+            '(optionally archived in compressed files under MEDIA_ROOT). An interrupted purge is resumed from its '
+            'checkpoint')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help='Retention in days of all the status classes')
+        parser.add_argument('--keep', action='append', default=list(), metavar='CLASS=DAYS',
+                            help='Retention in days of a status class (%s), \'never\' to keep it forever' %
+                                 ', '.join(STATUS_CLASSES))
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Rows deleted in each chunk')
+        parser.add_argument('--pause', type=float, default=0.1, help='Seconds to wait between two chunks')
+        parser.add_argument('--archive', choices=('jsonl', 'csv'), help='Archive purged rows in a gzip file')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the rows to purge')
+        parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint of an interrupted purge')
+
+    def handle(self, *args, **options):
+        directory = os.path.join(settings.MEDIA_ROOT, 'history-archive')
+        checkpoint_path = os.path.join(directory, 'purge_history.json')
+        checkpoint = None
+        if os.path.exists(checkpoint_path) and not options['restart'] and not options['dry_run']:
+            with open(checkpoint_path) as f:
+                checkpoint = json.load(f)
+            self.stdout.write('Resuming purge started at %s from id %d' % (checkpoint['started'], checkpoint['last_id']))
+        else:
+            now = datetime.now(timezone.utc)
+            retention = dict.fromkeys(STATUS_CLASSES, options['days'])
+            for value in options['keep']:
+                status_class, sep, days = value.partition('=')
+                if status_class not in STATUS_CLASSES or not sep:
+                    raise CommandError("Invalid retention '%s' (expected CLASS=DAYS with CLASS in %s)" % (
+                        value, ', '.join(STATUS_CLASSES)))
+                try:
+                    retention[status_class] = None if days == 'never' else int(days)
+                except ValueError:
+                    raise CommandError("Invalid retention '%s'" % value)
+            archive = None
+            if options['archive']:
+                archive = os.path.join(directory, 'packagehistory-%s.%s.gz' % (now.strftime('%Y%m%d-%H%M%S'),
+                                                                                options['archive']))
+            checkpoint = {
+                'started': now.isoformat(),
+                'cutoffs': {status_class: (now - timedelta(days=days)).isoformat()
+                            for status_class, days in retention.items() if days is not None},
+                'archive': archive,
+                'archive_size': 0,
+                'last_id': 0,
+                'deleted_id': 0,
+                'purged': 0,
+            }
+
+        query = Q(pk__in=[])
+        for status_class, cutoff in checkpoint['cutoffs'].items():
+            query |= STATUS_CLASSES[status_class] & Q(date__lt=datetime.fromisoformat(cutoff))
+        rows = packagehistory.objects.filter(query)
+        total = rows.filter(id__gt=checkpoint['last_id']).count()
+        if options['dry_run']:
+            self.stdout.write('%d rows to purge' % total)
+            return
+        self.stdout.write('%d rows to purge' % total)
+
+        os.makedirs(directory, exist_ok=True)
+        archive = checkpoint['archive']
+        if archive is not None and os.path.exists(archive):
+            # Rows archived after the last checkpoint are archived again
+            with open(archive, 'r+b') as f:
+                f.truncate(checkpoint['archive_size'])
+        # Chunk archived and checkpointed but maybe not deleted before the interruption
+        deleted_id = checkpoint.get('deleted_id', checkpoint['last_id'])
+        if deleted_id < checkpoint['last_id']:
+            rows.filter(id__gt=deleted_id, id__lte=checkpoint['last_id']).delete()
+        purged = 0
+        while True:
+            ids = list(rows.filter(id__gt=checkpoint['last_id']).order_by('id').values_list('id', flat=True)[
+                       :options['chunk_size']])
+            if not ids:
+                break
+            if archive is not None:
+                self.archive(archive, ids)
+                checkpoint['archive_size'] = os.path.getsize(archive)
+            # Checkpoint saved before the delete: archived rows are never lost
+            checkpoint['deleted_id'] = checkpoint['last_id']
+            checkpoint['last_id'] = ids[-1]
+            checkpoint['purged'] += len(ids)
+            self.save_checkpoint(checkpoint_path, checkpoint)
+            packagehistory.objects.filter(id__in=ids).delete()
+            purged += len(ids)
+            self.stdout.write('%d/%d rows purged' % (purged, total))
+            if options['pause']:
+                time.sleep(options['pause'])
+
+        # Revisions of the package fields are shared: delete the ones of no record anymore. Revisions used since
+        # two intervals before the purge start may be reused by a status being written, a revision reused later
+        # is locked by the update of its date (packagerevision.get_ids)
+        unused = packagerevision.objects.filter(
+            ~Exists(packagehistory.objects.filter(revision=OuterRef('pk'))),
+            date__lt=datetime.fromisoformat(checkpoint['started']) - 2 * packagerevision.USE_INTERVAL)
+        deleted = 0
+        while True:
+            with transaction.atomic():
+                ids = list(unused.select_for_update().order_by('id').values_list('id', flat=True)[
+                           :options['chunk_size']])
+                if not ids:
+                    break
+                deleted += packagerevision.objects.filter(id__in=ids).delete()[0]
+        if deleted:
+            self.stdout.write('%d unused package revisions deleted' % deleted)
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.stdout.write('%d rows purged%s' % (checkpoint['purged'], ', archived in %s' % archive if archive else ''))
+
+    def archive(self, path, ids):
+        '''Append the rows to a gzip file (one gzip member per chunk)'''
+        rows = packagehistory.objects.filter(id__in=ids).order_by('id').values_list(*ARCHIVE_LOOKUPS)
+        text = io.StringIO()
+        if path.endswith('.csv.gz'):
+            writer = csv.writer(text)
+            if not os.path.exists(path) or os.path.getsize(path) == 0:
+                writer.writerow(ARCHIVE_FIELDS)
+            writer.writerows(rows)
+        else:
+            for row in rows:
+                text.write(json.dumps(dict(zip(ARCHIVE_FIELDS, row)), cls=DjangoJSONEncoder) + '\n')
+        with open(path, 'ab') as f:
+            f.write(gzip.compress(text.getvalue().encode('utf-8')))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def save_checkpoint(self, path, checkpoint):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp, path)
@@ -0,0 +1,56 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.core.management.base import BaseCommand
+from deploy.models import package, impex, hashes_for_file, store_file, store_path
+import os
+
+
+class Command(BaseCommand):
+    help = ('Add the existing package and import/export files to the content-addressed store: identical files are '
+            'replaced by hard links of a single stored file')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Only count the files which would be linked')
+
+    def handle(self, *args, **options):
+        files = dict()
+        for model in (package, impex):
+            for obj in model.objects.exclude(filename='').only('filename').iterator():
+                files.setdefault(obj.filename.name, obj.filename)
+        count = linked = saved = 0
+        stored = dict()
+        for filefield in files.values():
+            if not os.path.isfile(filefield.path):
+                continue
+            count += 1
+            # hashes of the current content (cached), the recorded ones may be outdated
+            md5, sha512 = hashes_for_file(filefield)
+            blob = stored.setdefault(sha512, filefield.path)
+            if os.path.exists(store_path(sha512)):
+                blob = store_path(sha512)
+            if not os.path.samefile(blob, filefield.path):
+                linked += 1
+                saved += os.path.getsize(filefield.path)
+            if not options['dry_run']:
+                store_file(filefield.path, md5, sha512)
+        self.stdout.write('%d files, %d %s by a link to an identical file (%d bytes saved)' % (
+            count, linked, 'to replace' if options['dry_run'] else 'replaced', saved))
@@ -0,0 +1,178 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.conf import settings
+from django.core import signing
+from django.core.management.base import BaseCommand, CommandError
+from deploy.models import MIRROR_MANIFEST_SALT, MIRROR_REQUEST_SALT
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote
+from urllib.request import Request, urlopen
+import hashlib
+import json
+import os
+
+# Local state of the mirror: size, modification time and SHA-512 of the synchronized files
+STATE_FILE = '.sync_mirror.json'
+
+
+def file_sha512(path, block_size=2**20):
+    sha512 = hashlib.sha512()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha512.update(block)
+    return sha512.hexdigest()
+
+
+def download(url, path, size, sha512, timeout, block_size=2**20):
+    '''Download url in path.part (resumed with a range request when present) then move it to path
+    if its size and SHA-512 are the expected ones'''
+    part = path + '.part'
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    hasher = hashlib.sha512()
+    offset = 0
+    if os.path.exists(part):
+        with open(part, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                hasher.update(block)
+                offset += len(block)
+        if offset >= size:
+            hasher, offset = hashlib.sha512(), 0
+    headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+    with urlopen(Request(url, headers=headers), timeout=timeout) as response:
+        if offset and response.status != 206:
+            hasher, offset = hashlib.sha512(), 0  # range not supported: whole file
+        with open(part, 'ab' if offset else 'wb') as f:
+            for block in iter(lambda: response.read(block_size), b''):
+                f.write(block)
+                hasher.update(block)
+    if os.path.getsize(part) != size or hasher.hexdigest() != sha512:
+        os.remove(part)
+        raise ValueError('size or SHA-512 of the downloaded file is not the expected one')
+    os.replace(part, path)
+    return os.stat(path)
+
+
+class Command(BaseCommand):
+    help = ('Synchronize the package files of a redistribution mirror (entity redistribution URL) with the signed '
+            'manifest of the server: only missing or changed files are downloaded, in parallel, and verified')
+
+    def add_arguments(self, parser):
+        parser.add_argument('server', help='URL of the UpdatEngine server (https://server:port)')
+        parser.add_argument('entity', type=int, help='Id of the entity of the mirror')
+        parser.add_argument('destination', help='Directory served at the redistribution URL of the entity')
+        parser.add_argument('--key', help='Key shared with the server (default: MIRROR_KEY setting)')
+        parser.add_argument('--media-url', help='URL of the package files (default: <server>/media/)')
+        parser.add_argument('--jobs', type=int, default=4, help='Files downloaded at the same time')
+        parser.add_argument('--timeout', type=float, default=60, help='Network timeout in seconds')
+        parser.add_argument('--delete', action='store_true',
+                            help='Delete the synchronized files which are not in the manifest anymore')
+
+    def handle(self, *args, **options):
+        key = options['key'] or getattr(settings, 'MIRROR_KEY', '')
+        if not key:
+            raise CommandError('MIRROR_KEY setting or --key option is required')
+        if options['jobs'] < 1:
+            raise CommandError('--jobs must be at least 1')
+        server = options['server'].rstrip('/')
+        media_url = options['media_url'] or server + '/media/'
+        destination = options['destination']
+        manifest = self.get_manifest(server, options['entity'], key, options['timeout'])
+
+        state_path = os.path.join(destination, STATE_FILE)
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = dict()
+        files = dict()
+        todo = list()
+        for path, size, sha512 in manifest['files']:
+            if os.path.isabs(path) or os.path.normpath(path).startswith('..'):
+                raise CommandError("Invalid path '%s' in the manifest" % path)
+            files[path] = sha512
+            local = os.path.join(destination, path)
+            try:
+                stat = os.stat(local)
+            except OSError:
+                todo.append((path, size, sha512))
+                continue
+            if stat.st_size == size:
+                if state.get(path) != [stat.st_size, stat.st_mtime_ns, sha512] and file_sha512(local) == sha512:
+                    state[path] = [stat.st_size, stat.st_mtime_ns, sha512]  # file copied by hand
+                if state.get(path) == [stat.st_size, stat.st_mtime_ns, sha512]:
+                    continue
+            todo.append((path, size, sha512))
+
+        errors = 0
+        downloaded = 0
+        with ThreadPoolExecutor(max_workers=options['jobs']) as executor:
+            futures = {executor.submit(download, media_url + quote(path), os.path.join(destination, path), size,
+                                       sha512, options['timeout']): (path, size, sha512)
+                       for path, size, sha512 in todo}
+            for future in as_completed(futures):
+                path, size, sha512 = futures[future]
+                try:
+                    stat = future.result()
+                except (OSError, ValueError) as e:
+                    errors += 1
+                    state.pop(path, None)
+                    self.stderr.write('%s: %s' % (path, e))
+                    continue
+                downloaded += size
+                state[path] = [stat.st_size, stat.st_mtime_ns, sha512]
+                if options['verbosity'] > 1:
+                    self.stdout.write('%s downloaded' % path)
+
+        deleted = 0
+        for path in [path for path in state if path not in files]:
+            if options['delete']:
+                try:
+                    os.remove(os.path.join(destination, path))
+                    os.rmdir(os.path.dirname(os.path.join(destination, path)))
+                except OSError:
+                    pass  # already deleted or package directory not empty
+                deleted += 1
+            del state[path]
+        os.makedirs(destination, exist_ok=True)
+        with open(state_path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(state_path + '.tmp', state_path)
+
+        self.stdout.write('%d files, %d up to date, %d downloaded (%d bytes), %d deleted, %d errors' % (
+            len(files), len(files) - len(todo), len(todo) - errors, downloaded, deleted, errors))
+        if errors:
+            raise CommandError('%d files not synchronized' % errors)
+
+    def get_manifest(self, server, entity_id, key, timeout):
+        token = signing.dumps(entity_id, key=key, salt=MIRROR_REQUEST_SALT)
+        request = Request('%s/mirror/%d/manifest' % (server, entity_id), headers={'X-Mirror-Token': token})
+        try:
+            with urlopen(request, timeout=timeout) as response:
+                data = response.read().decode()
+            manifest = signing.loads(data, key=key, salt=MIRROR_MANIFEST_SALT, max_age=3600)
+        except signing.BadSignature:
+            raise CommandError('Invalid signature of the manifest')
+        except (OSError, ValueError) as e:
+            raise CommandError('Manifest not downloaded: %s' % e)
+        if manifest.get('entity') != entity_id:
+            raise CommandError('Manifest of another entity')
+        return manifest
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.3 on 2026-10-17 10:40
+
+from django.db import migrations, models
+
+
+def fill_effective_packages(apps, schema_editor):
+    packageprofile = apps.get_model('deploy', 'packageprofile')
+    parents = dict(packageprofile.objects.values_list('id', 'parent_id'))
+    packages = dict()
+    for profile_id, package_id in packageprofile.packages.through.objects.values_list('packageprofile_id', 'package_id'):
+        packages.setdefault(profile_id, set()).add(package_id)
+    through = packageprofile.effective_packages.through
+    rows = list()
+    for profile_id in parents:
+        effective = set()
+        visited = set()
+        ancestor_id = profile_id
+        while ancestor_id is not None and ancestor_id not in visited:
+            visited.add(ancestor_id)
+            effective |= packages.get(ancestor_id, set())
+            ancestor_id = parents.get(ancestor_id)
+        rows += [through(packageprofile_id=profile_id, package_id=package_id) for package_id in effective]
+    through.objects.bulk_create(rows, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deploy', '0010_package_download_no_restart_package_install_timeout_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packageprofile',
+            name='effective_packages',
+            field=models.ManyToManyField(blank=True, editable=False, related_name='effective_packageprofiles', to='deploy.package', verbose_name='packageprofile|effective packages'),
+        ),
+        migrations.RunPython(fill_effective_packages, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.3 on 2026-10-17 11:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deploy', '0011_packageprofile_effective_packages'),
+        ('inventory', '0006_alter_machine_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='deployplan',
+            fields=[
+                ('machine', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='deployplan', serialize=False, to='inventory.machine', verbose_name='deployplan|machine')),
+                ('key', models.CharField(max_length=40, verbose_name='deployplan|key')),
+                ('packages', models.JSONField(default=list, verbose_name='deployplan|packages')),
+                ('conditions', models.JSONField(default=dict, verbose_name='deployplan|conditions')),
+                ('date', models.DateTimeField(auto_now=True, verbose_name='deployplan|date')),
+            ],
+            options={
+                'verbose_name': 'deployplan|deploy plan',
+                'verbose_name_plural': 'deployplan|deploy plans',
+            },
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.3 on 2026-10-17 11:40
+
+import django.db.models.deletion
+from datetime import datetime, time, timedelta
+from django.db import migrations, models
+from django.db.models import Count, Max
+from django.utils import timezone
+
+
+def fill_packagecounters(apps, schema_editor):
+    packagehistory = apps.get_model('deploy', 'packagehistory')
+    packagecounter = apps.get_model('deploy', 'packagecounter')
+    today = timezone.localdate()
+    periods = {'day': today, 'week': today - timedelta(days=today.weekday()), 'month': today.replace(day=1)}
+    counters = dict()
+    history = packagehistory.objects.filter(package__isnull=False)
+    for kind, statuses in (('execute', ('Ready to download and execute', 'Install in progress')),
+                           ('install', ('Operation completed',))):
+        for period, start in periods.items():
+            rows = history.filter(status__in=statuses, date__gte=timezone.make_aware(datetime.combine(start, time.min)))
+            for machine_id, package_id, count in rows.values_list('machine_id', 'package_id').annotate(
+                    count=Count('id')).values_list('machine_id', 'package_id', 'count'):
+                counter = counters.setdefault((machine_id, package_id), packagecounter(machine_id=machine_id,
+                                                                                       package_id=package_id))
+                setattr(counter, '%s_%s' % (kind, period), start)
+                setattr(counter, '%s_%s_count' % (kind, period), count)
+    for last, status in (('last_ready', 'Ready to download and execute'), ('last_install', 'Operation completed')):
+        for machine_id, package_id, date in history.filter(status=status).values_list(
+                'machine_id', 'package_id').annotate(last=Max('date')).values_list('machine_id', 'package_id', 'last'):
+            counter = counters.setdefault((machine_id, package_id), packagecounter(machine_id=machine_id,
+                                                                                   package_id=package_id))
+            setattr(counter, last, date)
+    packagecounter.objects.bulk_create(counters.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deploy', '0012_deployplan'),
+        ('inventory', '0006_alter_machine_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='packagecounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('execute_day', models.DateField(blank=True, null=True, verbose_name='packagecounter|execute day')),
+                ('execute_day_count', models.PositiveIntegerField(default=0, verbose_name='packagecounter|execute day count')),
+                ('execute_week', models.DateField(blank=True, null=True, verbose_name='packagecounter|execute week')),
+                ('execute_week_count', models.PositiveIntegerField(default=0, verbose_name='packagecounter|execute week count')),
+                ('execute_month', models.DateField(blank=True, null=True, verbose_name='packagecounter|execute month')),
+                ('execute_month_count', models.PositiveIntegerField(default=0, verbose_name='packagecounter|execute month count')),
+                ('last_ready', models.DateTimeField(blank=True, null=True, verbose_name='packagecounter|last ready to download')),
+                ('install_day', models.DateField(blank=True, null=True, verbose_name='packagecounter|install day')),
+                ('install_day_count', models.PositiveIntegerField(default=0, verbose_name='packagecounter|install day count')),
+                ('install_week', models.DateField(blank=True, null=True, verbose_name='packagecounter|install week')),
+                ('install_week_count', models.PositiveIntegerField(default=0, verbose_name='packagecounter|install week count')),
+                ('install_month', models.DateField(blank=True, null=True, verbose_name='packagecounter|install month')),
+                ('install_month_count', models.PositiveIntegerField(default=0, verbose_name='packagecounter|install month count')),
+                ('last_install', models.DateTimeField(blank=True, null=True, verbose_name='packagecounter|last install')),
+                ('machine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inventory.machine', verbose_name='packagecounter|machine')),
+                ('package', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='deploy.package', verbose_name='packagecounter|package')),
+            ],
+            options={
+                'verbose_name': 'packagecounter|package counter',
+                'verbose_name_plural': 'packagecounter|package counters',
+                'unique_together': {('machine', 'package')},
+            },
+        ),
+        migrations.RunPython(fill_packagecounters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,76 @@
+# Generated by Django 5.2.3 on 2026-10-17 12:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def fill_packagestatuslatest(apps, schema_editor):
+    packagehistory = apps.get_model('deploy', 'packagehistory')
+    packagestatuslatest = apps.get_model('deploy', 'packagestatuslatest')
+    history = packagehistory.objects.filter(package__isnull=False).order_by('machine_id', 'package_id', 'date', 'id')
+    rows = list()
+    last = None
+    for record in history.values_list('machine_id', 'package_id', 'status', 'date').iterator(chunk_size=2000):
+        if last is not None and last[:2] != record[:2]:
+            rows.append(packagestatuslatest(machine_id=last[0], package_id=last[1], status=last[2], date=last[3]))
+            if len(rows) >= 1000:
+                packagestatuslatest.objects.bulk_create(rows)
+                rows = list()
+        last = record
+    if last is not None:
+        rows.append(packagestatuslatest(machine_id=last[0], package_id=last[1], status=last[2], date=last[3]))
+    packagestatuslatest.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deploy', '0013_packagecounter'),
+        ('inventory', '0006_alter_machine_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='packagestatuslatest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(blank=True, max_length=500, null=True, verbose_name='packagestatuslatest|status')),
+                ('date', models.DateTimeField(verbose_name='packagestatuslatest|date')),
+            ],
+            options={
+                'verbose_name': 'packagestatuslatest|package latest status',
+                'verbose_name_plural': 'packagestatuslatest|packages latest statuses',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='packagehistory',
+            index=models.Index(fields=['machine', 'package', 'status', 'date'], name='deploy_history_mpsd_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='packagehistory',
+            index=models.Index(fields=['date', 'status'], name='deploy_history_date_status_idx'),
+        ),
+        migrations.AddField(
+            model_name='packagestatuslatest',
+            name='machine',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='inventory.machine', verbose_name='packagestatuslatest|machine'),
+        ),
+        migrations.AddField(
+            model_name='packagestatuslatest',
+            name='package',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='deploy.package', verbose_name='packagestatuslatest|package'),
+        ),
+        migrations.AddIndex(
+            model_name='packagestatuslatest',
+            index=models.Index(fields=['package', 'status'], name='deploy_latest_package_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='packagestatuslatest',
+            index=models.Index(fields=['status', 'date'], name='deploy_latest_status_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='packagestatuslatest',
+            unique_together={('machine', 'package')},
+        ),
+        migrations.RunPython(fill_packagestatuslatest, migrations.RunPython.noop),
+    ]
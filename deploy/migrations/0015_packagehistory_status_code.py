@@ -0,0 +1,75 @@
+# Generated by Django 5.2.3 on 2026-10-17 12:40
+
+from django.db import migrations, models
+from django.db.models import Case, Q, Value, When
+
+# Status classes: programmed, ready, in progress, completed, warning, error and other (everything else)
+STATUS_CODES = (
+    (1, Q(status='Programmed')),
+    (2, Q(status='Ready to download and execute')),
+    (3, Q(status='Install in progress')),
+    (4, Q(status='Operation completed')),
+    (5, Q(status__startswith='Warning')),
+    (6, Q(status__startswith='Error')),
+)
+CHUNK_SIZE = 10000
+
+
+def fill_status_code(apps, schema_editor):
+    # One UPDATE per chunk of ids, committed separately to avoid locking the whole history
+    status_code = Case(*[When(query, then=Value(code)) for code, query in STATUS_CODES], default=Value(7))
+    for model in ('packagehistory', 'packagestatuslatest'):
+        rows = apps.get_model('deploy', model).objects.using(schema_editor.connection.alias)
+        last_id = 0
+        while True:
+            ids = list(rows.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:CHUNK_SIZE])
+            if not ids:
+                break
+            rows.filter(id__gte=ids[0], id__lte=ids[-1]).update(status_code=status_code)
+            last_id = ids[-1]
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('deploy', '0014_packagestatuslatest'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='packagehistory',
+            name='deploy_history_date_status_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='packagestatuslatest',
+            name='deploy_latest_package_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='packagestatuslatest',
+            name='deploy_latest_status_idx',
+        ),
+        migrations.AddField(
+            model_name='packagehistory',
+            name='status_code',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'packagehistory|programmed'), (2, 'packagehistory|ready'), (3, 'packagehistory|in progress'), (4, 'packagehistory|completed'), (5, 'packagehistory|warning'), (6, 'packagehistory|error'), (7, 'packagehistory|other')], default=1, editable=False, verbose_name='packagehistory|status code'),
+        ),
+        migrations.AddField(
+            model_name='packagestatuslatest',
+            name='status_code',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'packagehistory|programmed'), (2, 'packagehistory|ready'), (3, 'packagehistory|in progress'), (4, 'packagehistory|completed'), (5, 'packagehistory|warning'), (6, 'packagehistory|error'), (7, 'packagehistory|other')], default=1, verbose_name='packagehistory|status code'),
+        ),
+        migrations.RunPython(fill_status_code, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='packagehistory',
+            index=models.Index(fields=['status_code', 'date'], name='deploy_history_code_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='packagestatuslatest',
+            index=models.Index(fields=['package', 'status_code'], name='deploy_latest_package_code_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='packagestatuslatest',
+            index=models.Index(fields=['status_code', 'date'], name='deploy_latest_code_date_idx'),
+        ),
+    ]
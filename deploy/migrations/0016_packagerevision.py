@@ -0,0 +1,85 @@
+# Generated by Django 5.2.3 on 2026-10-17 13:15
+
+import django.db.models.deletion
+import hashlib
+import json
+from django.db import migrations, models
+
+FIELDS = ('name', 'description', 'command', 'packagesum', 'packagehash', 'filename')
+
+
+def fill_packagerevision(apps, schema_editor):
+    packagehistory = apps.get_model('deploy', 'packagehistory')
+    packagerevision = apps.get_model('deploy', 'packagerevision')
+    revisions = dict()
+    last_id = 0
+    while True:
+        rows = list(packagehistory.objects.filter(id__gt=last_id).order_by('id').values_list('id', *FIELDS)[:2000])
+        if not rows:
+            break
+        records = dict()
+        for row in rows:
+            h = hashlib.sha256(json.dumps(list(row[1:])).encode('utf-8')).hexdigest()
+            if h not in revisions:
+                revisions[h] = packagerevision.objects.get_or_create(hash=h, defaults=dict(zip(FIELDS, row[1:])))[0].id
+            records.setdefault(revisions[h], list()).append(row[0])
+        for revision_id, ids in records.items():
+            packagehistory.objects.filter(id__in=ids).update(revision_id=revision_id)
+        last_id = rows[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deploy', '0015_packagehistory_status_code'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='packagerevision',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(editable=False, max_length=64, unique=True, verbose_name='packagerevision|hash')),
+                ('name', models.CharField(blank=True, max_length=100, null=True, verbose_name='packagehistory|name')),
+                ('description', models.CharField(blank=True, max_length=500, null=True, verbose_name='packagehistory|description')),
+                ('command', models.TextField(blank=True, max_length=1000, null=True, verbose_name='packagehistory|command')),
+                ('packagesum', models.CharField(blank=True, max_length=40, null=True, verbose_name='packagehistory|packagesum')),
+                ('packagehash', models.CharField(blank=True, max_length=128, null=True, verbose_name='package|packagehash')),
+                ('filename', models.CharField(blank=True, max_length=500, null=True, verbose_name='packagehistory|filename')),
+            ],
+            options={
+                'verbose_name': 'packagerevision|package revision',
+                'verbose_name_plural': 'packagerevision|package revisions',
+            },
+        ),
+        migrations.AddField(
+            model_name='packagehistory',
+            name='revision',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, to='deploy.packagerevision', verbose_name='packagehistory|revision'),
+        ),
+        migrations.RunPython(fill_packagerevision, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='packagehistory',
+            name='command',
+        ),
+        migrations.RemoveField(
+            model_name='packagehistory',
+            name='description',
+        ),
+        migrations.RemoveField(
+            model_name='packagehistory',
+            name='filename',
+        ),
+        migrations.RemoveField(
+            model_name='packagehistory',
+            name='name',
+        ),
+        migrations.RemoveField(
+            model_name='packagehistory',
+            name='packagehash',
+        ),
+        migrations.RemoveField(
+            model_name='packagehistory',
+            name='packagesum',
+        ),
+    ]
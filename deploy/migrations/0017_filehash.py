@@ -0,0 +1,28 @@
+# Generated by Django 5.2.3 on 2026-10-17 13:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deploy', '0016_packagerevision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='filehash',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=500, unique=True, verbose_name='filehash|path')),
+                ('size', models.BigIntegerField(verbose_name='filehash|size')),
+                ('mtime', models.BigIntegerField(verbose_name='filehash|modification time')),
+                ('md5', models.CharField(max_length=32, verbose_name='filehash|md5')),
+                ('sha512', models.CharField(max_length=128, verbose_name='filehash|sha512')),
+            ],
+            options={
+                'verbose_name': 'filehash|file hash',
+                'verbose_name_plural': 'filehash|file hashes',
+            },
+        ),
+    ]
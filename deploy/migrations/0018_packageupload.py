@@ -0,0 +1,34 @@
+# Generated by Django 5.2.3 on 2026-10-17 14:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deploy', '0017_filehash'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='packageupload',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.CharField(editable=False, max_length=32, unique=True, verbose_name='packageupload|token')),
+                ('filename', models.CharField(max_length=500, verbose_name='packageupload|filename')),
+                ('size', models.BigIntegerField(verbose_name='packageupload|size')),
+                ('offset', models.BigIntegerField(default=0, verbose_name='packageupload|offset')),
+                ('md5', models.CharField(blank=True, default='', max_length=32, verbose_name='packageupload|md5')),
+                ('sha512', models.CharField(blank=True, default='', max_length=128, verbose_name='packageupload|sha512')),
+                ('date', models.DateTimeField(auto_now=True, verbose_name='packageupload|date')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='packageupload|user')),
+            ],
+            options={
+                'verbose_name': 'packageupload|package upload',
+                'verbose_name_plural': 'packageupload|package uploads',
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-17 15:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deploy', '0018_packageupload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='packagerevision',
+            name='date',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='packagerevision|last use'),
+        ),
+    ]
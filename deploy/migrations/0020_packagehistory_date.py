@@ -0,0 +1,19 @@
+# Generated by Django 5.2.3 on 2026-10-17 16:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('deploy', '0019_packagerevision_date'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='packagehistory',
+            name='date',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='packagehistory|date'),
+        ),
+    ]
@@ -20,18 +20,20 @@
 ###############################################################################
 
 from django.utils.translation import gettext_lazy as _
-from django.db.models.signals import post_save, pre_delete
-from django.db import models
+from django.db.models.signals import post_save, pre_delete, post_delete
+from django.db import connection, models, transaction
 from django.db.models.signals import m2m_changed, post_migrate
 from django.dispatch import receiver
-from inventory.models import machine
+from inventory.models import machine, typemachine
 import hashlib
+import json
 import os
 import string
 import random
+import secrets
 import shutil
 import zipfile
-from django.core import serializers
+from django.core import serializers, signing
 from django.conf import settings
 from inventory.models import entity
 from django.contrib.auth.models import User
@@ -40,6 +42,14 @@ from django.urls import reverse
 from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.core.files.storage import default_storage
+from django.utils import timezone
+from datetime import timedelta
+
+
+# Package download tokens: signing salt, validity and part of the package hash identifying the file content
+DOWNLOAD_SALT = 'deploy.package_download'
+DOWNLOAD_MAX_AGE = 7 * 24 * 3600
+DOWNLOAD_HASH_LENGTH = 32
 
 
 def random_directory(size=24, chars=string.ascii_lowercase + string.ascii_uppercase + string.digits, prefix='', suffix=''):
@@ -120,26 +130,227 @@ class packagecondition(models.Model):
 def content_file_name(self, name):
     return random_directory(prefix='package-file/', suffix='/'+name)
 
-def md5_for_file(filefield, block_size=2**20):  # MD5 keep for client backward compatibility < 6.0.0
-    if filefield == '':
-        return 'nofile'
-    f = open(filefield.path, 'rb')
-    md5 = hashlib.md5()
-    while True:
-        data = f.read(block_size)
-        if not data:
-            break
-        md5.update(data)
-    return md5.hexdigest()
-
-def sha512_for_file(filefield, block_size=2**20):
+class filehash(models.Model):
+    '''Checksums of a package file, reused while its size and modification time are unchanged'''
+    path = models.CharField(max_length=500, unique=True, verbose_name=_('filehash|path'))
+    size = models.BigIntegerField(verbose_name=_('filehash|size'))
+    mtime = models.BigIntegerField(verbose_name=_('filehash|modification time'))
+    md5 = models.CharField(max_length=32, verbose_name=_('filehash|md5'))
+    sha512 = models.CharField(max_length=128, verbose_name=_('filehash|sha512'))
+
+    class Meta:
+        verbose_name = _('filehash|file hash')
+        verbose_name_plural = _('filehash|file hashes')
+
+    def __str__(self):
+        return self.path
+
+
+def hashes_for_file(filefield, block_size=2**23):
+    '''Return (md5, sha512) of a file computed in one read (cached by path, size and modification time)'''
     if filefield == '':
-        return 'nofile'
+        return 'nofile', 'nofile'
+    return hashes_for_path(filefield.path, block_size)
+
+
+def hashes_for_path(path, block_size=2**23):
+    stat = os.stat(path)
+    cached = filehash.objects.filter(path=path).values_list('size', 'mtime', 'md5', 'sha512').first()
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2:]
+    md5 = hashlib.md5()  # MD5 keep for client backward compatibility < 6.0.0
     sha512 = hashlib.sha512()
-    with open(filefield.path, 'rb') as f:
+    with open(path, 'rb') as f:
         for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
             sha512.update(block)
-    return sha512.hexdigest()
+    if cached is not None and cached[3] != sha512.hexdigest():
+        # Modified in place: the stored file named by the old content (same inode) is not valid anymore
+        try:
+            if os.path.samefile(store_path(cached[3]), path):
+                os.remove(store_path(cached[3]))
+                filehash.objects.filter(path=store_path(cached[3])).exclude(path=path).delete()
+        except OSError:
+            pass
+    filehash.objects.update_or_create(path=path, defaults={'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                                           'md5': md5.hexdigest(), 'sha512': sha512.hexdigest()})
+    return md5.hexdigest(), sha512.hexdigest()
+
+
+def md5_for_file(filefield):  # MD5 keep for client backward compatibility < 6.0.0
+    return hashes_for_file(filefield)[0]
+
+
+def sha512_for_file(filefield):
+    return hashes_for_file(filefield)[1]
+
+
+def store_path(sha512):
+    '''Path of a file in the content-addressed store of the package files'''
+    return os.path.join(settings.MEDIA_ROOT, 'package-store', sha512[:2], sha512)
+
+
+def link_stored_file(sha512, path, size):
+    '''Replace path by a hard link of the stored file of sha512 after checking its size and hash,
+    return False if it is not stored'''
+    blob = store_path(sha512)
+    try:
+        if os.path.getsize(blob) != size or hashes_for_path(blob)[1] != sha512:
+            return False
+        os.link(blob, path + '.link')
+    except OSError:
+        return False
+    os.replace(path + '.link', path)
+    return True
+
+
+def store_file(path, md5, sha512):
+    '''Add a package file to the store: identical files become hard links of a single stored file
+    (the number of links of the stored file counts its references). Stored files are read-only
+    as a change of one of them would change all the packages sharing it'''
+    blob = store_path(sha512)
+    try:
+        if not os.path.exists(blob):
+            os.makedirs(os.path.dirname(blob), exist_ok=True)
+            os.chmod(path, 0o444)
+            os.link(path, blob)
+            path = blob
+        elif os.path.samefile(blob, path) or not link_stored_file(sha512, path, os.path.getsize(path)):
+            return
+    except OSError:
+        return  # file system without hard links: files are not deduplicated
+    stat = os.stat(path)
+    filehash.objects.update_or_create(path=path, defaults={'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                                           'md5': md5, 'sha512': sha512})
+
+
+def release_stored_file(sha512):
+    '''Delete a stored file when it is not linked to any package file anymore'''
+    if not sha512 or sha512 == 'nofile':
+        return
+    try:
+        if os.stat(store_path(sha512)).st_nlink <= 1:
+            os.remove(store_path(sha512))
+            filehash.objects.filter(path=store_path(sha512)).delete()
+    except OSError:
+        pass
+
+
+# Digests of the uploads received by this process: {token: (offset, md5, sha512)}
+upload_hashers = dict()
+
+
+class packageupload(models.Model):
+    '''Package file uploaded by chunks, resumable from its offset and moved to its final name when complete'''
+    token = models.CharField(max_length=32, unique=True, editable=False, verbose_name=_('packageupload|token'))
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name=_('packageupload|user'))
+    filename = models.CharField(max_length=500, verbose_name=_('packageupload|filename'))
+    size = models.BigIntegerField(verbose_name=_('packageupload|size'))
+    offset = models.BigIntegerField(default=0, verbose_name=_('packageupload|offset'))
+    md5 = models.CharField(max_length=32, blank=True, default='', verbose_name=_('packageupload|md5'))
+    sha512 = models.CharField(max_length=128, blank=True, default='', verbose_name=_('packageupload|sha512'))
+    date = models.DateTimeField(auto_now=True, verbose_name=_('packageupload|date'))
+
+    class Meta:
+        verbose_name = _('packageupload|package upload')
+        verbose_name_plural = _('packageupload|package uploads')
+
+    def __str__(self):
+        return self.filename
+
+    @property
+    def path(self):
+        return default_storage.path(self.filename)
+
+    @property
+    def part_path(self):
+        return self.path + '.part'
+
+    @property
+    def completed(self):
+        return self.sha512 != ''
+
+    @classmethod
+    def start(cls, user, name, size):
+        '''Create the upload of a file of size bytes in a new package directory'''
+        for upload in cls.objects.filter(date__lt=timezone.now() - timedelta(days=1)):
+            upload.discard()
+        name = default_storage.get_valid_name(os.path.basename(name))
+        upload = cls.objects.create(token=secrets.token_hex(16), user=user, filename=content_file_name(None, name),
+                                    size=size)
+        os.makedirs(os.path.dirname(upload.path), exist_ok=True)
+        open(upload.part_path, 'wb').close()
+        if size == 0:
+            upload.finish(hashlib.md5(), hashlib.sha512())
+            upload.save()
+        return upload
+
+    def hashers(self):
+        '''Digests of the received bytes, completed from the file when this process did not receive all the chunks'''
+        offset, md5, sha512 = upload_hashers.pop(self.token, (0, hashlib.md5(), hashlib.sha512()))
+        if offset > self.offset:
+            offset, md5, sha512 = 0, hashlib.md5(), hashlib.sha512()
+        if offset < self.offset:
+            with open(self.part_path, 'rb') as f:
+                f.seek(offset)
+                while offset < self.offset:
+                    block = f.read(min(2**23, self.offset - offset))
+                    if not block:
+                        raise ValueError('Upload file shorter than its offset')
+                    md5.update(block)
+                    sha512.update(block)
+                    offset += len(block)
+        return md5, sha512
+
+    def write(self, offset, stream, block_size=2**20):
+        '''Write a chunk read from stream at offset (the current one) and return the upload,
+        or None if offset is not the current one'''
+        with transaction.atomic():
+            upload = packageupload.objects.select_for_update().get(pk=self.pk)
+            if offset != upload.offset or upload.completed:
+                return None
+            md5, sha512 = upload.hashers()
+            with open(upload.part_path, 'r+b') as f:
+                # Drop the end of an interrupted chunk
+                f.seek(offset)
+                f.truncate()
+                for block in iter(lambda: stream.read(block_size), b''):
+                    if upload.offset + len(block) > upload.size:
+                        raise ValueError('Chunk exceeds the file size')
+                    f.write(block)
+                    md5.update(block)
+                    sha512.update(block)
+                    upload.offset += len(block)
+                f.flush()
+                os.fsync(f.fileno())
+            if upload.offset == upload.size:
+                upload.finish(md5, sha512)
+            else:
+                upload_hashers[upload.token] = (upload.offset, md5, sha512)
+            upload.save()
+        return upload
+
+    def finish(self, md5, sha512):
+        '''Move the complete file to its final name and store its checksums'''
+        self.md5 = md5.hexdigest()
+        self.sha512 = sha512.hexdigest()
+        os.replace(self.part_path, self.path)
+        stat = os.stat(self.path)
+        filehash.objects.update_or_create(path=self.path, defaults={'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                                                                    'md5': self.md5, 'sha512': self.sha512})
+
+    def discard(self):
+        '''Delete an upload and its file unless a package uses it'''
+        upload_hashers.pop(self.token, None)
+        if not self.completed or not package.objects.filter(filename=self.filename).exists():
+            for path in (self.part_path, self.path):
+                if os.path.exists(path):
+                    os.remove(path)
+            try:
+                os.rmdir(os.path.dirname(self.path))
+            except OSError:
+                pass
+        self.delete()
 
 
 class package(models.Model):
@@ -210,11 +421,22 @@ class package(models.Model):
                 else:
                     if len(package.objects.filter(filename=p.filename.name)) <= 1:
                         shutil.rmtree(os.path.dirname(p.filename.path))
+                release_stored_file(p.packagehash)
 
         except:
             pass  # when new file then we do nothing, normal case
         super(package, self).save(*args, **kwargs)
 
+    def download_url(self, m=None):
+        '''URL of the package file sent to the clients: media URL or, with PACKAGE_DOWNLOAD, URL of the
+        download view signed for the machine m (or for everyone when public)'''
+        if not getattr(settings, 'PACKAGE_DOWNLOAD', False):
+            return self.filename.url
+        token = signing.dumps([self.id, self.packagehash[:DOWNLOAD_HASH_LENGTH], m.id if m is not None else None],
+                              salt=DOWNLOAD_SALT)
+        return getattr(settings, 'PROJECT_URL', '') + reverse('package_download', args=[
+            token, os.path.basename(self.filename.name)])
+
     def __str__(self):
         return self.name
 
@@ -268,20 +490,22 @@ def postcreate_package(sender, instance, created, **kwargs):
         instance.packagesum = 'nofile'
         instance.packagehash = 'nofile'
     else:
-        instance.packagesum = md5_for_file(instance.filename)
-        instance.packagehash = sha512_for_file(instance.filename)
-    # Update of all package history wish are programmed
-    for ph in packagehistory.objects.filter(package=instance, status='Programmed'):
-        ph.name = instance.name
-        ph.description = instance.description
-        ph.command = instance.command
-        ph.packagesum = instance.packagesum
-        ph.packagehash = instance.packagehash
-        if instance.packagesum != 'nofile':
-            ph.filename = instance.filename.path
-        else:
-            ph.filename = ''
-        ph.save()
+        instance.packagesum, instance.packagehash = hashes_for_file(instance.filename)
+        store_file(instance.filename.path, instance.packagesum, instance.packagehash)
+    # Update of all package history wish are programmed (one revision and one update)
+    programmed = packagehistory.objects.filter(package=instance, status='Programmed')
+    if programmed.exists():
+        revision_id = packagerevision.get_id({
+            'name': instance.name,
+            'description': instance.description,
+            'command': instance.command,
+            'packagesum': instance.packagesum,
+            'packagehash': instance.packagehash,
+            'filename': instance.filename.path if instance.packagesum != 'nofile' else '',
+        })
+        now = timezone.now()
+        programmed.update(revision_id=revision_id, date=now)
+        packagestatuslatest.objects.filter(package=instance, status_code=packagehistory.PROGRAMMED).update(date=now)
 
     post_save.disconnect(receiver=postcreate_package, sender=package)
     instance.save()
@@ -292,11 +516,13 @@ def postcreate_package(sender, instance, created, **kwargs):
 def predelete_package(sender, instance, **kwargs):
     try:
         if instance.filename.name != '':
+            filehash.objects.filter(path=instance.filename.path).delete()
             if os.path.split(os.path.dirname(instance.filename.path))[1] == 'package-file':
                 instance.filename.delete(save=False)
             else:
                 if len(package.objects.filter(filename=instance.filename.name)) <= 1:
                     shutil.rmtree(os.path.dirname(instance.filename.path))
+            release_stored_file(instance.packagehash)
     except:
         pass
 
@@ -321,31 +547,355 @@ def packages_changed(sender, action, instance, **kwargs):
     # Should use this: if action == 'post_remove':
     # But don't work: bug #16073 of Django
     # So try to remove from history at every m2m changed
-    for package_history in packagehistory.objects.filter(machine=instance, status='Programmed'):
-        if not machine.objects.filter(packages__in=allpackages).exists():
-            package_history.delete()
+    programmed = packagehistory.objects.filter(machine=instance, status='Programmed')
+    if programmed.exists() and not machine.objects.filter(packages__in=allpackages).exists():
+        pairs = set(programmed.values_list('machine_id', 'package_id'))
+        programmed.delete()
+        refresh_latest_statuses(pairs)
 
 
-class packagehistory(models.Model):
+class packagerevision(models.Model):
+    '''Immutable snapshot of the package fields recorded in the history, shared by the identical records'''
+    FIELDS = ('name', 'description', 'command', 'packagesum', 'packagehash', 'filename')
+    hash = models.CharField(max_length=64, unique=True, editable=False, verbose_name=_('packagerevision|hash'))
     name = models.CharField(max_length=100, null=True, blank=True, verbose_name=_('packagehistory|name'))
     description = models.CharField(max_length=500, null=True, blank=True, verbose_name=_('packagehistory|description'))
     command = models.TextField(max_length=1000, null=True, blank=True, verbose_name=_('packagehistory|command'))
     packagesum = models.CharField(max_length=40, null=True, blank=True, verbose_name=_('packagehistory|packagesum'))
     packagehash = models.CharField(max_length=128, null=True, blank=True, verbose_name=_('package|packagehash'))
     filename = models.CharField(max_length=500, null=True, blank=True, verbose_name=_('packagehistory|filename'))
+    # Updated when reused after USE_INTERVAL: unused revisions are only deleted well after their last use
+    date = models.DateTimeField(default=timezone.now, editable=False, verbose_name=_('packagerevision|last use'))
+    USE_INTERVAL = timedelta(days=1)
+
+    class Meta:
+        verbose_name = _('packagerevision|package revision')
+        verbose_name_plural = _('packagerevision|package revisions')
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def hash_of(cls, values):
+        '''Content hash of the package fields values (dict)'''
+        return hashlib.sha256(json.dumps([values.get(f) for f in cls.FIELDS]).encode('utf-8')).hexdigest()
+
+    @classmethod
+    def get_ids(cls, snapshots):
+        '''Return {hash: id} of the revisions of the package fields values, created if needed'''
+        snapshots = {cls.hash_of(values): values for values in snapshots}
+        now = timezone.now()
+        found = list(cls.objects.filter(hash__in=snapshots).values_list('hash', 'id', 'date'))
+        ids = {h: i for h, i, date in found}
+        # A revision deleted by purge_history before the update of its date is created again
+        stale = [i for h, i, date in found if date < now - cls.USE_INTERVAL]
+        if stale and cls.objects.filter(id__in=stale).update(date=now) < len(stale):
+            ids = dict(cls.objects.filter(hash__in=snapshots).values_list('hash', 'id'))
+        missing = [cls(hash=h, **{f: values.get(f) for f in cls.FIELDS}) for h, values in snapshots.items() if h not in ids]
+        if missing:
+            cls.objects.bulk_create(missing, ignore_conflicts=True)
+            ids.update(cls.objects.filter(hash__in=[r.hash for r in missing]).values_list('hash', 'id'))
+        return ids
+
+    @classmethod
+    def get_id(cls, values):
+        return cls.get_ids([values])[cls.hash_of(values)]
+
+
+def revision_field(field, verbose_name):
+    '''packagehistory attribute reading and writing a field of its revision'''
+    def getter(self):
+        if self._snapshot is not None:
+            return self._snapshot[field]
+        if self.revision_id is not None:
+            return getattr(self.revision, field)
+        return None
+
+    def setter(self, value):
+        self.snapshot()[field] = value
+    getter.short_description = verbose_name
+    getter.admin_order_field = 'revision__%s' % field
+    return property(getter, setter)
+
+
+def assign_revisions(records):
+    '''Set the revision of packagehistory records whose package fields were modified'''
+    pending = dict()
+    for record in records:
+        if record._snapshot is not None:
+            h = packagerevision.hash_of(record._snapshot)
+            if h != record._revision_hash:
+                pending.setdefault(h, list()).append(record)
+    if not pending:
+        return
+    ids = packagerevision.get_ids([rs[0]._snapshot for rs in pending.values()])
+    for h, rs in pending.items():
+        for record in rs:
+            record.revision_id = ids[h]
+            record._revision_hash = h
+
+
+class packagehistory(models.Model):
+    # Status classes of the free-text statuses sent by the clients
+    PROGRAMMED, READY, PROGRESS, COMPLETED, WARNING, ERROR, OTHER = range(1, 8)
+    choice_status_code = (
+        (PROGRAMMED, _('packagehistory|programmed')),
+        (READY, _('packagehistory|ready')),
+        (PROGRESS, _('packagehistory|in progress')),
+        (COMPLETED, _('packagehistory|completed')),
+        (WARNING, _('packagehistory|warning')),
+        (ERROR, _('packagehistory|error')),
+        (OTHER, _('packagehistory|other')),
+    )
+    # Package fields at the time of the record (stored once in packagerevision)
+    revision = models.ForeignKey(packagerevision, null=True, blank=True, editable=False, on_delete=models.PROTECT, verbose_name=_('packagehistory|revision'))
+    name = revision_field('name', _('packagehistory|name'))
+    description = revision_field('description', _('packagehistory|description'))
+    command = revision_field('command', _('packagehistory|command'))
+    packagesum = revision_field('packagesum', _('packagehistory|packagesum'))
+    packagehash = revision_field('packagehash', _('package|packagehash'))
+    filename = revision_field('filename', _('packagehistory|filename'))
     machine = models.ForeignKey(machine, on_delete=models.CASCADE, verbose_name=_('packagehistory|machine'))
     package = models.ForeignKey(package, null=True, blank=True, on_delete=models.SET_NULL, verbose_name=_('packagehistory|package'))
     status = models.CharField(max_length=500, default='Programmed', null=True, blank=True, verbose_name=_('packagehistory|status'))
-    date = models.DateTimeField(auto_now=True, verbose_name=_('packagehistory|date'))
+    status_code = models.PositiveSmallIntegerField(choices=choice_status_code, default=PROGRAMMED, editable=False, verbose_name=_('packagehistory|status code'))
+    # Set by save() like auto_now, but kept by bulk_create (statuses of a request are ordered by date)
+    date = models.DateTimeField(default=timezone.now, editable=False, verbose_name=_('packagehistory|date'))
 
     class Meta:
         verbose_name = _('packagehistory|package history')
         verbose_name_plural = _('packagehistory|packages history')
         ordering = ['date']
+        indexes = [
+            models.Index(fields=['machine', 'package', 'status', 'date'], name='deploy_history_mpsd_idx'),
+            models.Index(fields=['status_code', 'date'], name='deploy_history_code_date_idx'),
+        ]
 
     def __str__(self):
         return self.name
 
+    _snapshot = None
+    _revision_hash = None
+
+    def snapshot(self):
+        '''Modifiable package fields values (copy of the revision ones)'''
+        if self._snapshot is None:
+            revision = self.revision if self.revision_id is not None else None
+            self._snapshot = {f: getattr(revision, f, None) for f in packagerevision.FIELDS}
+            self._revision_hash = revision.hash if revision is not None else None
+        return self._snapshot
+
+    def save(self, *args, **kwargs):
+        self.status_code = self.get_status_code(self.status)
+        assign_revisions([self])
+        if kwargs.get('update_fields') is None or 'date' in kwargs['update_fields']:
+            self.date = timezone.now()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields'])
+            if 'status' in kwargs['update_fields']:
+                kwargs['update_fields'].add('status_code')
+            if kwargs['update_fields'] & set(packagerevision.FIELDS):
+                kwargs['update_fields'] = (kwargs['update_fields'] - set(packagerevision.FIELDS)) | {'revision'}
+        super(packagehistory, self).save(*args, **kwargs)
+
+    @classmethod
+    def get_status_code(cls, status):
+        '''Status class of a client status (other statuses, e.g. written by the server, are not errors)'''
+        if status == 'Programmed':
+            return cls.PROGRAMMED
+        if status == 'Ready to download and execute':
+            return cls.READY
+        if status == 'Install in progress':
+            return cls.PROGRESS
+        if status == 'Operation completed':
+            return cls.COMPLETED
+        if status and status.startswith('Warning'):
+            return cls.WARNING
+        if status and status.startswith('Error'):
+            return cls.ERROR
+        return cls.OTHER
+
+    @property
+    def status_detail(self):
+        '''Free-text part of the status (condition of a warning, message of an error or of another status)'''
+        if self.status_code == self.WARNING:
+            return self.status.partition(':')[2].strip()
+        if self.status_code in (self.ERROR, self.OTHER):
+            return self.status or ''
+        return ''
+
+
+class packagecounter(models.Model):
+    '''Executions and installations of a package on a machine in the current day, week and month
+    and date of the last ones, updated on each packagehistory save (used by the history conditions)'''
+    EXECUTE_STATUSES = ('Ready to download and execute', 'Install in progress')
+    INSTALL_STATUSES = ('Operation completed',)
+    machine = models.ForeignKey(machine, on_delete=models.CASCADE, verbose_name=_('packagecounter|machine'))
+    package = models.ForeignKey(package, on_delete=models.CASCADE, verbose_name=_('packagecounter|package'))
+    execute_day = models.DateField(null=True, blank=True, verbose_name=_('packagecounter|execute day'))
+    execute_day_count = models.PositiveIntegerField(default=0, verbose_name=_('packagecounter|execute day count'))
+    execute_week = models.DateField(null=True, blank=True, verbose_name=_('packagecounter|execute week'))
+    execute_week_count = models.PositiveIntegerField(default=0, verbose_name=_('packagecounter|execute week count'))
+    execute_month = models.DateField(null=True, blank=True, verbose_name=_('packagecounter|execute month'))
+    execute_month_count = models.PositiveIntegerField(default=0, verbose_name=_('packagecounter|execute month count'))
+    last_ready = models.DateTimeField(null=True, blank=True, verbose_name=_('packagecounter|last ready to download'))
+    install_day = models.DateField(null=True, blank=True, verbose_name=_('packagecounter|install day'))
+    install_day_count = models.PositiveIntegerField(default=0, verbose_name=_('packagecounter|install day count'))
+    install_week = models.DateField(null=True, blank=True, verbose_name=_('packagecounter|install week'))
+    install_week_count = models.PositiveIntegerField(default=0, verbose_name=_('packagecounter|install week count'))
+    install_month = models.DateField(null=True, blank=True, verbose_name=_('packagecounter|install month'))
+    install_month_count = models.PositiveIntegerField(default=0, verbose_name=_('packagecounter|install month count'))
+    last_install = models.DateTimeField(null=True, blank=True, verbose_name=_('packagecounter|last install'))
+
+    class Meta:
+        verbose_name = _('packagecounter|package counter')
+        verbose_name_plural = _('packagecounter|package counters')
+        unique_together = ('machine', 'package',)
+
+    def __str__(self):
+        return '%s %s' % (self.machine_id, self.package_id)
+
+    @staticmethod
+    def periods(day):
+        '''Return first day of the day, week and month periods of day'''
+        return {'day': day, 'week': day - timedelta(days=day.weekday()), 'month': day.replace(day=1)}
+
+    def count(self, kind, period, day=None):
+        '''Number of executions or installations (kind) in the day, week or month (period) of day (today by default)'''
+        start = self.periods(day or timezone.localdate())[period]
+        if getattr(self, '%s_%s' % (kind, period)) != start:
+            return 0
+        return getattr(self, '%s_%s_count' % (kind, period))
+
+    def record(self, history, created):
+        '''Count a saved packagehistory record (records are reused by status() for 5 minutes: counted once)'''
+        if history.status in self.EXECUTE_STATUSES:
+            if created:
+                self.add('execute', history.date)
+            if history.status == 'Ready to download and execute':
+                self.last_ready = max(filter(None, (self.last_ready, history.date)))
+        elif history.status in self.INSTALL_STATUSES:
+            if created:
+                self.add('install', history.date)
+            self.last_install = max(filter(None, (self.last_install, history.date)))
+
+    def add(self, kind, date):
+        '''Count an execution or installation (kind) made at date'''
+        for period, start in self.periods(timezone.localdate(date)).items():
+            if getattr(self, '%s_%s' % (kind, period)) == start:
+                setattr(self, '%s_%s_count' % (kind, period), getattr(self, '%s_%s_count' % (kind, period)) + 1)
+            elif getattr(self, '%s_%s' % (kind, period)) is None or getattr(self, '%s_%s' % (kind, period)) < start:
+                setattr(self, '%s_%s' % (kind, period), start)
+                setattr(self, '%s_%s_count' % (kind, period), 1)
+
+
+def update_packagecounters(records):
+    '''Update the packagecounter of saved packagehistory records: list of (record, created)'''
+    records = [(record, created) for record, created in records if record.package_id is not None and
+               record.status in packagecounter.EXECUTE_STATUSES + packagecounter.INSTALL_STATUSES]
+    if not records:
+        return
+    with transaction.atomic():
+        counters = {(c.machine_id, c.package_id): c for c in packagecounter.objects.select_for_update().filter(
+            machine_id__in={r.machine_id for r, created in records}, package_id__in={r.package_id for r, created in records})}
+        existing_counters = list(counters.values())
+        new_counters = list()
+        for record, created in records:
+            counter = counters.get((record.machine_id, record.package_id))
+            if counter is None:
+                counter = packagecounter(machine_id=record.machine_id, package_id=record.package_id)
+                counters[(record.machine_id, record.package_id)] = counter
+                new_counters.append(counter)
+            counter.record(record, created)
+        packagecounter.objects.bulk_create(new_counters, ignore_conflicts=True)
+        packagecounter.objects.bulk_update(existing_counters,
+                                           [f.name for f in packagecounter._meta.concrete_fields
+                                            if f.name not in ('id', 'machine', 'package')])
+
+
+def refresh_packagecounters(pairs):
+    '''Recompute from the history the packagecounter of (machine_id, package_id) pairs after records deletion'''
+    pairs = {(mid, pid) for mid, pid in pairs if pid is not None}
+    if not pairs:
+        return
+    counters = dict()
+    history = packagehistory.objects.filter(machine_id__in={mid for mid, pid in pairs},
+                                            package_id__in={pid for mid, pid in pairs},
+                                            status__in=packagecounter.EXECUTE_STATUSES + packagecounter.INSTALL_STATUSES)
+    for record in history.order_by('date', 'id').only('machine_id', 'package_id', 'status', 'date'):
+        key = (record.machine_id, record.package_id)
+        if key in pairs:
+            if key not in counters:
+                counters[key] = packagecounter(machine_id=record.machine_id, package_id=record.package_id)
+            counters[key].record(record, True)
+    with transaction.atomic():
+        for mid, pid in pairs:
+            packagecounter.objects.filter(machine_id=mid, package_id=pid).delete()
+        packagecounter.objects.bulk_create(counters.values())
+
+
+class packagestatuslatest(models.Model):
+    '''Last status of a package on a machine, updated on each packagehistory save
+    (current state of a package across the fleet without scanning the history)'''
+    machine = models.ForeignKey(machine, on_delete=models.CASCADE, verbose_name=_('packagestatuslatest|machine'))
+    package = models.ForeignKey(package, on_delete=models.CASCADE, verbose_name=_('packagestatuslatest|package'))
+    status = models.CharField(max_length=500, null=True, blank=True, verbose_name=_('packagestatuslatest|status'))
+    status_code = models.PositiveSmallIntegerField(choices=packagehistory.choice_status_code, default=packagehistory.PROGRAMMED, verbose_name=_('packagehistory|status code'))
+    date = models.DateTimeField(verbose_name=_('packagestatuslatest|date'))
+
+    class Meta:
+        verbose_name = _('packagestatuslatest|package latest status')
+        verbose_name_plural = _('packagestatuslatest|packages latest statuses')
+        unique_together = ('machine', 'package',)
+        indexes = [
+            models.Index(fields=['package', 'status_code'], name='deploy_latest_package_code_idx'),
+            models.Index(fields=['status_code', 'date'], name='deploy_latest_code_date_idx'),
+        ]
+
+    def __str__(self):
+        return '%s %s: %s' % (self.machine_id, self.package_id, self.status)
+
+
+def update_latest_statuses(records):
+    '''Set the last status of saved packagehistory records (the most recent one of each machine and package)'''
+    latest = dict()
+    for record in records:
+        key = (record.machine_id, record.package_id)
+        if record.package_id is not None and (key not in latest or record.date >= latest[key].date):
+            latest[key] = record
+    if not latest:
+        return
+    # MySQL/MariaDB upsert (ON DUPLICATE KEY UPDATE) does not accept the conflict target
+    unique_fields = ['machine', 'package'] if connection.features.supports_update_conflicts_with_target else None
+    packagestatuslatest.objects.bulk_create(
+        [packagestatuslatest(machine_id=r.machine_id, package_id=r.package_id, status=r.status,
+                             status_code=packagehistory.get_status_code(r.status), date=r.date)
+         for r in latest.values()],
+        update_conflicts=True, unique_fields=unique_fields, update_fields=['status', 'status_code', 'date'])
+
+
+def refresh_latest_statuses(pairs):
+    '''Recompute from the history the last status of (machine_id, package_id) pairs after records deletion'''
+    pairs = {(mid, pid) for mid, pid in pairs if pid is not None}
+    if not pairs:
+        return
+    records = dict()
+    history = packagehistory.objects.filter(machine_id__in={mid for mid, pid in pairs},
+                                            package_id__in={pid for mid, pid in pairs}).order_by('date', 'id')
+    for record in history.only('machine_id', 'package_id', 'status', 'date'):
+        if (record.machine_id, record.package_id) in pairs:
+            records[(record.machine_id, record.package_id)] = record
+    with transaction.atomic():
+        for mid, pid in pairs - set(records):
+            packagestatuslatest.objects.filter(machine_id=mid, package_id=pid).delete()
+        update_latest_statuses(records.values())
+
+
+@receiver(post_save, sender=packagehistory)
+def postsave_packagehistory(sender, instance, created, **kwargs):
+    # packagecounter is updated by the status path (save_package_statuses)
+    update_latest_statuses([instance])
+
 
 class packageprofile(models.Model):
     choice_yes_no = (
@@ -359,6 +909,8 @@ class packageprofile(models.Model):
     entity = models.ManyToManyField(entity, blank=True,  related_name='package_profile_entity', verbose_name=_('packageprofile|entity'))
     editor = models.ForeignKey(User, null=True, on_delete=models.CASCADE, verbose_name=_('packageprofile| condition last editor'))
     exclusive_editor = models.CharField(max_length=3, choices=choice_yes_no, default='no', verbose_name=_('packageprofile|exclusive editor'))
+    # Packages of the profile and of all its parents, maintained by update_effective_packages()
+    effective_packages = models.ManyToManyField('package', blank=True, editable=False, related_name='effective_packageprofiles', verbose_name=_('packageprofile|effective packages'))
 
     class Meta:
         verbose_name = _('packageprofile|package profile')
@@ -375,19 +927,9 @@ class packageprofile(models.Model):
         else:
             return plist
 
-    def get_soft(self, plist=list()):
-        packlist = list()
-        # Add packages of profile
-        for package in self.packages.all():
-            if package not in packlist:
-                packlist.append(package)
-        # Add packages of profile's parents
-        # Need to pass list() as parameter, Django bug??
-        for profile in self.get_all_parents(list()):
-            for package in profile.packages.all():
-                if package not in packlist:
-                    packlist.append(package)
-        return sorted(packlist, key=lambda package: package.name)
+    def get_soft(self):
+        '''Return packages of profile and of profile's parents sorted by name'''
+        return list(self.effective_packages.all())
 
     def get_packages(self):
         retval = '<ul class="grp-list-options">'
@@ -398,6 +940,104 @@ class packageprofile(models.Model):
     get_packages.short_description = _('packageAdmin|get_packages')
 
 
+def update_effective_packages(profile_ids=None):
+    '''Update effective packages of profiles in profile_ids and of their children recursively
+    (all profiles if profile_ids is None)'''
+    parents = dict(packageprofile.objects.values_list('id', 'parent_id'))
+    packages = dict()
+    for profile_id, package_id in packageprofile.packages.through.objects.values_list('packageprofile_id', 'package_id'):
+        packages.setdefault(profile_id, set()).add(package_id)
+
+    if profile_ids is None:
+        profiles = set(parents)
+    else:
+        # Add children of updated profiles
+        profiles = set(profile_ids) & set(parents)
+        children = dict()
+        for profile_id, parent_id in parents.items():
+            children.setdefault(parent_id, list()).append(profile_id)
+        todo = list(profiles)
+        while todo:
+            for child_id in children.get(todo.pop(), list()):
+                if child_id not in profiles:
+                    profiles.add(child_id)
+                    todo.append(child_id)
+
+    through = packageprofile.effective_packages.through
+    current = dict()
+    for profile_id, package_id in through.objects.filter(packageprofile_id__in=profiles).values_list('packageprofile_id', 'package_id'):
+        current.setdefault(profile_id, set()).add(package_id)
+    to_insert = list()
+    changed = list()
+    for profile_id in profiles:
+        effective = set()
+        visited = set()
+        ancestor_id = profile_id
+        # Stop on loops in parents
+        while ancestor_id is not None and ancestor_id not in visited:
+            visited.add(ancestor_id)
+            effective |= packages.get(ancestor_id, set())
+            ancestor_id = parents.get(ancestor_id)
+        existing = current.get(profile_id, set())
+        to_insert += [through(packageprofile_id=profile_id, package_id=package_id) for package_id in effective - existing]
+        if existing - effective:
+            through.objects.filter(packageprofile_id=profile_id, package_id__in=existing - effective).delete()
+        if existing != effective:
+            changed.append(profile_id)
+    through.objects.bulk_create(to_insert)
+    # Candidate packages of the machines of these profiles have changed
+    if changed:
+        invalidate_deployplans(machine.objects.filter(packageprofile_id__in=changed).values('id'))
+
+
+@receiver(m2m_changed, sender=packageprofile.packages.through)
+def profile_packages_changed(sender, action, instance, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            update_effective_packages([instance.id])
+        elif pk_set is not None:
+            update_effective_packages(pk_set)
+        else:
+            update_effective_packages()
+
+
+@receiver(post_save, sender=packageprofile)
+def postsave_packageprofile(sender, instance, **kwargs):
+    # parent may have changed
+    update_effective_packages([instance.id])
+
+
+@receiver(post_delete, sender=packageprofile)
+def postdelete_packageprofile(sender, instance, **kwargs):
+    # children have lost their parent
+    update_effective_packages()
+
+
+# Salts of the mirror manifests and of the requests of the mirrors (signed with MIRROR_KEY)
+MIRROR_MANIFEST_SALT = 'deploy.mirror_manifest'
+MIRROR_REQUEST_SALT = 'deploy.mirror_request'
+
+
+def mirror_manifest(ent):
+    '''List of [path relative to MEDIA_ROOT, size, packagehash] of the package files needed by the machines of
+    the entity ent (effective packages of the profiles of the entity and of its machines, and packages
+    programmed on its machines)'''
+    profiles = set(machine.objects.filter(entity=ent).exclude(packageprofile=None).values_list(
+        'packageprofile_id', flat=True).distinct())
+    if ent.packageprofile_id is not None:
+        profiles.add(ent.packageprofile_id)
+    packages = package.objects.exclude(filename='').exclude(packagehash='nofile').order_by()
+    files = dict()
+    for filename, packagehash in packages.filter(effective_packageprofiles__in=profiles).values_list(
+            'filename', 'packagehash').union(packages.filter(machine__entity=ent).values_list(
+            'filename', 'packagehash')):
+        try:
+            files[filename] = [filename, os.path.getsize(os.path.join(settings.MEDIA_ROOT, filename)), packagehash]
+        except OSError:
+            pass  # missing file, nothing to mirror
+    return sorted(files.values())
+
+
 class packagewakeonlan(models.Model):
     choice_yes_no = (
         ('yes', _('package|yes')),
@@ -447,6 +1087,83 @@ class timeprofile(models.Model):
         return self.name
 
 
+class deployplan(models.Model):
+    '''Deploy plan of a machine computed at its last inventory: candidate packages (programmed on the
+    machine or included in its package profile) and results of the conditions which only depend on the
+    machine facts. The plan is valid while its key (inventory checksums and machine attributes used by
+    the conditions) is unchanged and is deleted for the machines concerned when packages, conditions or
+    profiles change. Softwares, systems and networks are only read again when an inventory changes their
+    checksums, or when they are edited in the admin'''
+    machine = models.OneToOneField(machine, primary_key=True, on_delete=models.CASCADE, related_name='deployplan', verbose_name=_('deployplan|machine'))
+    key = models.CharField(max_length=40, verbose_name=_('deployplan|key'))
+    packages = models.JSONField(default=list, verbose_name=_('deployplan|packages'))
+    # 'package_id:condition_id' -> result of the condition for the package (custom variables may differ)
+    conditions = models.JSONField(default=dict, verbose_name=_('deployplan|conditions'))
+    date = models.DateTimeField(auto_now=True, verbose_name=_('deployplan|date'))
+
+    class Meta:
+        verbose_name = _('deployplan|deploy plan')
+        verbose_name_plural = _('deployplan|deploy plans')
+
+    def __str__(self):
+        return str(self.machine_id)
+
+
+def invalidate_deployplans(machine_ids):
+    '''Delete the deploy plans of machines (ids or subquery of ids): they are computed again at their next inventory'''
+    deployplan.objects.filter(machine_id__in=machine_ids).delete()
+
+
+def invalidate_package_deployplans(package_ids):
+    '''Delete the deploy plans of the machines on which packages are programmed or included in their package profile'''
+    deployplan.objects.filter(
+        models.Q(machine_id__in=machine.packages.through.objects.filter(package_id__in=package_ids).values('machine_id')) |
+        models.Q(machine__packageprofile_id__in=packageprofile.effective_packages.through.objects.filter(
+            package_id__in=package_ids).values('packageprofile_id'))).delete()
+
+
+# Only the changes of the data stored in the plans (candidate packages, results of the conditions rendered
+# with the custom variables) delete plans: a new or deleted object, a time profile or an entity is not in a plan.
+# Effective packages of the profiles are handled in update_effective_packages()
+@receiver(post_save, sender=package)
+def postsave_package_deployplans(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_package_deployplans([instance.id])
+
+
+@receiver(post_save, sender=packagecondition)
+def postsave_packagecondition_deployplans(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_package_deployplans(package.objects.filter(conditions=instance).values('id'))
+
+
+@receiver(post_save, sender=packagecustomvar)
+@receiver(post_delete, sender=packagecustomvar)
+def packagecustomvar_deployplans(sender, instance, **kwargs):
+    invalidate_package_deployplans([instance.package_id])
+
+
+@receiver(post_save, sender=typemachine)
+def postsave_typemachine_deployplans(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_deployplans(machine.objects.filter(typemachine=instance).values('id'))
+
+
+@receiver(m2m_changed, sender=machine.packages.through)
+def machine_packages_changed(sender, action, instance, reverse, pk_set, **kwargs):
+    # status() removes each reported package from the machine: plan is kept if it was not programmed on it
+    if action == 'pre_remove' and not reverse:
+        if sender.objects.filter(machine_id=instance.id, package_id__in=pk_set).exists():
+            deployplan.objects.filter(machine_id=instance.id).delete()
+    elif action in ('post_add', 'pre_remove', 'post_clear'):
+        if not reverse:
+            deployplan.objects.filter(machine_id=instance.id).delete()
+        elif pk_set is not None:
+            deployplan.objects.filter(machine_id__in=pk_set).delete()
+    elif action == 'pre_clear' and reverse:
+        invalidate_package_deployplans([instance.id])
+
+
 class impex(models.Model):
     choice_yes_no = (
         ('yes', _('package|yes')),
@@ -510,7 +1227,8 @@ def postcreate_impex(sender, instance, created, **kwargs):
             os.mkdir(fullpath)
             instance.filename = 'package-file/'+path+'/export.zip'
 
-        zip = zipfile.ZipFile(instance.filename.path, 'w', zipfile.ZIP_DEFLATED)
+        # Written in a new file: the previous one may be a stored file
+        zip = zipfile.ZipFile(instance.filename.path + '.tmp', 'w', zipfile.ZIP_DEFLATED)
         if pack.filename is not None:
             try:
                 zip.write(pack.filename.path, os.path.basename(pack.filename.name))
@@ -518,6 +1236,7 @@ def postcreate_impex(sender, instance, created, **kwargs):
                 pass
         zip.writestr('export.json', data)
         zip.close()
+        os.replace(instance.filename.path + '.tmp', instance.filename.path)
     # if we choose to make an import
     else:
         if instance.filename is not None or instance.filename != '':
@@ -525,9 +1244,17 @@ def postcreate_impex(sender, instance, created, **kwargs):
             path = random_directory()
             fullpath = settings.MEDIA_ROOT+'/package-file/'+path
             os.mkdir(fullpath)
-            # Extract package's file
+            # Extract package's file (linked to the stored file if already known)
             zfile = zipfile.ZipFile(instance.filename)
-            zfile.extractall(fullpath)
+            stored = dict()
+            for obj in serializers.deserialize('json', zfile.read('export.json')):
+                if type(obj.object) == package and obj.object.filename != '' and obj.object.packagehash:
+                    stored[os.path.basename(obj.object.filename.name)] = obj.object.packagehash
+            for member in zfile.namelist():
+                if member in stored and link_stored_file(stored[member], os.path.join(fullpath, member),
+                                                         zfile.getinfo(member).file_size):
+                    continue
+                zfile.extract(member, fullpath)
             zfile.close()
             # Create package object
             # Load Json file
@@ -577,8 +1304,12 @@ def postcreate_impex(sender, instance, created, **kwargs):
                 pack.conditions.add(cond)
             pack.save()
 
-    instance.packagesum = md5_for_file(instance.filename)
-    instance.packagehash = sha512_for_file(instance.filename)
+    previous = instance.packagehash
+    instance.packagesum, instance.packagehash = hashes_for_file(instance.filename)
+    if instance.packagehash != 'nofile':
+        store_file(instance.filename.path, instance.packagesum, instance.packagehash)
+    if previous != instance.packagehash:
+        release_stored_file(previous)
     post_save.disconnect(receiver=postcreate_impex, sender=impex)
     instance.save()
     post_save.connect(receiver=postcreate_impex, sender=impex)
@@ -592,3 +1323,4 @@ def predelete_impex(sender, instance, **kwargs):
         else:
             if len(package.objects.filter(filename=instance.filename.name)) <= 1:
                 shutil.rmtree(os.path.dirname(instance.filename.path))
+        release_stored_file(instance.packagehash)
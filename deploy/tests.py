@@ -5,7 +5,33 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
+from django.contrib.auth.models import User
+from deploy.models import package, packageprofile, packagehistory, packagecounter, \
+    packagestatuslatest, refresh_latest_statuses, update_latest_statuses, packagerevision, filehash, packageupload, \
+    upload_hashers, hashes_for_file, store_path, link_stored_file, update_packagecounters
+from deploy.admin import packagehistoryAdmin
+from django.contrib import admin
+from deploy.views import upload_start, upload_chunk, package_download, byte_range, mirror_manifest_view
+from deploy.models import MIRROR_MANIFEST_SALT, MIRROR_REQUEST_SALT
+from inventory.models import machine, entity
+from django.core import signing
+from django.db import connection
+from django.db.models import QuerySet
+from django.core.management.base import CommandError
+from datetime import date, datetime, timedelta, timezone
+from django.core.management import call_command
+from django.urls import resolve
+from django.http import Http404
+from django.core.files.uploadedfile import SimpleUploadedFile
+from unittest import mock
+from io import StringIO
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
 
 
 class SimpleTest(TestCase):
@@ -14,3 +40,665 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class packageprofileTestCase(TestCase):
+    def setUp(self):
+        self.packs = [package.objects.create(name='package %d' % i, description='package', command='cmd')
+                      for i in range(4)]
+
+    def names(self, profile):
+        return [p.name for p in profile.get_soft()]
+
+    def test_effective_packages(self):
+        root = packageprofile.objects.create(name='root', description='root')
+        child = packageprofile.objects.create(name='child', description='child', parent=root)
+        grandchild = packageprofile.objects.create(name='grandchild', description='grandchild', parent=child)
+        root.packages.add(self.packs[0])
+        child.packages.add(self.packs[2], self.packs[0])
+        grandchild.packages.add(self.packs[1])
+        self.assertEqual(self.names(grandchild), ['package 0', 'package 1', 'package 2'])
+        self.assertEqual(self.names(root), ['package 0'])
+        with self.assertNumQueries(1):
+            grandchild.get_soft()
+
+        # Parent change
+        grandchild.parent = root
+        grandchild.save()
+        self.assertEqual(self.names(grandchild), ['package 0', 'package 1'])
+
+        # Packages removed from a parent or added from the package side
+        root.packages.remove(self.packs[0])
+        self.assertEqual(self.names(grandchild), ['package 1'])
+        self.assertEqual(self.names(child), ['package 0', 'package 2'])
+        self.packs[3].packageprofile_set.add(root)
+        self.assertEqual(self.names(grandchild), ['package 1', 'package 3'])
+
+        # Deleted parent
+        root.delete()
+        self.assertEqual(self.names(packageprofile.objects.get(name='grandchild')), ['package 1'])
+
+    def test_effective_packages_loop(self):
+        first = packageprofile.objects.create(name='first', description='first')
+        second = packageprofile.objects.create(name='second', description='second', parent=first)
+        first.parent = second
+        first.save()
+        first.packages.add(self.packs[0])
+        second.packages.add(self.packs[1])
+        self.assertEqual(self.names(first), ['package 0', 'package 1'])
+        self.assertEqual(self.names(second), ['package 0', 'package 1'])
+
+
+class filehashTestCase(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+
+    def test_hashes_cached(self):
+        content = b'installer' * 1000
+        with self.settings(MEDIA_ROOT=self.media.name):
+            p = package.objects.create(name='p', description='p', command='setup.exe',
+                                       filename=SimpleUploadedFile('setup.exe', content))
+            self.assertEqual(p.packagesum, hashlib.md5(content).hexdigest())
+            self.assertEqual(p.packagehash, hashlib.sha512(content).hexdigest())
+            self.assertEqual(filehash.objects.filter(path=p.filename.path).count(), 1)
+            # Only the description changed: the file is not read again
+            with mock.patch('deploy.models.hashlib.sha512') as sha512:
+                p.description = 'edited'
+                p.save()
+            self.assertFalse(sha512.called)
+            self.assertEqual(package.objects.get(id=p.id).packagehash, hashlib.sha512(content).hexdigest())
+            # Modified file (stored files are read-only): hashes are computed again
+            os.chmod(p.filename.path, 0o644)
+            with open(p.filename.path, 'ab') as f:
+                f.write(b'patch')
+            p.save()
+            self.assertEqual(p.packagehash, hashlib.sha512(content + b'patch').hexdigest())
+            p.delete()
+            self.assertFalse(filehash.objects.exists())
+
+
+class packagestoreTestCase(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+
+    def create(self, name, content):
+        return package.objects.create(name=name, description=name, command='setup.exe',
+                                      filename=SimpleUploadedFile('setup.exe', content))
+
+    def test_identical_files_linked(self):
+        content = os.urandom(2000)
+        with self.settings(MEDIA_ROOT=self.media.name):
+            p1 = self.create('p1', content)
+            p2 = self.create('p2', content)
+            other = self.create('other', b'other')
+            blob = store_path(p1.packagehash)
+            self.assertNotEqual(p1.filename.path, p2.filename.path)
+            self.assertTrue(os.path.samefile(p1.filename.path, blob))
+            self.assertTrue(os.path.samefile(p2.filename.path, blob))
+            self.assertFalse(os.path.samefile(other.filename.path, blob))
+            with open(p2.filename.path, 'rb') as f:
+                self.assertEqual(f.read(), content)
+            # The stored file is deleted with its last package
+            p1.delete()
+            self.assertTrue(os.path.exists(blob))
+            p2.delete()
+            self.assertFalse(os.path.exists(blob))
+            self.assertTrue(os.path.exists(store_path(other.packagehash)))
+
+    def test_stored_files_protected(self):
+        content = os.urandom(2000)
+        with self.settings(MEDIA_ROOT=self.media.name):
+            p1 = self.create('p1', content)
+            p2 = self.create('p2', content)
+            blob = store_path(p1.packagehash)
+            self.assertEqual(os.stat(blob).st_mode & 0o777, 0o444)
+            # Modified in place anyway: the stored file does not match its name anymore
+            os.chmod(p1.filename.path, 0o644)
+            with open(p1.filename.path, 'ab') as f:
+                f.write(b'patch')
+            p1.save()
+            self.assertFalse(os.path.exists(blob))
+            self.assertEqual(p1.packagehash, hashlib.sha512(content + b'patch').hexdigest())
+            self.assertTrue(os.path.samefile(store_path(p1.packagehash), p1.filename.path))
+            # Stored file not matching its size or hash is not linked
+            path = os.path.join(self.media.name, 'setup.exe')
+            with open(path, 'wb') as f:
+                f.write(content)
+            self.assertFalse(link_stored_file(p1.packagehash, path, len(content)))
+            self.assertFalse(link_stored_file('0' * 128, path, len(content)))
+            with open(blob, 'wb') as f:
+                f.write(b'x' * len(content))
+            self.assertFalse(link_stored_file(hashlib.sha512(content).hexdigest(), path, len(content)))
+            self.assertFalse(os.path.samefile(path, blob))
+
+    def test_store_package_files(self):
+        content = os.urandom(2000)
+        with self.settings(MEDIA_ROOT=self.media.name):
+            with mock.patch('deploy.models.store_file'):
+                p1 = self.create('p1', content)
+                p2 = self.create('p2', content)
+            self.assertFalse(os.path.samefile(p1.filename.path, p2.filename.path))
+            out = StringIO()
+            call_command('store_package_files', '--dry-run', stdout=out)
+            self.assertIn('2 files, 1 to replace', out.getvalue())
+            self.assertFalse(os.path.samefile(p1.filename.path, p2.filename.path))
+            call_command('store_package_files', stdout=StringIO())
+            self.assertTrue(os.path.samefile(p1.filename.path, p2.filename.path))
+            self.assertTrue(os.path.samefile(p1.filename.path, store_path(p1.packagehash)))
+            # Cached hashes follow the linked file
+            self.assertEqual(hashes_for_file(package.objects.get(id=p2.id).filename),
+                             (p2.packagesum, p2.packagehash))
+
+
+class packagedownloadTestCase(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.content = os.urandom(1000)
+        self.machine = machine.objects.create(name='host')
+        with self.settings(MEDIA_ROOT=self.media.name):
+            self.pack = package.objects.create(name='p', description='p', command='setup.exe',
+                                               filename=SimpleUploadedFile('setup.exe', self.content))
+        self.etag = '"%s"' % hashlib.sha512(self.content).hexdigest()
+
+    def get(self, url, method='get', **headers):
+        match = resolve(url)
+        request = getattr(RequestFactory(), method)(url, headers=headers)
+        with self.settings(MEDIA_ROOT=self.media.name):
+            response = match.func(request, *match.args, **match.kwargs)
+            response.body = b''.join(response.streaming_content) if response.streaming else response.content
+        return response
+
+    def url(self, m=None):
+        with self.settings(PACKAGE_DOWNLOAD=True, PROJECT_URL=''):
+            return self.pack.download_url(m or self.machine)
+
+    def test_byte_range(self):
+        self.assertEqual(byte_range('bytes=0-9', 100), (0, 9))
+        self.assertEqual(byte_range('bytes=90-', 100), (90, 99))
+        self.assertEqual(byte_range('bytes=90-500', 100), (90, 99))
+        self.assertEqual(byte_range('bytes=-10', 100), (90, 99))
+        self.assertEqual(byte_range('bytes=-500', 100), (0, 99))
+        self.assertIs(byte_range('bytes=100-', 100), False)
+        self.assertIs(byte_range('bytes=-0', 100), False)
+        for header in ('bytes=0-9,20-29', 'bytes=9-0', 'bytes=-', 'items=0-9', 'bytes=a-b', 'bytes=0-+9'):
+            self.assertIsNone(byte_range(header, 100), header)
+
+    def test_download_url(self):
+        with self.settings(MEDIA_ROOT=self.media.name):
+            self.assertEqual(self.pack.download_url(self.machine), self.pack.filename.url)
+        self.assertTrue(self.url().startswith('/download/'))
+        self.assertTrue(self.url().endswith('/setup.exe'))
+
+    def test_ranges(self):
+        url = self.url()
+        response = self.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.body, self.content)
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Length'], '1000')
+        response = self.get(url, Range='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 100-199/1000')
+        self.assertEqual(response.body, self.content[100:200])
+        # Resumed download
+        response = self.get(url, Range='bytes=600-', If_Range=self.etag)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Length'], '400')
+        self.assertEqual(response.body, self.content[600:])
+        response = self.get(url, Range='bytes=-10')
+        self.assertEqual(response.body, self.content[-10:])
+        # Other content: the whole file is sent
+        for headers in ({'If_Range': '"other"'}, {'If_Range': 'W/' + self.etag},
+                        {'If_Range': 'Sat, 17 Oct 2026 10:00:00 GMT'}):
+            response = self.get(url, Range='bytes=600-', **headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.body, self.content)
+        response = self.get(url, Range='bytes=0-9,20-29')
+        self.assertEqual(response.status_code, 200)
+        response = self.get(url, Range='bytes=1000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */1000')
+        response = self.get(url, If_None_Match=self.etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.get(url, method='head', Range='bytes=0-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response.body, b'')
+
+    def test_x_accel_redirect(self):
+        with self.settings(PACKAGE_DOWNLOAD_ACCEL='/protected-media/'):
+            response = self.get(self.url(), Range='bytes=0-9')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/' + self.pack.filename.name)
+        self.assertEqual(response['ETag'], self.etag)
+        self.assertEqual(response.body, b'')
+
+    def test_requester_validated(self):
+        url = self.url()
+        token = url.split('/')[2]
+        self.assertEqual(self.get(url.replace(token, token[:-1] + 'x')).status_code, 403)
+        with self.assertRaises(Http404):
+            self.get(url.replace('setup.exe', 'other.exe'))
+        # File replaced since the deploy plan
+        with self.settings(MEDIA_ROOT=self.media.name):
+            self.pack.filename = SimpleUploadedFile('setup.exe', b'new')
+            self.pack.save()
+        self.assertEqual(self.get(url).status_code, 410)
+        url = self.url()
+        self.assertEqual(self.get(url).status_code, 200)
+        self.machine.delete()
+        self.assertEqual(self.get(url).status_code, 403)
+
+
+class mirrorTestCase(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.mirror = tempfile.TemporaryDirectory()
+        self.addCleanup(self.mirror.cleanup)
+        self.requests = list()
+        with self.settings(MEDIA_ROOT=self.media.name):
+            self.packs = {name: package.objects.create(name=name, description=name, command='setup.exe',
+                                                       filename=SimpleUploadedFile('setup.exe', os.urandom(3000)))
+                          for name in ('a', 'b', 'c', 'direct', 'other')}
+        profile = packageprofile.objects.create(name='site', description='site')
+        profile.packages.add(self.packs['a'], self.packs['b'])
+        machine_profile = packageprofile.objects.create(name='machine', description='machine')
+        machine_profile.packages.add(self.packs['c'])
+        self.entity = entity.objects.create(name='site', description='site', packageprofile=profile)
+        host = machine.objects.create(name='host', entity=self.entity, packageprofile=machine_profile)
+        # Programmed directly on a machine of the entity
+        host.packages.add(self.packs['direct'])
+
+    def urlopen(self, request, timeout=None):
+        '''Server answers: manifest view and media files (with ranges)'''
+        self.requests.append((request.full_url, request.get_header('Range')))
+        path = request.full_url.split('://server', 1)[1]
+        if path.startswith('/mirror/'):
+            token = request.get_header('X-mirror-token')
+            django_request = RequestFactory().get(path, headers={'X-Mirror-Token': token})
+            with self.settings(MEDIA_ROOT=self.media.name):
+                response = resolve(path).func(django_request, **resolve(path).kwargs)
+            body = io.BytesIO(response.content)
+            body.status = response.status_code
+            return body
+        with open(os.path.join(self.media.name, path[len('/media/'):]), 'rb') as f:
+            content = f.read()
+        status = 200
+        if request.get_header('Range'):
+            status = 206
+            content = content[int(request.get_header('Range')[6:-1]):]
+        body = io.BytesIO(self.corrupt(content))
+        body.status = status
+        return body
+
+    def corrupt(self, content):
+        return content
+
+    def sync(self, *args):
+        out = StringIO()
+        with mock.patch('deploy.management.commands.sync_mirror.urlopen', self.urlopen):
+            call_command('sync_mirror', 'https://server', self.entity.id, self.mirror.name, '--key', 'secret', *args,
+                         stdout=out, stderr=StringIO())
+        return out.getvalue()
+
+    def test_manifest(self):
+        token = signing.dumps(self.entity.id, key='secret', salt=MIRROR_REQUEST_SALT)
+        request = RequestFactory().get('/', headers={'X-Mirror-Token': token})
+        with self.settings(MEDIA_ROOT=self.media.name, MIRROR_KEY='secret'):
+            response = mirror_manifest_view(request, self.entity.id)
+            manifest = signing.loads(response.content.decode(), key='secret', salt=MIRROR_MANIFEST_SALT)
+            self.assertEqual(manifest['entity'], self.entity.id)
+            self.assertEqual(manifest['files'], sorted([p.filename.name, 3000, p.packagehash]
+                                                       for name, p in self.packs.items() if name != 'other'))
+            self.assertEqual(mirror_manifest_view(request, self.entity.id + 1).status_code, 403)
+            request = RequestFactory().get('/', headers={'X-Mirror-Token': token[:-1]})
+            self.assertEqual(mirror_manifest_view(request, self.entity.id).status_code, 403)
+            with self.assertRaises(signing.BadSignature):
+                signing.loads(response.content.decode(), key='other', salt=MIRROR_MANIFEST_SALT)
+        with self.settings(MIRROR_KEY=''), self.assertRaises(Http404):
+            mirror_manifest_view(request, self.entity.id)
+
+    def test_sync(self):
+        with self.settings(MIRROR_KEY='secret'):
+            self.assertIn('4 files, 0 up to date, 4 downloaded (12000 bytes)', self.sync())
+            for name in ('a', 'b', 'c', 'direct'):
+                with open(os.path.join(self.mirror.name, self.packs[name].filename.name), 'rb') as f:
+                    self.assertEqual(hashlib.sha512(f.read()).hexdigest(), self.packs[name].packagehash)
+            self.assertFalse(os.path.exists(os.path.join(self.mirror.name, self.packs['other'].filename.name)))
+            # Nothing changed: only the manifest is downloaded
+            self.requests.clear()
+            self.assertIn('4 files, 4 up to date, 0 downloaded', self.sync())
+            self.assertEqual(len(self.requests), 1)
+            # New file of a package: only this file is downloaded, the old one deleted
+            old = os.path.join(self.mirror.name, self.packs['b'].filename.name)
+            with self.settings(MEDIA_ROOT=self.media.name):
+                self.packs['b'].filename = SimpleUploadedFile('setup.exe', b'new')
+                self.packs['b'].save()
+            self.requests.clear()
+            self.assertIn('4 files, 3 up to date, 1 downloaded (3 bytes), 1 deleted', self.sync('--delete'))
+            self.assertEqual(self.requests[1][0], 'https://server/media/' + self.packs['b'].filename.name)
+            self.assertFalse(os.path.exists(old))
+
+    def test_sync_verified_and_resumed(self):
+        path = os.path.join(self.mirror.name, self.packs['a'].filename.name)
+        with open(os.path.join(self.media.name, self.packs['a'].filename.name), 'rb') as f:
+            content = f.read()
+        os.makedirs(os.path.dirname(path))
+        with open(path + '.part', 'wb') as f:
+            f.write(content[:1000])
+        # Whole files (b and c) are corrupted, the end of a is not
+        self.corrupt = lambda content: content[:-1] + b'x' if len(content) == 3000 else content
+        with self.settings(MIRROR_KEY='secret'), self.assertRaises(CommandError):
+            self.sync()
+        self.assertIn(('https://server/media/' + self.packs['a'].filename.name, 'bytes=1000-'), self.requests)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['setup.exe'])
+        for name in ('b', 'c', 'direct'):
+            path = os.path.join(self.mirror.name, self.packs[name].filename.name)
+            self.assertEqual(os.listdir(os.path.dirname(path)), [])
+
+
+class packageuploadTestCase(TestCase):
+    def setUp(self):
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+        self.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.factory = RequestFactory()
+
+    def request(self, view, method, url, data=None, **kwargs):
+        if method == 'post' and isinstance(data, bytes):
+            request = self.factory.post(url, data, content_type='application/octet-stream')
+        else:
+            request = getattr(self.factory, method)(url, data or {})
+        request.user = self.user
+        return view(request, **kwargs)
+
+    def test_chunked_upload(self):
+        content = os.urandom(3000)
+        with self.settings(MEDIA_ROOT=self.media.name):
+            response = self.request(upload_start, 'post', '/', {'name': '../setup.exe', 'size': len(content)})
+            token = json.loads(response.content)['token']
+            upload = packageupload.objects.get(token=token)
+            self.assertTrue(upload.filename.startswith('package-file/'))
+            self.assertTrue(upload.filename.endswith('/setup.exe'))
+            response = self.request(upload_chunk, 'post', '/?offset=0', content[:1000], token=token)
+            self.assertEqual(json.loads(response.content)['offset'], 1000)
+            # Chunk sent again after a lost response
+            response = self.request(upload_chunk, 'post', '/?offset=0', content[:1000], token=token)
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(json.loads(response.content)['offset'], 1000)
+            # Next chunk received by another process
+            upload_hashers.clear()
+            self.request(upload_chunk, 'post', '/?offset=1000', content[1000:2000], token=token)
+            response = self.request(upload_chunk, 'post', '/?offset=2000', content[2000:] + b'extra', token=token)
+            self.assertEqual(response.status_code, 400)
+            response = self.request(upload_chunk, 'get', '/', token=token)
+            self.assertEqual(json.loads(response.content)['offset'], 2000)
+            response = self.request(upload_chunk, 'post', '/?offset=2000', content[2000:], token=token)
+            self.assertTrue(json.loads(response.content)['completed'])
+            upload = packageupload.objects.get(token=token)
+            self.assertEqual(upload.sha512, hashlib.sha512(content).hexdigest())
+            self.assertFalse(os.path.exists(upload.part_path))
+            # The package does not read the file again
+            with mock.patch('deploy.models.hashlib.sha512') as sha512:
+                p = package.objects.create(name='p', description='p', command='setup.exe', filename=upload.filename)
+            self.assertFalse(sha512.called)
+            self.assertEqual(p.packagesum, hashlib.md5(content).hexdigest())
+            with open(p.filename.path, 'rb') as f:
+                self.assertEqual(f.read(), content)
+
+    def test_stale_upload_discarded(self):
+        with self.settings(MEDIA_ROOT=self.media.name):
+            upload = packageupload.start(self.user, 'setup.exe', 10)
+            packageupload.objects.filter(id=upload.id).update(date=datetime.now(timezone.utc) - timedelta(days=2))
+            packageupload.start(self.user, 'other.exe', 10)
+            self.assertFalse(packageupload.objects.filter(id=upload.id).exists())
+            self.assertFalse(os.path.exists(os.path.dirname(upload.path)))
+
+
+class packagecounterTestCase(TestCase):
+    def setUp(self):
+        self.m = machine.objects.create(serial='1234', name='pc')
+        self.p = package.objects.create(name='p', description='p', command='rem')
+
+    def history(self, *statuses):
+        return [packagehistory.objects.create(machine=self.m, package=self.p, command='rem', status=status)
+                for status in statuses]
+
+    def test_counter_updated_by_history(self):
+        h, progress, completed, warning = self.history('Ready to download and execute', 'Install in progress',
+                                                       'Operation completed', 'Warning condition: x')
+        self.assertFalse(packagecounter.objects.exists())  # only updated by the status path
+        update_packagecounters([(h, True), (h, False), (progress, True), (completed, True), (warning, True)])
+        counter = packagecounter.objects.get(machine=self.m, package=self.p)
+        for period in ('day', 'week', 'month'):
+            self.assertEqual(counter.count('execute', period), 2)
+            self.assertEqual(counter.count('install', period), 1)
+        self.assertEqual(counter.last_ready, h.date)
+        self.assertIsNotNone(counter.last_install)
+
+    def test_counter_refreshed_on_delete(self):
+        records = self.history('Ready to download and execute', 'Operation completed',
+                               'Ready to download and execute', 'Operation completed')
+        update_packagecounters([(h, True) for h in records])
+        request = RequestFactory().post('/')
+        request.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        history_admin = packagehistoryAdmin(packagehistory, admin.site)
+        history_admin.delete_queryset(request, packagehistory.objects.filter(id__in=[records[2].id, records[3].id]))
+        counter = packagecounter.objects.get(machine=self.m, package=self.p)
+        self.assertEqual(counter.count('execute', 'day'), 1)
+        self.assertEqual(counter.count('install', 'day'), 1)
+        self.assertEqual(packagestatuslatest.objects.get(machine=self.m, package=self.p).status, 'Operation completed')
+        history_admin.delete_model(request, records[1])
+        counter = packagecounter.objects.get(machine=self.m, package=self.p)
+        self.assertEqual(counter.count('install', 'day'), 0)
+        self.assertIsNone(counter.last_install)
+        history_admin.delete_model(request, records[0])
+        self.assertFalse(packagecounter.objects.exists())
+        self.assertFalse(packagestatuslatest.objects.exists())
+
+    def test_counter_periods(self):
+        counter = packagecounter(machine=self.m, package=self.p)
+        counter.add('install', datetime(2026, 3, 30, 12, tzinfo=timezone.utc))  # monday
+        counter.add('install', datetime(2026, 4, 1, 12, tzinfo=timezone.utc))
+        self.assertEqual(counter.count('install', 'day', date(2026, 4, 1)), 1)
+        self.assertEqual(counter.count('install', 'week', date(2026, 4, 5)), 2)
+        self.assertEqual(counter.count('install', 'month', date(2026, 4, 5)), 1)
+        self.assertEqual(counter.count('install', 'week', date(2026, 4, 6)), 0)
+        self.assertEqual(counter.count('execute', 'month', date(2026, 4, 5)), 0)
+
+
+class packagehistoryTestCase(TestCase):
+    def setUp(self):
+        self.m = machine.objects.create(serial='1234', name='pc')
+        self.p = package.objects.create(name='p', description='p', command='rem', packagesum='nofile')
+
+    def test_status_code(self):
+        for status, code, detail in (('Programmed', packagehistory.PROGRAMMED, ''),
+                                     ('Ready to download and execute', packagehistory.READY, ''),
+                                     ('Install in progress', packagehistory.PROGRESS, ''),
+                                     ('Operation completed', packagehistory.COMPLETED, ''),
+                                     ('Warning condition: software firefox', packagehistory.WARNING, 'software firefox'),
+                                     # Written by the server, not counted as errors
+                                     ("Unsupported option for updatengine-client version '3.0': Ignoring 'no_break_on_error'",
+                                      packagehistory.OTHER,
+                                      "Unsupported option for updatengine-client version '3.0': Ignoring 'no_break_on_error'"),
+                                     (None, packagehistory.OTHER, ''),
+                                     ('Error installing package: 1603', packagehistory.ERROR, 'Error installing package: 1603')):
+            h = packagehistory.objects.create(machine=self.m, package=self.p, status=status)
+            self.assertEqual(packagehistory.objects.get(id=h.id).status_code, code)
+            self.assertEqual(h.status_detail, detail)
+        self.assertEqual(packagestatuslatest.objects.get().status_code, packagehistory.ERROR)
+        h.status = 'Operation completed'
+        h.save(update_fields=['status'])
+        self.assertEqual(packagehistory.objects.get(id=h.id).status_code, packagehistory.COMPLETED)
+
+    def test_shared_revisions(self):
+        m2 = machine.objects.create(serial='5678', name='pc2')
+        self.m.packages.add(self.p)
+        m2.packages.add(self.p)
+        self.assertEqual(packagerevision.objects.count(), 1)
+        self.assertEqual(packagehistory.objects.filter(revision__command='rem').count(), 2)
+        # Package edition: one new revision for all the programmed records
+        self.p.command = 'rem edited'
+        self.p.save()
+        self.assertEqual(packagerevision.objects.count(), 2)
+        self.assertEqual([h.command for h in packagehistory.objects.all()], ['rem edited', 'rem edited'])
+        h = packagehistory.objects.create(machine=self.m, package=self.p, name='p', description='p', command='rem edited',
+                                          packagesum='nofile', packagehash='nofile', filename='', status='Install in progress')
+        self.assertEqual(packagerevision.objects.count(), 2)
+        h = packagehistory.objects.get(id=h.id)
+        h.command = 'rem other'
+        h.save(update_fields=['command'])
+        self.assertEqual(packagehistory.objects.get(id=h.id).revision.command, 'rem other')
+        self.assertEqual(packagerevision.objects.count(), 3)
+
+
+class packagestatuslatestTestCase(TestCase):
+    def setUp(self):
+        self.m = machine.objects.create(serial='1234', name='pc')
+        self.p = package.objects.create(name='p', description='p', command='rem', packagesum='nofile')
+
+    def latest(self):
+        return list(packagestatuslatest.objects.values_list('machine_id', 'package_id', 'status'))
+
+    def test_latest_status_follows_history(self):
+        self.m.packages.add(self.p)
+        self.assertEqual(self.latest(), [(self.m.id, self.p.id, 'Programmed')])
+        self.m.packages.remove(self.p)
+        self.assertEqual(self.latest(), [])
+        packagehistory.objects.create(machine=self.m, package=self.p, command='rem', status='Install in progress')
+        h = packagehistory.objects.create(machine=self.m, package=self.p, command='rem', status='Operation completed')
+        self.assertEqual(self.latest(), [(self.m.id, self.p.id, 'Operation completed')])
+        # Programmed again then unprogrammed: previous status is restored
+        self.m.packages.add(self.p)
+        self.assertEqual(self.latest(), [(self.m.id, self.p.id, 'Programmed')])
+        self.m.packages.clear()
+        self.assertEqual(self.latest(), [(self.m.id, self.p.id, 'Operation completed')])
+        self.assertEqual(packagestatuslatest.objects.get().date, h.date)
+
+    def test_refresh_latest_statuses(self):
+        h = packagehistory.objects.create(machine=self.m, package=self.p, command='rem', status='Error: 1')
+        packagestatuslatest.objects.all().delete()
+        refresh_latest_statuses([(self.m.id, self.p.id), (self.m.id, None)])
+        self.assertEqual(self.latest(), [(self.m.id, self.p.id, 'Error: 1')])
+        h.delete()
+        refresh_latest_statuses([(self.m.id, self.p.id)])
+        self.assertEqual(self.latest(), [])
+
+    def test_upsert(self):
+        # Runs on the configured database backend
+        first = packagehistory.objects.create(machine=self.m, package=self.p, command='rem', status='Ready')
+        update_latest_statuses([first])
+        last = packagehistory(machine=self.m, package=self.p, status='Operation completed',
+                              date=first.date + timedelta(seconds=1))
+        update_latest_statuses([last])
+        self.assertEqual(self.latest(), [(self.m.id, self.p.id, 'Operation completed')])
+        # MySQL/MariaDB: no conflict target
+        with mock.patch.object(connection.features, 'supports_update_conflicts_with_target', False), \
+                mock.patch.object(packagestatuslatest.objects, 'bulk_create') as bulk_create:
+            update_latest_statuses([last])
+        self.assertIsNone(bulk_create.call_args.kwargs['unique_fields'])
+        self.assertTrue(bulk_create.call_args.kwargs['update_conflicts'])
+
+
+class purgehistoryTestCase(TestCase):
+    def setUp(self):
+        self.m = machine.objects.create(serial='1234', name='pc')
+        self.p = package.objects.create(name='p', description='p', command='rem')
+        old = datetime.now(timezone.utc) - timedelta(days=100)
+        for status in ('Operation completed', 'Warning condition: x', 'Error: 1', 'Operation completed'):
+            h = packagehistory.objects.create(machine=self.m, package=self.p, command='rem', status=status)
+            packagehistory.objects.filter(id=h.id).update(date=old)
+        packagehistory.objects.create(machine=self.m, package=self.p, command='rem', status='Operation completed')
+        self.media = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media.cleanup)
+
+    def test_purge_retention_and_archive(self):
+        with self.settings(MEDIA_ROOT=self.media.name):
+            call_command('purge_history', keep=['error=never'], chunk_size=2, pause=0, archive='jsonl', stdout=StringIO())
+        self.assertEqual(sorted(packagehistory.objects.values_list('status', flat=True)),
+                         ['Error: 1', 'Operation completed'])
+        directory = os.path.join(self.media.name, 'history-archive')
+        archives = os.listdir(directory)
+        self.assertEqual(len(archives), 1)
+        with gzip.open(os.path.join(directory, archives[0]), 'rt') as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual([row['status'] for row in rows],
+                         ['Operation completed', 'Warning condition: x', 'Operation completed'])
+        self.assertEqual(rows[0]['machine__name'], 'pc')
+
+    def test_purge_resume(self):
+        first = packagehistory.objects.order_by('id').first()
+        directory = os.path.join(self.media.name, 'history-archive')
+        os.makedirs(directory)
+        # Interrupted purge of the completed class after the first row
+        with open(os.path.join(directory, 'purge_history.json'), 'w') as f:
+            json.dump({'started': '2026-01-01T00:00:00+00:00', 'archive': None, 'archive_size': 0,
+                       'cutoffs': {'completed': (datetime.now(timezone.utc) - timedelta(days=90)).isoformat()},
+                       'last_id': first.id, 'purged': 1}, f)
+        out = StringIO()
+        with self.settings(MEDIA_ROOT=self.media.name):
+            call_command('purge_history', pause=0, stdout=out)
+        self.assertIn('Resuming purge', out.getvalue())
+        self.assertIn('2 rows purged', out.getvalue())
+        self.assertEqual(packagehistory.objects.filter(status='Operation completed').count(), 2)
+        self.assertEqual(packagehistory.objects.count(), 4)
+        self.assertFalse(os.path.exists(os.path.join(directory, 'purge_history.json')))
+
+    def test_unused_revisions(self):
+        now = datetime.now(timezone.utc)
+        values = {'name': 'old', 'command': 'rem'}
+        old = packagerevision.objects.get(id=packagerevision.get_id(values))
+        recent = packagerevision.objects.get(id=packagerevision.get_id({'name': 'recent'}))
+        packagerevision.objects.filter(id=old.id).update(date=now - timedelta(days=3))
+        with self.settings(MEDIA_ROOT=self.media.name):
+            call_command('purge_history', keep=['completed=never', 'warning=never', 'error=never'], pause=0,
+                         stdout=StringIO())
+        self.assertFalse(packagerevision.objects.filter(id=old.id).exists())
+        self.assertTrue(packagerevision.objects.filter(id=recent.id).exists())
+        # Reused after a while: its date is updated, or it is created again if deleted meanwhile
+        packagerevision.objects.filter(id=recent.id).update(date=now - timedelta(days=3))
+        self.assertEqual(packagerevision.get_id({'name': 'recent'}), recent.id)
+        self.assertGreater(packagerevision.objects.get(id=recent.id).date, now)
+        packagerevision.objects.filter(id=recent.id).update(date=now - timedelta(days=3))
+        update = QuerySet.update
+
+        def purged_update(queryset, **kwargs):
+            packagerevision.objects.filter(id=recent.id).delete()
+            return update(queryset, **kwargs)
+
+        with mock.patch.object(QuerySet, 'update', purged_update):
+            revision_id = packagerevision.get_id({'name': 'recent'})
+        self.assertNotEqual(revision_id, recent.id)
+        self.assertTrue(packagerevision.objects.filter(id=revision_id, name='recent').exists())
+
+    def test_purge_resume_after_archive(self):
+        # Interrupted after the checkpoint of the first chunk, before its delete
+        delete = QuerySet.delete
+        calls = list()
+
+        def interrupted_delete(queryset):
+            calls.append(queryset)
+            if len(calls) == 1:
+                raise KeyboardInterrupt
+            return delete(queryset)
+
+        with self.settings(MEDIA_ROOT=self.media.name):
+            with mock.patch.object(QuerySet, 'delete', interrupted_delete), self.assertRaises(KeyboardInterrupt):
+                call_command('purge_history', chunk_size=2, pause=0, archive='jsonl', stdout=StringIO())
+            self.assertEqual(packagehistory.objects.count(), 5)
+            call_command('purge_history', pause=0, stdout=StringIO())
+        self.assertEqual(packagehistory.objects.count(), 1)
+        directory = os.path.join(self.media.name, 'history-archive')
+        archives = [name for name in os.listdir(directory) if name.endswith('.gz')]
+        with gzip.open(os.path.join(directory, archives[0]), 'rt') as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual([row['status'] for row in rows],
+                         ['Operation completed', 'Warning condition: x', 'Error: 1', 'Operation completed'])
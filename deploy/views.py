@@ -1 +1,184 @@
-# Create your views here.
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.conf import settings
+from django.core import signing
+from django.http import JsonResponse, HttpResponse, HttpResponseNotAllowed, HttpResponseForbidden, HttpResponseGone, \
+    FileResponse, StreamingHttpResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.utils.http import content_disposition_header, parse_etags
+from django.utils import timezone
+from deploy.models import package, packageupload, mirror_manifest, DOWNLOAD_SALT, DOWNLOAD_MAX_AGE, \
+    DOWNLOAD_HASH_LENGTH, MIRROR_MANIFEST_SALT, MIRROR_REQUEST_SALT
+from inventory.models import machine, entity
+from urllib.parse import quote
+import os
+
+
+def upload_status(upload):
+    return JsonResponse({'token': upload.token, 'filename': upload.filename, 'size': upload.size,
+                         'offset': upload.offset, 'completed': upload.completed})
+
+
+def upload_start(request):
+    '''Start a chunked upload of a package file (POST name and size)'''
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    if not (request.user.has_perm('deploy.add_package') or request.user.has_perm('deploy.change_package')):
+        return JsonResponse({'error': 'Permission denied'}, status=403)
+    name = request.POST.get('name', '')
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        size = -1
+    if not name or size < 0:
+        return JsonResponse({'error': 'Invalid name or size'}, status=400)
+    return upload_status(packageupload.start(request.user, name, size))
+
+
+def upload_chunk(request, token):
+    '''Status of an upload (GET) or chunk written at ?offset= (POST raw body).
+    A chunk at another offset than the current one is refused with 409 and the current offset'''
+    upload = get_object_or_404(packageupload, token=token, user=request.user)
+    if request.method == 'GET':
+        return upload_status(upload)
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['GET', 'POST'])
+    try:
+        offset = int(request.GET.get('offset', ''))
+        result = upload.write(offset, request)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    if result is None:
+        upload.refresh_from_db()
+        response = upload_status(upload)
+        response.status_code = 409
+        return response
+    return upload_status(result)
+
+
+def byte_range(header, size):
+    '''(first, last) bytes of a single range "bytes=first-last", "bytes=first-" or "bytes=-length",
+    None when the whole file is sent (malformed or multiple ranges) and False when not satisfiable'''
+    unit, sep, spec = header.partition('=')
+    first, dash, last = spec.strip().partition('-')
+    if unit.strip().lower() != 'bytes' or not sep or not dash or not (first.isdigit() or first == '') or \
+            not (last.isdigit() or last == '') or first == last == '':
+        return None
+    if first == '':
+        length = int(last)
+        if length == 0 or size == 0:
+            return False
+        return max(size - length, 0), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        return False
+    return first, min(int(last), size - 1) if last else size - 1
+
+
+def read_range(path, first, length, block_size=2**16):
+    with open(path, 'rb') as f:
+        f.seek(first)
+        while length > 0:
+            block = f.read(min(block_size, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+
+
+def package_download(request, token, name):
+    '''Download of a package file with a token signed in the deploy plan. The file is sent by nginx
+    (X-Accel-Redirect under PACKAGE_DOWNLOAD_ACCEL) or by this view, with Range/If-Range support
+    and the package SHA-512 as strong ETag'''
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    try:
+        pid, hash_prefix, mid = signing.loads(token, salt=DOWNLOAD_SALT, max_age=DOWNLOAD_MAX_AGE)
+    except (signing.BadSignature, ValueError, TypeError):
+        return HttpResponseForbidden()
+    if mid is not None and not machine.objects.filter(id=mid).exists():
+        return HttpResponseForbidden()
+    pack = package.objects.filter(id=pid).only('filename', 'packagehash').first()
+    if pack is None or pack.filename == '' or os.path.basename(pack.filename.name) != name:
+        raise Http404
+    if pack.packagehash[:DOWNLOAD_HASH_LENGTH] != hash_prefix:
+        return HttpResponseGone()  # file replaced since the deploy plan
+    etag = '"%s"' % pack.packagehash
+    if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+    if etag in if_none_match or '*' in if_none_match:
+        response = HttpResponse(status=304)
+        response['ETag'] = etag
+        return response
+
+    accel = getattr(settings, 'PACKAGE_DOWNLOAD_ACCEL', '')
+    if accel:
+        # nginx handles Range and If-Range with the ETag sent here
+        response = HttpResponse(content_type='application/octet-stream')
+        response['X-Accel-Redirect'] = accel.rstrip('/') + '/' + quote(pack.filename.name)
+    else:
+        path = pack.filename.path
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            raise Http404
+        span = None
+        if 'Range' in request.headers and request.headers.get('If-Range', etag) == etag:
+            span = byte_range(request.headers['Range'], size)
+        if span is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % size
+        elif span is None:
+            if request.method == 'GET':
+                response = FileResponse(open(path, 'rb'), content_type='application/octet-stream')
+            else:
+                response = HttpResponse(content_type='application/octet-stream')
+            response['Content-Length'] = size
+        else:
+            first, last = span
+            body = read_range(path, first, last - first + 1) if request.method == 'GET' else iter(())
+            response = StreamingHttpResponse(body, status=206, content_type='application/octet-stream')
+            response['Content-Range'] = 'bytes %d-%d/%d' % (first, last, size)
+            response['Content-Length'] = last - first + 1
+        response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Content-Disposition'] = content_disposition_header(True, name)
+    return response
+
+
+def mirror_manifest_view(request, entity_id):
+    '''Package files needed by an entity, for its redistribution mirror (sync_mirror command).
+    The request token (entity id) and the returned manifest are signed with MIRROR_KEY'''
+    key = getattr(settings, 'MIRROR_KEY', '')
+    if not key:
+        raise Http404
+    try:
+        if signing.loads(request.headers.get('X-Mirror-Token', ''), key=key, salt=MIRROR_REQUEST_SALT,
+                         max_age=300) != entity_id:
+            return HttpResponseForbidden()
+    except signing.BadSignature:
+        return HttpResponseForbidden()
+    ent = get_object_or_404(entity, id=entity_id)
+    manifest = {'entity': ent.id, 'date': timezone.now().isoformat(), 'files': mirror_manifest(ent)}
+    return HttpResponse(signing.dumps(manifest, key=key, salt=MIRROR_MANIFEST_SALT, compress=True),
+                        content_type='text/plain')
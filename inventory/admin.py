@@ -28,7 +28,7 @@ from inventory.filters import (
     entityFilter, domainFilter, usernameFilter, languageFilter, typemachineFilter,
     osdistributionFilter, timeprofileFilter, packageprofileFilter, hostFilter, commentFilter,
     osnameFilter, osversionFilter, osarchFilter)
-from deploy.models import package, packageprofile, timeprofile
+from deploy.models import package, packageprofile, timeprofile, invalidate_deployplans
 
 
 class ueAdmin(admin.ModelAdmin):
@@ -41,6 +41,23 @@ class ueAdmin(admin.ModelAdmin):
         return 'inventory'
 
 
+class hostAdmin(ueAdmin):
+    '''Inventory data of a host: its stored deploy plan is deleted when they are edited
+    (the inventory checksums are unchanged)'''
+    def save_model(self, request, obj, form, change):
+        super(hostAdmin, self).save_model(request, obj, form, change)
+        invalidate_deployplans({obj.host_id, form.initial.get('host')} - {None})
+
+    def delete_model(self, request, obj):
+        super(hostAdmin, self).delete_model(request, obj)
+        invalidate_deployplans([obj.host_id])
+
+    def delete_queryset(self, request, queryset):
+        host_ids = set(queryset.values_list('host_id', flat=True))
+        super(hostAdmin, self).delete_queryset(request, queryset)
+        invalidate_deployplans(host_ids)
+
+
 class netInline(admin.TabularInline):
     model = net
     max_num = 5000
@@ -158,6 +175,12 @@ class machineAdmin(ueAdmin):
     operatingsystem.admin_order_field = 'osdistribution__name'
     operatingsystem.short_description = _('operating_system')
 
+    def save_related(self, request, form, formsets, change):
+        super(machineAdmin, self).save_related(request, form, formsets, change)
+        # Systems, networks or softwares edited in the inlines
+        if any(formset.has_changed() for formset in formsets):
+            invalidate_deployplans([form.instance.id])
+
     def get_queryset(self, request):
         # Re-create queryset with entity list returned by list_entities_allowed
         if request.user.is_superuser:
@@ -201,7 +224,7 @@ class machineAdmin(ueAdmin):
         return form
 
 
-class netAdmin(ueAdmin):
+class netAdmin(hostAdmin):
     list_display = ('ip', 'mask', 'mac', 'host')
     search_fields = ('ip', 'mask', 'mac', 'host__name')
     list_filter = (hostFilter,)
@@ -224,7 +247,7 @@ class netAdmin(ueAdmin):
         return form
 
 
-class osAdmin(ueAdmin):
+class osAdmin(hostAdmin):
     list_display = ('name', 'version', 'arch', 'systemdrive', 'host')
     search_fields = ('name', 'version', 'arch', 'systemdrive', 'host__name')
     list_filter = (osnameFilter, osversionFilter, osarchFilter, hostFilter)
@@ -247,7 +270,7 @@ class osAdmin(ueAdmin):
         return form
 
 
-class softwareAdmin(ueAdmin):
+class softwareAdmin(hostAdmin):
     list_display = ('name', 'version', 'host')
     search_fields = ('name', 'version', 'host__name')
     list_filter = (hostFilter,)
@@ -0,0 +1,305 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.utils.functional import cached_property
+from inventory.models import software, osdistribution, net
+from deploy.models import packagecounter
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from netaddr import IPNetwork, IPAddress
+import re
+
+
+def compare_versions(version1, version2):
+    ''' Compare two version string '''
+    from packaging import version
+    if version1 is None:
+        version1 = ''
+    if version2 is None:
+        version2 = ''
+    if version1 == version2:
+        return 0
+    try:
+        return -1 if version.parse(version1) < version.parse(version2) else 1
+    except:
+        ver = [version1, version2]
+        ver.sort()
+        return -1 if ver[0] == version1 else 1
+
+
+class MachineFacts(object):
+    '''Inventory data of a machine used by the conditions. Each kind of data is loaded
+    at most once and shared by the conditions of all the packages of a request'''
+    def __init__(self, m):
+        self.machine = m
+
+    @cached_property
+    def softwares(self):
+        return list(software.objects.filter(host_id=self.machine.id).values_list('name', 'version'))
+
+    @cached_property
+    def systems(self):
+        return list(osdistribution.objects.filter(host_id=self.machine.id).values_list('name', 'version', 'arch'))
+
+    @cached_property
+    def ips(self):
+        return list(net.objects.filter(host_id=self.machine.id).values_list('ip', flat=True))
+
+    @cached_property
+    def addresses(self):
+        '''IPAddress of each ip (None if the ip is invalid)'''
+        return [parse_or_none(IPAddress, ip) for ip in self.ips]
+
+    @cached_property
+    def typemachine(self):
+        return str(self.machine.typemachine)
+
+    @cached_property
+    def counters(self):
+        '''packagecounter of each package (history conditions)'''
+        return {c.package_id: c for c in packagecounter.objects.filter(machine_id=self.machine.id)}
+
+
+def parse_or_none(parser, value):
+    try:
+        return parser(value)
+    except Exception:
+        return None
+
+
+def wildcard_regex(value, anchored=True):
+    '''Case insensitive regex of a condition value where '*' matches anything'''
+    nameregex = re.escape(value).replace('\\*', '.*')
+    if anchored:
+        nameregex = '^' + nameregex + '$'
+    return re.compile(nameregex, re.IGNORECASE)
+
+
+def software_installed(nameregex, version):
+    '''Check if a software with this name and exactly this version is installed'''
+    def predicate(facts, pack):
+        return any(nameregex.search(name) and v == version for name, v in facts.softwares)
+    return predicate
+
+
+def windows_arch(*archs):
+    '''Check if a Windows system with one of these architectures is installed'''
+    def predicate(facts, pack):
+        return any('windows' in name.lower() and arch is not None and a in arch
+                   for name, version, arch in facts.systems for a in archs)
+    return predicate
+
+
+def system_installed(nameregex, version):
+    '''Check if a system matching the name (and containing the version if defined) is installed'''
+    version = version.lower() if version != 'undefined' else None
+    def predicate(facts, pack):
+        return any(nameregex.search(name) and (version is None or (v is not None and version in v.lower()))
+                   for name, v, arch in facts.systems)
+    return predicate
+
+
+def negate(check):
+    return lambda facts, pack: not check(facts, pack)
+
+
+def software_lower(nameregex, version):
+    def predicate(facts, pack):
+        versions = [v for name, v in facts.softwares if nameregex.search(name)]
+        if versions:
+            # Empty softwareversion is useful to ignore the version and only check not installed
+            if version is None:
+                return False
+            # Check if at least one of the versions is greater than condition
+            for v in versions:
+                if compare_versions(v, version) >= 0:
+                    return False
+        return True
+    return predicate
+
+
+def software_higher(nameregex, version):
+    def predicate(facts, pack):
+        versions = [v for name, v in facts.softwares if nameregex.search(name)]
+        if not versions:
+            return False
+        install = True
+        # Empty softwareversion is useful to ignore the version and only check installed
+        if version is not None:
+            # Check if all of the versions are lower than condition
+            for v in versions:
+                if compare_versions(v, version) <= 0:
+                    install = False
+                else:
+                    install = True
+                    break
+        return install
+    return predicate
+
+
+def value_in_list(values, attribute, included):
+    '''Check machine attribute against a comma separated list (wildcards can be used).
+    With included the value must be in the list else it must not be in the list'''
+    try:
+        patterns = [wildcard_regex(value) for value in values.split(',') if value]
+    except:
+        return lambda facts, pack: False
+
+    def predicate(facts, pack):
+        install = True
+        try:
+            for pattern in patterns:
+                if pattern.match(attribute(facts)):
+                    return included
+                elif included:
+                    install = False
+        except:
+            return False
+        return install
+    return predicate
+
+
+def ip_in_list(values, included):
+    '''Check machine ip addresses against a comma separated list of IP or network addresses'''
+    try:
+        networks = [parse_or_none(IPNetwork, network) for network in values.split(',') if network]
+    except:
+        # The list is only read when the machine has ip addresses
+        return lambda facts, pack: not facts.ips
+
+    def predicate(facts, pack):
+        install = True
+        for address in facts.addresses:
+            for network in networks:
+                if address is None or network is None:
+                    return False
+                if address in network:
+                    install = included
+                    break
+                elif included:
+                    install = False
+            if install is included:
+                break
+        return install
+    return predicate
+
+
+def history_times(period, times, kind):
+    '''Installation executed or completed (kind) a maximum of X times per day/week/month (calendar period, not duration)'''
+    periods = {'day': 'day', 'jour': 'day', 'week': 'week', 'semaine': 'week', 'month': 'month', 'mois': 'month'}
+    def predicate(facts, pack):
+        try:
+            max_times_per_period = int(times)
+            if period not in periods:
+                return False
+            counter = facts.counters.get(pack.id)
+            return (counter.count(kind, periods[period]) if counter is not None else 0) < max_times_per_period
+        except:
+            return False
+    return predicate
+
+
+def history_delay(unit, interval, last):
+    '''Installation executed or completed (date of the last one in the last field of packagecounter)
+    a minimum interval of X minutes/hours/days (duration)'''
+    def predicate(facts, pack):
+        try:
+            today = datetime.now(timezone.utc)
+            interval_value = int(interval)
+            if unit in ['minutes']:
+                date_max = today - timedelta(minutes=interval_value)
+            elif unit in ['hours', 'heures']:
+                date_max = today - timedelta(hours=interval_value)
+            elif unit in ['days', 'jours']:
+                date_max = today - timedelta(days=interval_value)
+            else:
+                return False
+            counter = facts.counters.get(pack.id)
+            return counter is None or getattr(counter, last) is None or getattr(counter, last) <= date_max
+        except:
+            return False
+    return predicate
+
+
+# Conditions evaluated on the server from the inventory (basic) and by the client (extended)
+BASIC_CONDITIONS = ('notinstalled', 'installed', 'is_W64_bits', 'is_W32_bits', 'system_is', 'system_not',
+                    'language_is', 'lower', 'higher', 'hostname_in', 'hostname_not', 'username_in', 'username_not',
+                    'ipaddr_in', 'ipaddr_not', 'vendor_in', 'vendor_not', 'product_in', 'product_not', 'type_in',
+                    'type_not', 'executetimes', 'installtimes', 'executedelay', 'installdelay')
+EXTENDED_CONDITIONS = ('isfile', 'notisfile', 'isdir', 'notisdir', 'isfiledir', 'notisfiledir', 'hashis', 'hashnot',
+                       'exitcodeis', 'exitcodenot')
+# Conditions depending on the deployment history and on the current time (never stored in deploy plans)
+HISTORY_CONDITIONS = ('executetimes', 'installtimes', 'executedelay', 'installdelay')
+
+
+@lru_cache(maxsize=4096)
+def compile_condition(condition_id, depends, softwarename, softwareversion):
+    '''Return the predicate of a basic condition: a function of (facts, pack) returning
+    True if the condition allows the installation. Predicates are cached by condition id
+    and content (values are the rendered ones when custom variables are used)'''
+    # Software not installed / installed (wildcards can be used for condition name)
+    if depends == 'notinstalled':
+        return negate(software_installed(wildcard_regex(softwarename), softwareversion))
+    elif depends == 'installed':
+        return software_installed(wildcard_regex(softwarename), softwareversion)
+    # OS architecture is Windows 64bits / 32bits
+    elif depends == 'is_W64_bits':
+        return windows_arch('64')
+    elif depends == 'is_W32_bits':
+        return windows_arch('32', 'undefined')
+    # System name is / is not (wildcards can be used)
+    elif depends == 'system_is':
+        return system_installed(wildcard_regex(softwarename, anchored=False), softwareversion)
+    elif depends == 'system_not':
+        return negate(system_installed(wildcard_regex(softwarename, anchored=False), softwareversion))
+    # Default system language is (ex: fr_FR)
+    elif depends == 'language_is':
+        return lambda facts, pack: facts.machine.language.upper() == softwarename.upper()
+    # Software not installed or version lower than / installed and version higher than
+    elif depends == 'lower':
+        return software_lower(wildcard_regex(softwarename), softwareversion)
+    elif depends == 'higher':
+        return software_higher(wildcard_regex(softwarename), softwareversion)
+    # Hostname, username, vendor, product, machine type is / is NOT in the list
+    elif depends in ('hostname_in', 'hostname_not'):
+        return value_in_list(softwarename, lambda facts: facts.machine.name, depends == 'hostname_in')
+    elif depends in ('username_in', 'username_not'):
+        return value_in_list(softwarename, lambda facts: facts.machine.username, depends == 'username_in')
+    elif depends in ('vendor_in', 'vendor_not'):
+        return value_in_list(softwarename, lambda facts: facts.machine.vendor, depends == 'vendor_in')
+    elif depends in ('product_in', 'product_not'):
+        return value_in_list(softwarename, lambda facts: facts.machine.product, depends == 'product_in')
+    elif depends in ('type_in', 'type_not'):
+        return value_in_list(softwarename, lambda facts: facts.typemachine, depends == 'type_in')
+    # IP address is / is NOT in the list
+    elif depends in ('ipaddr_in', 'ipaddr_not'):
+        return ip_in_list(softwarename, depends == 'ipaddr_in')
+    # For 'executetimes' we consider both 'Ready to download and execute' and
+    # 'Install in progress' as executions (tests create 'Install in progress').
+    elif depends == 'executetimes':
+        return history_times(softwarename, softwareversion, 'execute')
+    elif depends == 'installtimes':
+        return history_times(softwarename, softwareversion, 'install')
+    elif depends == 'executedelay':
+        return history_delay(softwarename, softwareversion, 'last_ready')
+    elif depends == 'installdelay':
+        return history_delay(softwarename, softwareversion, 'last_install')
+    return lambda facts, pack: True
@@ -0,0 +1,100 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from bisect import bisect_right
+from heapq import heappush, heappop
+from netaddr import IPNetwork, IPAddress
+
+
+class IPRangeIndex(object):
+    '''Compiled entities IP ranges. For each IP version the ranges are flattened into sorted
+    disjoint [start, end] segments of integer addresses so that a lookup is a binary search.
+    When ranges overlap, the first entity (then the first range of its ip_range) wins'''
+    def __init__(self, entities):
+        '''entities is an iterable of (id, name, ip_range) in priority order'''
+        self.names = dict()
+        self.errors = list()
+        self.starts = dict()
+        self.ends = dict()
+        self.entities = dict()
+        ranges = {4: list(), 6: list()}
+        priority = 0
+        for entity_id, name, ip_range in entities:
+            self.names[entity_id] = name
+            # comma separated IP/CIDR networks (could be simple a IP Address)
+            for network_range in ip_range.split(','):
+                if not network_range:
+                    continue
+                try:
+                    network = IPNetwork(network_range)
+                except Exception:
+                    self.errors.append((name, network_range))
+                    continue
+                ranges[network.version].append((network.first, network.last, priority, entity_id))
+                priority += 1
+        for version, items in ranges.items():
+            self.compile(version, items)
+
+    def compile(self, version, items):
+        starts = self.starts[version] = list()
+        ends = self.ends[version] = list()
+        entities = self.entities[version] = list()
+        bounds = sorted(set(b for first, last, priority, entity_id in items for b in (first, last + 1)))
+        items.sort()
+        active = list()
+        i = 0
+        for low, high in zip(bounds, bounds[1:]):
+            while i < len(items) and items[i][0] <= low:
+                heappush(active, (items[i][2], items[i][1], items[i][3]))
+                i += 1
+            # Ranges ending before this segment are dropped when they reach the top of the heap
+            while active and active[0][1] < low:
+                heappop(active)
+            if not active:
+                continue
+            entity_id = active[0][2]
+            if entities and entities[-1] == entity_id and ends[-1] == low - 1:
+                ends[-1] = high - 1
+            else:
+                starts.append(low)
+                ends.append(high - 1)
+                entities.append(entity_id)
+
+    def lookup(self, ip):
+        '''Return the id of the entity matching the ip address or None'''
+        try:
+            address = IPAddress(ip)
+        except Exception:
+            return None
+        value = int(address)
+        starts = self.starts.get(address.version, [])
+        i = bisect_right(starts, value) - 1
+        if i >= 0 and value <= self.ends[address.version][i]:
+            return self.entities[address.version][i]
+        return None
+
+    def find(self, ips):
+        '''Return the id of the entity matching the first matching ip address or None'''
+        for ip in ips:
+            entity_id = self.lookup(ip)
+            if entity_id is not None:
+                return entity_id
+        return None
@@ -0,0 +1,62 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.core.management.base import BaseCommand
+from inventory.models import machine, net, entity, entity_ranges
+from itertools import groupby
+
+
+class Command(BaseCommand):
+    help = 'Re-evaluate the entity of all the machines from the entities IP ranges'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--apply', action='store_true', help='Update the machines (default: only list changes)')
+        parser.add_argument('--all', action='store_true',
+                            help='Include machines without entity (by default only machines with an entity are '
+                                 'updated, as on inventory)')
+
+    def handle(self, *args, **options):
+        ranges = entity_ranges.get()
+        for entity_name, network_range in ranges.errors:
+            self.stderr.write("Error: Invalid network in ip range for entity '%s' : '%s'" % (entity_name,
+                                                                                           network_range))
+        hosts = machine.objects.all()
+        if not options['all']:
+            hosts = hosts.filter(entity__isnull=False)
+        current = dict(hosts.values_list('id', 'entity_id'))
+        names = dict(hosts.values_list('id', 'name'))
+        entity_names = dict(entity.objects.values_list('id', 'name'))
+        ips = net.objects.filter(host_id__in=hosts.values('id')).order_by('host_id', 'id').values_list('host_id', 'ip')
+
+        changes = dict()
+        for host_id, host_ips in groupby(ips, key=lambda row: row[0]):
+            entity_id = ranges.find(ip for host_id, ip in host_ips)
+            if entity_id is not None and entity_id != current[host_id]:
+                changes.setdefault(entity_id, list()).append(host_id)
+                self.stdout.write("Entity updated for %s from '%s' to '%s'" % (
+                    names[host_id], entity_names.get(current[host_id]), entity_names[entity_id]))
+
+        if options['apply']:
+            for entity_id, host_ids in changes.items():
+                for i in range(0, len(host_ids), 500):
+                    machine.objects.filter(id__in=host_ids[i:i + 500]).update(entity_id=entity_id)
+        self.stdout.write('%d machines %s' % (sum(len(h) for h in changes.values()),
+                                              'updated' if options['apply'] else 'to update'))
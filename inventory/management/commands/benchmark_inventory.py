@@ -0,0 +1,81 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from inventory.models import machine, inventoryqueue
+from inventory.views import inventory, queue_inventory
+import time
+
+
+class Command(BaseCommand):
+    help = 'Measure inventories/sec of the synchronous and the queued inventory modes with generated inventories'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=200, help='Number of generated inventories')
+        parser.add_argument('--softwares', type=int, default=100, help='Number of softwares per inventory')
+        parser.add_argument('--workers', type=int, default=4, help='Number of queue workers')
+        parser.add_argument('--batch-size', type=int, default=10, help='Queue workers batch size')
+        parser.add_argument('--prefix', default='benchmark-', help='Hostname prefix of the generated machines')
+
+    def build_xml(self, index, options):
+        softwares = ''.join('<Software><Name>software %d</Name><Version>%d.0</Version>'
+                            '<Uninstall>uninstall %d</Uninstall></Software>' % (i, index % 3, i)
+                            for i in range(options['softwares']))
+        return ('<Packages><SerialNumber>BENCH%05d</SerialNumber><Hostname>%s%05d</Hostname>'
+                '<Manufacturer>Bench</Manufacturer><Product>Bench</Product><Chassistype>Desktop</Chassistype>'
+                '<Softsum>soft%d</Softsum><Ossum>os%d</Ossum><Netsum>net%d</Netsum>'
+                '<Osdistribution><Name>Windows</Name><Version>10</Version><Arch>64bits</Arch>'
+                '<Systemdrive>C:</Systemdrive></Osdistribution>%s'
+                '<Network><Ip>10.%d.%d.%d</Ip><Mask>255.0.0.0</Mask><Mac>00:00:00:00:00:01</Mac></Network>'
+                '</Packages>' % (index, options['prefix'], index, index, index, index, softwares,
+                                 index // 65536 % 256, index // 256 % 256, index % 256))
+
+    def clean(self, options):
+        machine.objects.filter(name__startswith=options['prefix']).delete()
+
+    def rate(self, label, count, elapsed):
+        self.stdout.write('%-28s %8.1f inventories/sec (%d in %.2fs)' % (label, count / elapsed, count, elapsed))
+
+    def handle(self, *args, **options):
+        xmls = [self.build_xml(i, options) for i in range(options['count'])]
+        self.clean(options)
+
+        start = time.monotonic()
+        for xml in xmls:
+            inventory(xml)
+        self.rate('Synchronous import:', len(xmls), time.monotonic() - start)
+        self.clean(options)
+
+        first_id = inventoryqueue.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        start = time.monotonic()
+        for xml in xmls:
+            queue_inventory(xml, wait=0)
+        enqueued = time.monotonic() - start
+        self.rate('Queued mode, request side:', len(xmls), enqueued)
+        start = time.monotonic()
+        call_command('process_inventory_queue', workers=options['workers'], batch_size=options['batch_size'],
+                     once=True, stdout=self.stdout)
+        drained = time.monotonic() - start
+        self.rate('Queued mode, workers:', len(xmls), drained)
+        self.rate('Queued mode, end to end:', len(xmls), enqueued + drained)
+        inventoryqueue.objects.filter(id__gt=first_id, status='done').delete()
+        self.clean(options)
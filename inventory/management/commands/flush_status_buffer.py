@@ -0,0 +1,50 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.core.management.base import BaseCommand, CommandError
+from inventory.views import status_buffer
+import time
+
+
+class Command(BaseCommand):
+    help = 'Write the package statuses of the Redis status buffer (STATUS_BUFFER=redis) to the package history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=None,
+                            help='Milliseconds between two flushes (default: STATUS_BUFFER_INTERVAL)')
+        parser.add_argument('--once', action='store_true', help='Exit when the buffer is empty')
+
+    def handle(self, *args, **options):
+        if status_buffer.backend != 'redis':
+            raise CommandError("STATUS_BUFFER is not set to 'redis'")
+        interval = options['interval'] if options['interval'] is not None else status_buffer.interval * 1000
+        written = 0
+        try:
+            while True:
+                count = status_buffer.flush()
+                written += count
+                if options['once']:
+                    break
+                if not count:
+                    time.sleep(interval / 1000.0)
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write('%d statuses written' % written)
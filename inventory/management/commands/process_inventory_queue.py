@@ -0,0 +1,88 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from inventory.models import inventoryqueue
+from inventory.views import claim_queued_inventories, process_queued_inventories
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+import threading
+
+
+class Command(BaseCommand):
+    help = 'Import the inventories stored in the inventory queue (INVENTORY_QUEUE mode) with a pool of workers'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Number of worker threads')
+        parser.add_argument('--batch-size', type=int, default=10,
+                            help='Number of inventories claimed at once by a worker')
+        parser.add_argument('--idle', type=float, default=1.0, help='Seconds to wait when the queue is empty')
+        parser.add_argument('--keep', type=int, default=3600,
+                            help='Seconds to keep processed inventories not fetched by a client')
+        parser.add_argument('--requeue-after', type=int, default=600,
+                            help='Seconds after which an inventory still in processing is queued again')
+        parser.add_argument('--once', action='store_true', help='Exit when the queue is empty')
+
+    def handle(self, *args, **options):
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.purge(options)
+        if options['workers'] <= 1:
+            self.work(options)
+        else:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                futures = [executor.submit(self.work, options) for i in range(options['workers'])]
+                try:
+                    while wait(futures, timeout=60).not_done:
+                        self.purge(options)
+                except KeyboardInterrupt:
+                    self.stopping.set()
+                for future in futures:
+                    future.result()
+        self.purge(options)
+        self.stdout.write('%d inventories imported' % self.processed)
+
+    def work(self, options):
+        try:
+            while not self.stopping.is_set():
+                ids = claim_queued_inventories(options['batch_size'])
+                if ids:
+                    count = process_queued_inventories(ids)
+                    with self.lock:
+                        self.processed += count
+                elif options['once']:
+                    break
+                else:
+                    self.stopping.wait(options['idle'])
+        finally:
+            if threading.current_thread() is not threading.main_thread():
+                connection.close()
+
+    def purge(self, options):
+        now = datetime.now(timezone.utc)
+        # Inventories claimed by a worker which died are queued again
+        inventoryqueue.objects.filter(status='processing',
+                                      claimed__lt=now - timedelta(seconds=options['requeue_after'])).update(
+            status='pending', claimed=None)
+        inventoryqueue.objects.filter(status__in=('done', 'error'),
+                                      claimed__lt=now - timedelta(seconds=options['keep'])).delete()
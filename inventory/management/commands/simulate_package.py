@@ -0,0 +1,65 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.core.management.base import BaseCommand, CommandError
+from inventory.models import machine
+from inventory.simulate import simulate_package
+from deploy.models import package
+import time
+
+
+class Command(BaseCommand):
+    help = 'Count per entity the machines which would install deployment packages, and why the others would not'
+
+    def add_arguments(self, parser):
+        parser.add_argument('packages', nargs='+', help='Package ids or names')
+        parser.add_argument('--profile', help='Only machines of this package profile (id or name)')
+        parser.add_argument('--entity', help='Only machines of this entity (id or name)')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Machines loaded at once')
+
+    def handle(self, *args, **options):
+        machines = machine.objects.all()
+        for option, field in (('profile', 'packageprofile'), ('entity', 'entity')):
+            value = options[option]
+            if value:
+                if value.isdigit():
+                    machines = machines.filter(**{field + '_id': int(value)})
+                else:
+                    machines = machines.filter(**{field + '__name': value})
+
+        for value in options['packages']:
+            packs = package.objects.filter(id=int(value)) if value.isdigit() else package.objects.filter(name=value)
+            if not packs:
+                raise CommandError("Package '%s' does not exist" % value)
+            for pack in packs:
+                start = time.monotonic()
+                results = simulate_package(pack, machines, chunk_size=options['chunk_size'])
+                self.stdout.write('Package %s (%d):' % (pack.name, pack.id))
+                for entity_name in sorted(results):
+                    counts = results[entity_name]
+                    self.stdout.write('  %s: %d install, %d depend on extended conditions, %d skip' % (
+                        entity_name or '(no entity)', counts['install'], counts['extended'],
+                        sum(counts['skip'].values())))
+                    for condition_name, count in counts['skip'].most_common():
+                        self.stdout.write('    %d skip on condition %s' % (count, condition_name))
+                self.stdout.write('  %d machines evaluated in %.2fs' % (
+                    sum(c['install'] + c['extended'] + sum(c['skip'].values()) for c in results.values()),
+                    time.monotonic() - start))
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.3 on 2026-10-17 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0004_add_wol_proxy'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='inventoryqueue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('xml', models.BinaryField(verbose_name='inventoryqueue|xml')),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('processing', 'processing'), ('done', 'done')], default='pending', max_length=10, verbose_name='inventoryqueue|status')),
+                ('response', models.TextField(blank=True, null=True, verbose_name='inventoryqueue|response')),
+                ('date', models.DateTimeField(auto_now_add=True, verbose_name='inventoryqueue|date')),
+                ('claimed', models.DateTimeField(blank=True, null=True, verbose_name='inventoryqueue|claimed')),
+            ],
+            options={
+                'verbose_name': 'inventoryqueue|inventory queue',
+                'verbose_name_plural': 'inventoryqueue|inventory queues',
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['status', 'id'], name='inventory_queue_status_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0005_inventoryqueue'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='machine',
+            name='name',
+            field=models.CharField(db_index=True, max_length=100, verbose_name='machine|name'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.3 on 2026-10-17 16:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0006_alter_machine_name'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='inventoryqueue',
+            name='status',
+            field=models.CharField(choices=[('pending', 'pending'), ('processing', 'processing'), ('done', 'done'), ('error', 'error')], default='pending', max_length=10, verbose_name='inventoryqueue|status'),
+        ),
+    ]
@@ -22,7 +22,9 @@
 from django.utils.translation import gettext_lazy as _
 from django.db import models
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
+from inventory.ipranges import IPRangeIndex
+from updatengine.cache import ProcessCache
 
 
 class entity(models.Model):
@@ -119,7 +121,7 @@ class machine(models.Model):
         ('no', _('no'))
     )
     serial = models.CharField(max_length=100, verbose_name=_('machine|serial'))
-    name = models.CharField(max_length=100, verbose_name=_('machine|name'))
+    name = models.CharField(max_length=100, db_index=True, verbose_name=_('machine|name'))
     vendor = models.CharField(max_length=100, null=True, blank=True, default='undefined', verbose_name=_('machine|vendor'))
     product = models.CharField(max_length=100, null=True, blank=True, default='undefined', verbose_name=_('machine|product'))
     domain = models.CharField(max_length=100, null=True, blank=True, default='undefined', verbose_name=_('machine|domain'))
@@ -249,6 +251,29 @@ class software(models.Model):
         verbose_name_plural = _('software|softwares')
 
 
+class inventoryqueue(models.Model):
+    choice = (
+        ('pending', _('pending')),
+        ('processing', _('processing')),
+        ('done', _('done')),
+        ('error', _('error'))
+    )
+    xml = models.BinaryField(verbose_name=_('inventoryqueue|xml'))
+    status = models.CharField(max_length=10, choices=choice, default='pending', verbose_name=_('inventoryqueue|status'))
+    response = models.TextField(null=True, blank=True, verbose_name=_('inventoryqueue|response'))
+    date = models.DateTimeField(auto_now_add=True, verbose_name=_('inventoryqueue|date'))
+    claimed = models.DateTimeField(null=True, blank=True, verbose_name=_('inventoryqueue|claimed'))
+
+    def __str__(self):
+        return '%s - %s' % (self.id, self.status)
+
+    class Meta:
+        verbose_name = _('inventoryqueue|inventory queue')
+        verbose_name_plural = _('inventoryqueue|inventory queues')
+        ordering = ['id']
+        indexes = [models.Index(fields=['status', 'id'], name='inventory_queue_status_idx')]
+
+
 # Add a post_save function to update packagesum after each save on
 # a package object
 @receiver(post_save, sender=entity)
@@ -277,3 +302,18 @@ def postsave_entity(sender, instance, created, **kwargs):
     instance.old_timeprofile = instance.timeprofile
     instance.save()
     post_save.connect(receiver=postsave_entity, sender=entity)
+
+
+def build_entity_ranges():
+    return IPRangeIndex(entity.objects.exclude(ip_range__isnull=True).exclude(ip_range__exact='').order_by(
+        'name').values_list('id', 'name', 'ip_range'))
+
+
+# Compiled IP ranges of the entities used to set automatically the entity of machines
+entity_ranges = ProcessCache('entity_ranges', build_entity_ranges)
+
+
+@receiver(post_save, sender=entity)
+@receiver(post_delete, sender=entity)
+def invalidate_entity_ranges(sender, instance, **kwargs):
+    entity_ranges.invalidate()
@@ -0,0 +1,81 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.db.models import Prefetch
+from deploy.models import package, packagecustomvar, deployplan
+from inventory.conditions import MachineFacts
+import hashlib
+
+
+def plan_key(m):
+    '''Key of the stored deploy plan of a machine: inventory checksums, package profile
+    and machine attributes used by the conditions and the global variables'''
+    values = (m.softsum, m.ossum, m.netsum, m.packageprofile_id, m.typemachine_id, m.name, m.username,
+              m.domain, m.language, m.vendor, m.product)
+    return hashlib.sha1('\x1f'.join(str(v) for v in values).encode('utf-8')).hexdigest()
+
+
+class DeployPlanContext(object):
+    '''Packages to deploy on a machine (programmed on the machine or included in its package profile)
+    loaded with their custom variables, conditions and time profiles in a fixed number of queries.
+    The machine facts used by the conditions are shared by all the packages.
+    The candidate packages and the results of the facts-only conditions are read from the stored
+    deploy plan of the machine when its key is unchanged, otherwise they are computed and stored'''
+    def __init__(self, m):
+        self.machine = m
+        self.facts = MachineFacts(m)
+        self.key = plan_key(m)
+        stored = deployplan.objects.filter(machine_id=m.id).values_list('key', 'packages', 'conditions').first()
+        if stored is not None and stored[0] == self.key:
+            package_ids = stored[1]
+            self.results = dict(stored[2])
+            self.stored_results = stored[2]
+        else:
+            package_ids = set(m.packages.values_list('id', flat=True))
+            if m.packageprofile_id is not None:
+                package_ids.update(package.objects.filter(effective_packageprofiles=m.packageprofile_id).values_list(
+                    'id', flat=True))
+            self.results = dict()
+            self.stored_results = dict()
+            # Stored before checking the conditions: a status removing a package from the machine
+            # during this request deletes the plan again
+            deployplan.objects.update_or_create(machine_id=m.id, defaults={
+                'key': self.key, 'packages': sorted(package_ids), 'conditions': self.results})
+        if package_ids:
+            self.packages = list(package.objects.filter(id__in=package_ids).order_by('name', 'id').prefetch_related(
+                Prefetch('packagecustomvar_set', queryset=packagecustomvar.objects.all()),
+                'conditions',
+                'timeprofiles'))
+        else:
+            self.packages = list()
+
+    def __iter__(self):
+        return iter(self.packages)
+
+    def __len__(self):
+        return len(self.packages)
+
+    def save(self):
+        '''Store the results of the facts-only conditions evaluated during the request
+        (unless the plan has been invalidated in the meantime)'''
+        if self.results != self.stored_results:
+            deployplan.objects.filter(machine_id=self.machine.id, key=self.key).update(conditions=self.results)
+            self.stored_results = dict(self.results)
@@ -0,0 +1,128 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from collections import Counter
+from django.db.models import Q, Prefetch
+from inventory.models import machine, software, osdistribution, net
+from inventory.conditions import MachineFacts, compile_condition, BASIC_CONDITIONS, EXTENDED_CONDITIONS, \
+    HISTORY_CONDITIONS
+from inventory.views import custom_variables, render_condition
+from deploy.models import package, packagecustomvar
+
+SOFTWARE_CONDITIONS = ('installed', 'notinstalled', 'lower', 'higher')
+
+
+def software_filter(pattern):
+    '''Filter on software names matching a condition value where '*' matches anything.
+    The filter may match more names than the condition (the predicates check them afterwards)'''
+    if not pattern:
+        # Condition without software name: no prefilter
+        return Q(pk__isnull=False)
+    parts = pattern.split('*')
+    if len(parts) == 1:
+        return Q(name__iexact=pattern)
+    query = Q()
+    if parts[0]:
+        query &= Q(name__istartswith=parts[0])
+    if parts[-1]:
+        query &= Q(name__iendswith=parts[-1])
+    for part in parts[1:-1]:
+        if part:
+            query &= Q(name__icontains=part)
+    return query
+
+
+def group_by_host(rows):
+    '''Group (host_id, values...) rows by host_id'''
+    grouped = dict()
+    for row in rows:
+        grouped.setdefault(row[0], list()).append(row[1:] if len(row) > 2 else row[1])
+    return grouped
+
+
+def simulate_package(pack, machines=None, chunk_size=1000):
+    '''Evaluate the basic conditions of pack on machines (all machines by default) without
+    calling check_conditions per machine: facts are loaded by chunks of machines (one query
+    per kind of data and per chunk, softwares restricted to the names used by the conditions).
+    History conditions depend on the time of the check-in and are not evaluated.
+    Return per entity counts: {entity name: {'install': n, 'extended': n, 'skip': Counter(condition name)}}
+    where 'extended' machines install the package only if the client validates its extended conditions.
+    Machines whose facts cannot be evaluated (e.g. no language) are counted as skipped on error: <condition name>'''
+    pack = package.objects.prefetch_related(
+        Prefetch('packagecustomvar_set', queryset=packagecustomvar.objects.all()), 'conditions').get(id=pack.id)
+    conditions = [c for c in pack.conditions.all() if c.depends in BASIC_CONDITIONS and
+                  c.depends not in HISTORY_CONDITIONS]
+    extended = any(c.depends in EXTENDED_CONDITIONS for c in pack.conditions.all())
+    software_conditions = [c for c in conditions if c.depends in SOFTWARE_CONDITIONS]
+
+    # Without global variables, rendered conditions are the same for all the machines
+    names = None
+    if pack.use_global_variables != 'yes':
+        cv = custom_variables(None, pack)
+        conditions = [render_condition(c, cv) for c in conditions]
+        software_conditions = [render_condition(c, cv) for c in software_conditions]
+        names = Q()
+        for condition in software_conditions:
+            names |= software_filter(condition.softwarename)
+
+    if machines is None:
+        machines = machine.objects.all()
+    host_ids = list(machines.order_by('id').values_list('id', flat=True))
+    results = dict()
+    for i in range(0, len(host_ids), chunk_size):
+        chunk = host_ids[i:i + chunk_size]
+        softwares = dict()
+        if software_conditions:
+            rows = software.objects.filter(host_id__in=chunk)
+            if names is not None:
+                rows = rows.filter(names)
+            softwares = group_by_host(rows.values_list('host_id', 'name', 'version'))
+        systems = group_by_host(osdistribution.objects.filter(host_id__in=chunk).values_list(
+            'host_id', 'name', 'version', 'arch'))
+        ips = group_by_host(net.objects.filter(host_id__in=chunk).values_list('host_id', 'ip'))
+
+        for m in machine.objects.filter(id__in=chunk).select_related('entity', 'typemachine'):
+            counts = results.setdefault(str(m.entity) if m.entity_id else '', {
+                'install': 0, 'extended': 0, 'skip': Counter()})
+            condition_name = 'custom variables'
+            try:
+                facts = MachineFacts(m)
+                facts.softwares = softwares.get(m.id, list())
+                facts.systems = systems.get(m.id, list())
+                facts.ips = ips.get(m.id, list())
+                if names is None:
+                    cv = custom_variables(m, pack)
+                    machine_conditions = [render_condition(c, cv) for c in conditions]
+                else:
+                    machine_conditions = conditions
+                for condition in machine_conditions:
+                    condition_name = condition.name
+                    predicate = compile_condition(condition.id, condition.depends, condition.softwarename,
+                                                  condition.softwareversion)
+                    if not predicate(facts, pack):
+                        counts['skip'][condition.name] += 1
+                        break
+                else:
+                    counts['extended' if extended else 'install'] += 1
+            except Exception:
+                # Incomplete facts of one machine do not stop the simulation of the others
+                counts['skip']['error: %s' % condition_name] += 1
+    return results
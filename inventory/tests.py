@@ -1,9 +1,22 @@
 from django.test import TestCase
-from inventory.models import machine, software, osdistribution, typemachine
-from deploy.models import package, packagecondition, packagecustomvar, timeprofile, packagehistory
+from inventory.models import machine, software, osdistribution, typemachine, net, inventoryqueue, entity, entity_ranges
+from inventory.ipranges import IPRangeIndex
+from inventory.simulate import simulate_package
+from deploy.models import package, packagecondition, packagecustomvar, timeprofile, packagehistory, packageprofile, deployplan, \
+    packagecounter, packagestatuslatest, refresh_packagecounters
 from inventory.views import *
 from configuration.models import deployconfig, globalconfig
 from datetime import datetime, timedelta, date, timezone
+from django.core.management import call_command
+from django.db import connection, DatabaseError
+from django.test.utils import CaptureQueriesContext
+from io import StringIO
+from unittest import mock
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.test import RequestFactory
+from inventory.admin import softwareAdmin
+import json
 
 
 class machineTestCase(TestCase):
@@ -393,6 +406,8 @@ class machineTestCase(TestCase):
                                                                              command='rem', machine=mw11,
                                                                              package=package_installdelay_3hours,
                                                                              status='Install in progress')
+        # packagecounter is maintained by the status path, not by packagehistory.objects.create
+        refresh_packagecounters(packagehistory.objects.values_list('machine_id', 'package_id'))
 
     def test_lower_condition_without_joker(self):
         m = machine.objects.get(name='machine_windows_7_32')
@@ -596,6 +611,14 @@ class machineTestCase(TestCase):
         self.assertEqual(check_conditions(m64, executetimes_2days), True)
         self.assertEqual(check_conditions(m11, executetimes_2days), False)
 
+    def test_history_conditions_read_counters(self):
+        m64 = machine.objects.get(name='machine_windows_7_64')
+        installdelay_3hours = package.objects.get(name='installdelay_3hours')
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(check_conditions(m64, installdelay_3hours), True)
+        self.assertFalse([q for q in context.captured_queries if 'deploy_packagehistory' in q['sql']])
+        self.assertEqual(len([q for q in context.captured_queries if 'deploy_packagecounter' in q['sql']]), 1)
+
     def test_installtimes(self):
         m32 = machine.objects.get(name='machine_windows_7_32')
         m64 = machine.objects.get(name='machine_windows_7_64')
@@ -625,3 +648,525 @@ class machineTestCase(TestCase):
         self.assertEqual(check_conditions(m32, installdelay_3hours), True)
         self.assertEqual(check_conditions(m64, installdelay_3hours), True)
         self.assertEqual(check_conditions(m11, installdelay_3hours), False)
+
+
+class inventoryTestCase(TestCase):
+    def setUp(self):
+        deployconfig.objects.create(name='Default configuration', activate_deploy='yes', activate_time_deploy='no',
+                                    start_time='07:00', end_time='18:00')
+        globalconfig.objects.create(name='default')
+        entity_ranges.invalidate()
+
+    def build_xml(self, softwares, softsum='1', ossum='1', netsum='1', hostname='pc-inventory'):
+        xml = ('<Inventory><SerialNumber>4321</SerialNumber><Hostname>' + hostname + '</Hostname>'
+               '<Manufacturer>vendor</Manufacturer><Product>product</Product><Chassistype>Desktop</Chassistype>'
+               '<Softsum>' + softsum + '</Softsum><Ossum>' + ossum + '</Ossum><Netsum>' + netsum + '</Netsum>'
+               '<Osdistribution><Name>Microsoft Windows 11 Pro</Name><Version>10.0.22621</Version>'
+               '<Arch>64bits</Arch><Systemdrive>c</Systemdrive></Osdistribution>'
+               '<Network><Ip>192.168.1.10</Ip><Mask>255.255.255.0</Mask><Mac>00:11:22:33:44:55</Mac></Network>')
+        for name, version in softwares:
+            xml += ('<Software><Name>' + name + '</Name><Version>' + version + '</Version>'
+                    '<Uninstall>bla</Uninstall></Software>')
+        return xml + '</Inventory>'
+
+    def test_software_differential_sync(self):
+        handling = inventory(self.build_xml([('mozilla', '24.0.1'), ('PDFCreator', '1.6.2')], softsum='1'))
+        self.assertIn('<Import>Software: 2 inserted, 0 deleted</Import>', handling)
+        m = machine.objects.get(name='pc-inventory')
+        pdf_id = software.objects.get(host=m, name='PDFCreator').id
+
+        handling = inventory(self.build_xml([('mozilla', '25.0'), ('PDFCreator', '1.6.2')], softsum='2'))
+        self.assertIn('<Import>Software: 1 inserted, 1 deleted</Import>', handling)
+        self.assertEqual(software.objects.get(host=m, name='PDFCreator').id, pdf_id)
+        self.assertEqual(software.objects.get(host=m, name='mozilla').version, '25.0')
+
+    def test_software_unchanged_softsum(self):
+        inventory(self.build_xml([('mozilla', '24.0.1')], softsum='1'))
+        handling = inventory(self.build_xml([('mozilla', '25.0')], softsum='1'))
+        self.assertNotIn('<Import>Software', ''.join(handling))
+        m = machine.objects.get(name='pc-inventory')
+        self.assertEqual(software.objects.get(host=m, name='mozilla').version, '24.0.1')
+
+    def test_software_manual_entries_kept(self):
+        inventory(self.build_xml([('mozilla', '24.0.1')], softsum='1'))
+        m = machine.objects.get(name='pc-inventory')
+        software.objects.create(name='manual', version='1', host=m, manualy_created='yes')
+        inventory(self.build_xml([], softsum='2'))
+        self.assertEqual(list(software.objects.filter(host=m).values_list('name', flat=True)), ['manual'])
+
+    def test_machine_children_bulk_import(self):
+        inventory(self.build_xml([('mozilla', '24.0.1')]))
+        m = machine.objects.get(name='pc-inventory')
+        self.assertEqual(osdistribution.objects.filter(host=m).count(), 1)
+        self.assertEqual(net.objects.get(host=m).ip, '192.168.1.10')
+        self.assertEqual((m.softsum, m.ossum, m.netsum), ('1', '1', '1'))
+
+    def test_network_creation_warning(self):
+        xml = self.build_xml([]).replace('<Ip>192.168.1.10</Ip>', '<Ip/>')
+        xml = xml.replace('</Inventory>', '<Network><Ip>10.0.0.1</Ip><Mask>255.0.0.0</Mask><Mac>00:00:00:00:00:01'
+                                          '</Mac></Network></Inventory>')
+        handling = inventory(xml)
+        self.assertIn('<Warning>Creation of Network: None -- 255.255.255.0 failed</Warning>', handling)
+        self.assertIn('<Import>Import ok</Import>', handling)
+        m = machine.objects.get(name='pc-inventory')
+        self.assertEqual(list(net.objects.filter(host=m).values_list('ip', flat=True)), ['10.0.0.1'])
+
+    def test_new_machine_not_saved(self):
+        with mock.patch.object(machine, 'save', side_effect=ValueError('insert failed')):
+            handling = inventory(self.build_xml([('mozilla', '24.0.1')]))
+        self.assertEqual(handling, ['<Response>', '<Error>can\'t save machine!</Error>', '</Response>'])
+        self.assertFalse(machine.objects.exists())
+        self.assertFalse(net.objects.exists())
+
+    def test_machine_update_query_count(self):
+        inventory(self.build_xml([('mozilla', '24.0.1')]))
+        # Same checksums: no children is written, the machine is updated once
+        with self.assertNumQueries(8):
+            inventory(self.build_xml([('mozilla', '24.0.1')]))
+
+    def test_streaming_inventory(self):
+        xml = self.build_xml([('mozilla', '24.0.1'), ('PDFCreator', '1.6.2')])
+        response = self.client.post('/post/?action=inventory', data=xml, content_type='application/xml')
+        self.assertContains(response, '<Import>Software: 2 inserted, 0 deleted</Import>')
+        m = machine.objects.get(name='pc-inventory')
+        self.assertEqual(net.objects.get(host=m).mac, '00:11:22:33:44:55')
+        self.assertEqual(osdistribution.objects.get(host=m).arch, '64bits')
+
+    def test_streaming_inventory_size_limit(self):
+        xml = self.build_xml([('software %d' % i, '1.0') for i in range(100)])
+        with self.settings(INVENTORY_MAX_SIZE=1024):
+            response = self.client.post('/post/?action=inventory', data=xml, content_type='application/xml')
+        self.assertContains(response, '<Error>Inventory exceeds the maximum size</Error>')
+        self.assertFalse(machine.objects.filter(name='pc-inventory').exists())
+
+    def test_remove_duplicates_on_inventory(self):
+        main_config = globalconfig.objects.get()
+        main_config.remove_duplicate = 'yes'
+        main_config.save()
+        profile = packageprofile.objects.create(name='profile', description='profile')
+        old = machine.objects.create(serial='OLD', name='pc-inventory', packageprofile=profile, comment='old pc',
+                                     lastsave=datetime.now(timezone.utc) - timedelta(days=10))
+        software.objects.create(name='old software', host=old)
+        other = machine.objects.create(serial='A', name='pc-other')
+        machine.objects.create(serial='B', name='pc-other')
+        inventory(self.build_xml([('mozilla', '24.0.1')]))
+        m = machine.objects.get(name='pc-inventory')
+        self.assertNotEqual(m.id, old.id)
+        self.assertEqual(m.packageprofile, profile)
+        self.assertEqual(m.comment, 'old pc')
+        self.assertFalse(software.objects.filter(host_id=old.id).exists())
+        # Only the inventoried hostname is checked
+        self.assertEqual(machine.objects.filter(name='pc-other').count(), 2)
+        self.assertTrue(machine.objects.filter(id=other.id).exists())
+
+    def test_remove_duplicates_batch(self):
+        now = datetime.now(timezone.utc)
+        for name in ('pc-a', 'pc-b'):
+            for days in (3, 1, 2):
+                m = machine.objects.create(serial=name, name=name, comment='%d days' % days,
+                                           lastsave=now - timedelta(days=days))
+                net.objects.create(ip='10.0.0.%d' % days, mask='255.0.0.0', mac='00:00:00:00:00:00', host=m)
+        machine.objects.create(serial='C', name='pc-c')
+        self.assertEqual(remove_duplicates(), 4)
+        self.assertEqual(machine.objects.count(), 3)
+        for name in ('pc-a', 'pc-b'):
+            m = machine.objects.get(name=name)
+            self.assertEqual(m.lastsave, now - timedelta(days=1))
+            self.assertEqual(m.comment, '2 days')
+            self.assertEqual(net.objects.get(host=m).ip, '10.0.0.1')
+        self.assertEqual(remove_duplicates(), 0)
+
+    def test_remove_duplicates_case(self):
+        now = datetime.now(timezone.utc)
+        # Names differing only by case are not sorted together by a case-sensitive collation
+        for name, days in (('PC-A', 3), ('pc-b', 3), ('pc-a', 2), ('PC-B', 2), ('Pc-A', 1)):
+            machine.objects.create(serial=name, name=name, comment='%s %d days' % (name, days),
+                                   lastsave=now - timedelta(days=days))
+        self.assertEqual(remove_duplicates('PC-b'), 1)
+        self.assertEqual(list(machine.objects.filter(name__iexact='pc-b').values_list('name', 'comment')),
+                         [('PC-B', 'pc-b 3 days')])
+        self.assertEqual(remove_duplicates(), 2)
+        self.assertEqual(list(machine.objects.filter(name__iexact='pc-a').values_list('name', 'comment')),
+                         [('Pc-A', 'pc-a 2 days')])
+
+    def test_ip_range_index(self):
+        ranges = IPRangeIndex([(1, 'a-site', '10.0.0.0/8,bad range'), (2, 'b-site', '10.1.0.0/16,192.168.1.10'),
+                               (3, 'c-site', '10.1.2.0/24,172.16.0.0/12,2001:db8::/32')])
+        self.assertEqual(ranges.lookup('10.1.2.3'), 1)
+        self.assertEqual(ranges.lookup('192.168.1.10'), 2)
+        self.assertIsNone(ranges.lookup('192.168.1.11'))
+        self.assertEqual(ranges.lookup('172.31.255.255'), 3)
+        self.assertIsNone(ranges.lookup('172.32.0.0'))
+        self.assertEqual(ranges.lookup('2001:db8::1'), 3)
+        self.assertIsNone(ranges.lookup('not an ip'))
+        self.assertEqual(ranges.find(['127.0.0.1', '192.168.1.10', '10.0.0.1']), 2)
+        self.assertEqual(ranges.errors, [('a-site', 'bad range')])
+
+    def test_inventory_entity_from_ip_range(self):
+        default = entity.objects.create(name='default', description='default')
+        site = entity.objects.create(name='site', description='site', ip_range='192.168.0.0/16')
+        machine.objects.create(serial='4321', name='pc-inventory', entity=default)
+        handling = inventory(self.build_xml([]))
+        self.assertIn('<Info>Entity updated for pc-inventory from \'default\' to \'site\'</Info>', handling)
+        self.assertEqual(machine.objects.get(name='pc-inventory').entity, site)
+        # The index is rebuilt when an entity is modified
+        site.ip_range = '10.0.0.0/8'
+        site.save()
+        default.ip_range = '192.168.1.0/24'
+        default.save()
+        inventory(self.build_xml([]))
+        self.assertEqual(machine.objects.get(name='pc-inventory').entity, default)
+
+    def test_autoset_entity_command(self):
+        default = entity.objects.create(name='default', description='default')
+        site = entity.objects.create(name='site', description='site', ip_range='10.0.0.0/8')
+        for i in range(3):
+            m = machine.objects.create(serial=str(i), name='pc-%d' % i, entity=default if i else None)
+            net.objects.create(ip='10.0.0.%d' % i, mask='255.0.0.0', mac='00:00:00:00:00:00', host=m)
+        out = StringIO()
+        call_command('autoset_entity', stdout=out)
+        self.assertIn('2 machines to update', out.getvalue())
+        self.assertEqual(machine.objects.filter(entity=site).count(), 0)
+        call_command('autoset_entity', apply=True, stdout=out)
+        self.assertEqual(machine.objects.filter(entity=site).count(), 2)
+        call_command('autoset_entity', apply=True, all=True, stdout=out)
+        self.assertEqual(machine.objects.filter(entity=site).count(), 3)
+
+    def test_config_cache(self):
+        config = get_deployconfig()
+        get_globalconfig()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_deployconfig().activate_time_deploy, 'no')
+            self.assertEqual(get_globalconfig().name, 'default')
+        config.activate_time_deploy = 'yes'
+        config.save()
+        self.assertEqual(get_deployconfig().activate_time_deploy, 'yes')
+        # Each call returns a copy, modifications are not shared
+        get_deployconfig().activate_deploy = 'no'
+        self.assertEqual(get_deployconfig().activate_deploy, 'yes')
+
+    def test_conditions_on_shared_facts(self):
+        m = machine.objects.create(serial='1', name='pc-01', vendor='Dell Inc.')
+        software.objects.create(name='Mozilla Firefox', version='24.0.1', host=m)
+        net.objects.create(ip='192.168.1.10', mask='255.255.255.0', mac='00:00:00:00:00:00', host=m)
+        packs = list()
+        for depends, name, version, expected in (
+                ('installed', 'mozilla*', '24.0.1', True), ('notinstalled', 'Mozilla Firefox', '24.0.1', False),
+                ('hostname_in', 'srv-*,PC-0*', None, True), ('hostname_not', 'pc-01', None, False),
+                ('ipaddr_in', '10.0.0.0/8,192.168.0.0/16', None, True), ('ipaddr_not', '192.168.1.10', None, False),
+                ('vendor_in', 'dell*', None, True), ('product_not', 'undefined', None, False)):
+            pack = package.objects.create(name=depends, description=depends, command='cmd', ignoreperiod='yes')
+            pack.conditions.add(packagecondition.objects.create(name=depends, depends=depends, softwarename=name,
+                                                                softwareversion=version))
+            packs.append((pack, expected))
+        facts = MachineFacts(m)
+        for pack, expected in packs:
+            self.assertEqual(check_conditions(m, pack, facts=facts), expected, pack.name)
+        # Facts are loaded once: each package only reads its custom variables, time profiles and conditions
+        with self.assertNumQueries(3 * len(packs)):
+            for pack, expected in packs:
+                check_conditions(m, pack, b'BASIC_CHECK', facts)
+
+    def test_template_cache(self):
+        cache = TemplateCache(django_engine, maxsize=2)
+        self.assertEqual(cache.render('{{hostname}}.log', {'hostname': 'pc-01'}), 'pc-01.log')
+        self.assertEqual(cache.render('{{hostname}}.log', {'hostname': 'pc-02'}), 'pc-02.log')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.render('{{username}}', {'username': 'user'})
+        cache.render('{{domain}}', {'domain': 'domain'})
+        # The least recently used template is dropped
+        cache.render('{{hostname}}.log', {'hostname': 'pc-03'})
+        self.assertEqual((cache.hits, cache.misses), (1, 4))
+        self.assertEqual(len(cache.templates), 2)
+
+    def test_deploy_plan_query_count(self):
+        profile = packageprofile.objects.create(name='profile', description='profile')
+        inventory(self.build_xml([('mozilla', '24.0.1')]))
+        m = machine.objects.get(name='pc-inventory')
+        m.packageprofile = profile
+        m.save()
+        queries = list()
+        for count in (2, 6):
+            for i in range(len(profile.packages.all()), count):
+                pack = package.objects.create(name='package %d' % i, description='package', command='setup {{arg}}',
+                                              ignoreperiod='yes', packagesum='nofile', packagehash='nofile')
+                packagecustomvar.objects.create(name='arg', value='/S', package=pack)
+                pack.conditions.add(packagecondition.objects.create(name='mozilla', depends='installed',
+                                                                    softwarename='mozilla', softwareversion='24.0.1'))
+                pack.conditions.add(packagecondition.objects.create(name='host', depends='hostname_in',
+                                                                    softwarename='pc-*'))
+                pack.timeprofiles.add(timeprofile.objects.create(name='always', start_time='00:00',
+                                                                 end_time='23:59'))
+                profile.packages.add(pack)
+            with CaptureQueriesContext(connection) as context:
+                handling = inventory(self.build_xml([('mozilla', '24.0.1')]))
+            self.assertEqual(len([line for line in handling if '<Command>setup /S' in line]), count)
+            queries.append(len(context.captured_queries))
+        self.assertEqual(queries[0], queries[1])
+
+    def test_stored_deploy_plan(self):
+        profile = packageprofile.objects.create(name='profile', description='profile')
+        pack = package.objects.create(name='package', description='package', command='setup', ignoreperiod='yes',
+                                      packagesum='nofile', packagehash='nofile')
+        condition = packagecondition.objects.create(name='mozilla', depends='installed', softwarename='mozilla',
+                                                    softwareversion='24.0.1')
+        pack.conditions.add(condition)
+        profile.packages.add(pack)
+        inventory(self.build_xml([('mozilla', '24.0.1')]))
+        m = machine.objects.get(name='pc-inventory')
+        m.packageprofile = profile
+        m.save()
+        handling = inventory(self.build_xml([('mozilla', '24.0.1')]))
+        self.assertEqual(len([line for line in handling if '<Command>setup' in line]), 1)
+        plan = deployplan.objects.get(machine=m)
+        self.assertEqual(plan.packages, [pack.id])
+        self.assertEqual(plan.conditions, {'%d:%d' % (pack.id, condition.id): True})
+
+        # Unchanged checksums: softwares are not read again
+        with CaptureQueriesContext(connection) as context:
+            handling = inventory(self.build_xml([('mozilla', '24.0.1')]))
+        self.assertEqual(len([line for line in handling if '<Command>setup' in line]), 1)
+        self.assertFalse([q for q in context.captured_queries if 'FROM "inventory_software"' in q['sql']])
+
+        # Condition changed: plan is invalidated
+        condition.softwareversion = '25.0'
+        condition.save()
+        self.assertFalse(deployplan.objects.filter(machine=m).exists())
+        handling = inventory(self.build_xml([('mozilla', '24.0.1')]))
+        self.assertEqual(len([line for line in handling if '<Command>setup' in line]), 0)
+        self.assertEqual(deployplan.objects.get(machine=m).conditions, {'%d:%d' % (pack.id, condition.id): False})
+
+        # New checksum: plan is computed again
+        handling = inventory(self.build_xml([('mozilla', '25.0')], softsum='2'))
+        self.assertEqual(len([line for line in handling if '<Command>setup' in line]), 1)
+        self.assertEqual(deployplan.objects.get(machine=m).conditions, {'%d:%d' % (pack.id, condition.id): True})
+
+    def test_deploy_plan_invalidation(self):
+        profile = packageprofile.objects.create(name='profile', description='profile')
+        pack = package.objects.create(name='package', description='package', command='setup', ignoreperiod='yes',
+                                      packagesum='nofile', packagehash='nofile')
+        condition = packagecondition.objects.create(name='mozilla', depends='installed', softwarename='mozilla',
+                                                    softwareversion='24.0.1')
+        pack.conditions.add(condition)
+        profile.packages.add(pack)
+        for hostname in ('pc-1', 'pc-2'):
+            inventory(self.build_xml([('mozilla', '24.0.1')], hostname=hostname))
+        m1, m2 = machine.objects.get(name='pc-1'), machine.objects.get(name='pc-2')
+        m1.packageprofile = profile
+        m1.save()
+
+        def stored_plans():
+            for m in (m1, m2):
+                inventory(self.build_xml([('mozilla', '24.0.1')], hostname=m.name))
+            return set(deployplan.objects.values_list('machine__name', flat=True))
+        self.assertEqual(stored_plans(), {'pc-1', 'pc-2'})
+
+        # Only the machines of the package lose their plan
+        condition.save()
+        self.assertEqual(set(deployplan.objects.values_list('machine__name', flat=True)), {'pc-2'})
+        stored_plans()
+        profile.packages.remove(pack)
+        self.assertEqual(set(deployplan.objects.values_list('machine__name', flat=True)), {'pc-2'})
+        stored_plans()
+        # Data which is not in the plans
+        typemachine.objects.create(name='Laptop')
+        timeprofile.objects.create(name='always', start_time='00:00', end_time='23:59')
+        entity.objects.create(name='site', description='site')
+        self.assertEqual(deployplan.objects.count(), 2)
+
+        # Softwares edited in the admin: checksums are unchanged
+        request = RequestFactory().post('/')
+        request.user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        software_admin = softwareAdmin(software, admin.site)
+        software_admin.delete_queryset(request, software.objects.filter(host=m2))
+        self.assertEqual(set(deployplan.objects.values_list('machine__name', flat=True)), {'pc-1'})
+
+    def test_simulate_package(self):
+        inventory(self.build_xml([('Mozilla Firefox', '24.0.1')], hostname='pc-1'))
+        inventory(self.build_xml([('Mozilla Firefox', '25.0')], hostname='pc-2'))
+        inventory(self.build_xml([('PDFCreator', '1.6.2')], hostname='pc-3'))
+        e = entity.objects.create(name='site', description='site')
+        machine.objects.filter(name='pc-3').update(entity=e)
+        pack = package.objects.create(name='firefox', description='firefox', command='setup', packagesum='nofile',
+                                      packagehash='nofile')
+        pack.conditions.add(packagecondition.objects.create(name='no pdfcreator', depends='notinstalled',
+                                                            softwarename='pdf*', softwareversion='1.6.2'))
+        pack.conditions.add(packagecondition.objects.create(name='firefox lower', depends='lower',
+                                                            softwarename='mozilla*', softwareversion='25.0'))
+        pack.conditions.add(packagecondition.objects.create(name='execute once', depends='executetimes',
+                                                            softwarename='day', softwareversion='1'))
+        results = simulate_package(pack)
+        self.assertEqual(results['']['install'], 1)
+        self.assertEqual(results['']['skip'], {'firefox lower': 1})
+        self.assertEqual(results['site']['skip'], {'no pdfcreator': 1})
+
+        pack.conditions.add(packagecondition.objects.create(name='file', depends='isfile', softwarename='c:\\x'))
+        results = simulate_package(pack, machine.objects.filter(entity__isnull=True))
+        self.assertEqual(list(results), [''])
+        self.assertEqual(results['']['extended'], 1)
+
+        out = StringIO()
+        call_command('simulate_package', 'firefox', entity='site', stdout=out)
+        self.assertIn('site: 0 install, 0 depend on extended conditions, 1 skip', out.getvalue())
+        self.assertIn('1 skip on condition no pdfcreator', out.getvalue())
+
+    def test_simulate_package_without_software_name(self):
+        inventory(self.build_xml([('mozilla', '24.0.1')], hostname='pc-1'))
+        pack = package.objects.create(name='firefox', description='firefox', command='setup', packagesum='nofile',
+                                      packagehash='nofile')
+        condition = packagecondition.objects.create(name='no name', depends='installed', softwarename=None,
+                                                    softwareversion='24.0.1')
+        pack.conditions.add(condition)
+        self.assertEqual(simulate_package(pack)['']['skip'], {'error: no name': 1})
+        condition.softwarename = ''
+        condition.save()
+        pack.conditions.add(packagecondition.objects.create(name='mozilla', depends='installed', softwarename='mozilla',
+                                                            softwareversion='24.0.1'))
+        self.assertEqual(simulate_package(pack)['']['skip'], {'no name': 1})
+
+    def test_simulate_package_incomplete_facts(self):
+        inventory(self.build_xml([], hostname='pc-1'))
+        inventory(self.build_xml([], hostname='pc-2'))
+        machine.objects.filter(name='pc-1').update(language=None)
+        machine.objects.filter(name='pc-2').update(language='fr_FR')
+        pack = package.objects.create(name='french', description='french', command='setup', packagesum='nofile',
+                                      packagehash='nofile')
+        pack.conditions.add(packagecondition.objects.create(name='french only', depends='language_is',
+                                                            softwarename='fr_fr'))
+        results = simulate_package(pack)
+        self.assertEqual(results['']['install'], 1)
+        self.assertEqual(results['']['skip'], {'error: french only': 1})
+
+    def status_xml(self, m, pack, status):
+        return ('<Packagestatus><Mid>%d</Mid><Pid>%d</Pid><Status>%s</Status></Packagestatus>' %
+                (m.id, pack.id, status))
+
+    def test_status_batch(self):
+        inventory(self.build_xml([('mozilla', '24.0.1')]))
+        m = machine.objects.get(name='pc-inventory')
+        packs = [package.objects.create(name='package %d' % i, description='package', command='setup',
+                                        packagesum='nofile', packagehash='nofile') for i in range(2)]
+        m.packages.add(*packs)
+        statuses = ['Ready to download and execute', 'Ready to download and execute', 'Install in progress',
+                    'Warning condition: x', 'Warning condition: x', 'Operation completed']
+        # Sequential status requests on the first package, one batch on the second
+        with CaptureQueriesContext(connection) as single:
+            for st in statuses:
+                self.assertIn('Status saved', status(self.status_xml(m, packs[0], st)))
+        xml = '<Packagestatuses>' + ''.join(self.status_xml(m, packs[1], st) for st in statuses) + \
+              '<Packagestatus><Mid>%d</Mid><Pid>0</Pid><Status>Install in progress</Status></Packagestatus>' % m.id + \
+              '</Packagestatuses>'
+        with CaptureQueriesContext(connection) as batch:
+            response = self.client.post('/post/', {'action': 'statusbatch', 'xml': xml})
+        self.assertContains(response, '<Result>Status saved</Result>', count=len(statuses))
+        self.assertContains(response, 'package matching query does not exist', count=1)
+        self.assertLess(len(batch.captured_queries), len(single.captured_queries) / 2)
+
+        for pack in packs:
+            self.assertEqual(list(packagehistory.objects.filter(package=pack).order_by('id').values_list('status', flat=True)),
+                             ['Ready to download and execute', 'Install in progress', 'Warning condition: x',
+                              'Operation completed'])
+            counter = packagecounter.objects.get(machine=m, package=pack)
+            self.assertEqual((counter.count('execute', 'day'), counter.count('install', 'day')), (2, 1))
+            self.assertEqual(packagestatuslatest.objects.get(machine=m, package=pack).status, 'Operation completed')
+        self.assertFalse(m.packages.exists())
+
+    def test_status_batch_dates(self):
+        inventory(self.build_xml([('mozilla', '24.0.1')]))
+        m = machine.objects.get(name='pc-inventory')
+        pack = package.objects.create(name='package', description='package', command='setup', packagesum='nofile',
+                                      packagehash='nofile')
+        ready = packagehistory.objects.create(machine=m, package=pack, command='setup',
+                                              status='Ready to download and execute')
+        # New and reused records are dated in the order of the request
+        status_batch('<Packagestatuses>' + self.status_xml(m, pack, 'Install in progress') +
+                     self.status_xml(m, pack, 'Ready to download and execute') + '</Packagestatuses>')
+        progress = packagehistory.objects.get(package=pack, status='Install in progress')
+        ready.refresh_from_db()
+        self.assertEqual(ready.date - progress.date, timedelta(microseconds=1))
+        self.assertEqual(packagestatuslatest.objects.get(machine=m, package=pack).status, 'Ready to download and execute')
+
+    def test_status_buffer(self):
+        inventory(self.build_xml([('mozilla', '24.0.1')]))
+        m = machine.objects.get(name='pc-inventory')
+        pack = package.objects.create(name='package', description='package', command='setup', packagesum='nofile',
+                                      packagehash='nofile')
+        m.packages.add(pack)
+        with self.settings(STATUS_BUFFER='memory', STATUS_BUFFER_ALLOW_LOSS=True, STATUS_BUFFER_INTERVAL=3600000,
+                           STATUS_BUFFER_SIZE=1000):
+            self.assertIn('Status saved', status(self.status_xml(m, pack, 'Install in progress')))
+            # Checked and removed from the machine now, only the history write is deferred
+            self.assertFalse(m.packages.exists())
+            response = ''.join(status_batch('<Packagestatuses>' + self.status_xml(m, pack, 'Operation completed') +
+                                            self.status_xml(m, pack, '') + '</Packagestatuses>'))
+            self.assertIn('<Result>Status saved</Result>', response)
+            self.assertIn('Empty status', response)
+            self.assertIn('package matching query does not exist', ''.join(status(
+                '<Packagestatus><Mid>%d</Mid><Pid>0</Pid><Status>Install in progress</Status></Packagestatus>' % m.id)))
+            self.assertFalse(packagehistory.objects.filter(package=pack).exists())
+            self.assertEqual(status_buffer.flush(), 2)
+        self.assertEqual(list(packagehistory.objects.filter(package=pack).order_by('id').values_list('status', flat=True)),
+                         ['Install in progress', 'Operation completed'])
+        self.assertFalse(m.packages.exists())
+
+        # Memory buffer is not crash-safe: refused unless its loss is allowed
+        with self.settings(STATUS_BUFFER='memory'):
+            self.assertIn('Status saved', status(self.status_xml(m, pack, 'Error: 1')))
+            self.assertEqual(status_buffer.flush(), 0)
+        self.assertTrue(packagehistory.objects.filter(package=pack, status='Error: 1').exists())
+
+        # Redis unavailable: statuses are written directly
+        with self.settings(STATUS_BUFFER='redis'):
+            self.assertIn('Status saved', status(self.status_xml(m, pack, 'Warning condition: x')))
+        self.assertTrue(packagehistory.objects.filter(package=pack, status='Warning condition: x').exists())
+
+    def test_queued_inventory(self):
+        xml = self.build_xml([('mozilla', '24.0.1'), ('PDFCreator', '1.6.2')])
+        with self.settings(INVENTORY_QUEUE=True, INVENTORY_QUEUE_WAIT=0):
+            response = self.client.post('/post/', {'action': 'inventory', 'xml': xml})
+        self.assertContains(response, '<Info>Inventory queued</Info>')
+        self.assertFalse(machine.objects.filter(name='pc-inventory').exists())
+        item = inventoryqueue.objects.get()
+        self.assertEqual(item.status, 'pending')
+
+        call_command('process_inventory_queue', workers=1, once=True, stdout=StringIO())
+        item.refresh_from_db()
+        self.assertEqual(item.status, 'done')
+        self.assertIn('<Import>Software: 2 inserted, 0 deleted</Import>', json.loads(item.response))
+        self.assertEqual(software.objects.filter(host__name='pc-inventory').count(), 2)
+
+    def test_queued_inventory_invalid(self):
+        with self.settings(INVENTORY_QUEUE=True):
+            response = self.client.post('/post/?action=inventory', data='<Packages><Hostname>pc</Hostname></Packages>',
+                                        content_type='application/xml')
+        self.assertContains(response, '<Error>Error etree or find in xml</Error>')
+        self.assertFalse(inventoryqueue.objects.exists())
+
+    def test_queued_inventory_claim(self):
+        for i in range(3):
+            queue_inventory(self.build_xml([], hostname='pc-%d' % i), wait=0)
+        first = claim_queued_inventories(2)
+        second = claim_queued_inventories(2)
+        self.assertEqual(len(first), 2)
+        self.assertEqual(len(second), 1)
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(process_queued_inventories(first + second), 3)
+        self.assertEqual(machine.objects.filter(name__startswith='pc-').count(), 3)
+
+    def test_queued_inventory_error(self):
+        for i in range(2):
+            queue_inventory(self.build_xml([], hostname='pc-%d' % i), wait=0)
+        ids = claim_queued_inventories(2)
+        results = [DatabaseError('deadlock')]
+
+        def import_inventory(xml):
+            if results:
+                raise results.pop()
+            return inventory(xml)
+        with mock.patch('inventory.views.inventory', side_effect=import_inventory):
+            self.assertEqual(process_queued_inventories(ids), 2)
+        failed, done = inventoryqueue.objects.order_by('id')
+        # Only the failed inventory is lost, its client gets an error response
+        self.assertEqual((failed.status, done.status), ('error', 'done'))
+        self.assertIn('deadlock', json.loads(failed.response)[1])
+        self.assertEqual(list(machine.objects.filter(name__startswith='pc-').values_list('name', flat=True)), ['pc-1'])
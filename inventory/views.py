@@ -20,47 +20,47 @@
 ###############################################################################
 
 from django.shortcuts import render
+from django.conf import settings
 from lxml import etree
-from inventory.models import machine, typemachine, software, net, osdistribution, entity
-from deploy.models import package, packagehistory, packagecustomvar
-from configuration.models import deployconfig, globalconfig
+from inventory.models import machine, typemachine, software, net, osdistribution, entity, inventoryqueue, entity_ranges
+from deploy.models import package, packagehistory, packagecustomvar, update_packagecounters, \
+    update_latest_statuses, assign_revisions
+from configuration.models import deployconfig, globalconfig, get_deployconfig, get_globalconfig
 from datetime import datetime, timedelta, timezone
 from xml.sax.saxutils import escape
-from django.db.models import Count, Max
+from collections import Counter
+from django.db import connection, transaction
+from django.db.models import Count, F, Max, Q, Prefetch
+from django.db.models.functions import Lower
+from itertools import groupby
 from netaddr import IPNetwork, IPAddress
+import logging
 import sys
 import re
+import copy
+import json
+import time
 from django.template import engines
+from inventory.conditions import MachineFacts, compile_condition, compare_versions, BASIC_CONDITIONS, \
+    EXTENDED_CONDITIONS, HISTORY_CONDITIONS
+from updatengine.cache import TemplateCache, WriteBehindBuffer
+from inventory.plan import DeployPlanContext
 
+logger = logging.getLogger(__name__)
 django_engine = engines['django']
-
-
-def compare_versions(version1, version2):
-    ''' Compare two version string '''
-    from packaging import version
-    if version1 is None:
-        version1 = ''
-    if version2 is None:
-        version2 = ''
-    if version1 == version2:
-        return 0
-    try:
-        return -1 if version.parse(version1) < version.parse(version2) else 1
-    except:
-        ver = [version1, version2]
-        ver.sort()
-        return -1 if ver[0] == version1 else 1
+# Compiled templates of package commands and conditions using custom variables
+templates = TemplateCache(django_engine)
 
 
 def is_deploy_authorized(m, handling, p=None):
     '''Function that define if deploy is authorized or not'''
     # Loading configuration datas
-    config = deployconfig.objects.get(pk=1)
+    config = get_deployconfig()
     now = datetime.now().time()
     deploy_auth = False
     # if a package time period is defined
     if p is not None:
-        periods = p.timeprofiles.filter()
+        periods = p.timeprofiles.all()
         if not periods:
             deploy_auth = True
         else:
@@ -91,6 +91,165 @@ def is_deploy_authorized(m, handling, p=None):
     return deploy_auth
 
 
+def custom_variables(m, pack, commands=False):
+    '''Return custom variables of pack applied on commands (or on conditions) with global variables'''
+    cv = {}
+    for customvar in pack.packagecustomvar_set.all():
+        if customvar.apply_on_commands if commands else customvar.apply_on_conditions:
+            cv[customvar.name] = customvar.value
+    if pack.use_global_variables == 'yes':
+        cv['username'] = m.username.replace(' (not logged in)', '')
+        cv['hostname'] = m.name
+        cv['domain'] = m.domain
+    return cv
+
+
+def check_package_statuses(items, packages=package.objects):
+    '''Check package statuses sent by clients: items is a list of (mid, pid, status).
+    Return the error of each item (None if valid) and the list of valid (index, machine, package, status)'''
+    results = [None] * len(items)
+    machines = machine.objects.in_bulk({int(mid) for mid, pid, st in items if str(mid).isdigit()})
+    packages = packages.in_bulk({int(pid) for mid, pid, st in items if str(pid).isdigit()})
+    valid = list()
+    for index, (mid, pid, status) in enumerate(items):
+        try:
+            m = machines.get(int(mid))
+            if m is None:
+                raise machine.DoesNotExist('machine matching query does not exist.')
+            p = packages.get(int(pid))
+            if p is None:
+                raise package.DoesNotExist('package matching query does not exist.')
+            if not status:
+                raise ValueError('Empty status')
+            valid.append((index, m, p, status))
+        except:
+            results[index] = 'Error when modifying status: %s' % str(sys.exc_info())
+    return results, valid
+
+
+def remove_machine_packages(valid):
+    '''Remove the packages of the valid statuses from their machines'''
+    removed = dict()
+    for index, m, p, status in valid:
+        removed.setdefault(m, set()).add(p.id)
+    for m, package_ids in removed.items():
+        m.packages.remove(*package_ids)
+
+
+def save_package_statuses(items):
+    '''Save package statuses sent by clients: items is a list of (mid, pid, status).
+    Statuses are applied in order in one transaction with bulk queries.
+    Return the result of each item ('Status saved' or an error message)'''
+    results = [None] * len(items)
+    window_statuses = ('Install in progress', 'Operation completed', 'Ready to download and execute')
+    try:
+        with transaction.atomic():
+            results, valid = check_package_statuses(items, package.objects.prefetch_related(
+                Prefetch('packagecustomvar_set', queryset=packagecustomvar.objects.all())))
+            if not valid:
+                return results
+
+            now = datetime.now(timezone.utc)
+            date_max = now - timedelta(minutes=5)
+            history = packagehistory.objects.filter(machine_id__in={m.id for i, m, p, st in valid},
+                                                    package_id__in={p.id for i, m, p, st in valid})
+            last_dates = {(h['machine_id'], h['package_id']): h['last'] for h in history.values(
+                'machine_id', 'package_id').annotate(last=Max('date'))}
+            # Records which may be deleted ('Programmed') or reused (same status and command)
+            statuses = {st for i, m, p, st in valid}
+            rows = dict()
+            latest = dict()
+            for h in history.select_related('revision').filter(Q(status='Programmed') |
+                                    Q(status__in=statuses & set(window_statuses), date__gt=date_max) |
+                                    Q(status__in={st for st in statuses if st.startswith('Warning condition:')})):
+                rows.setdefault((h.machine_id, h.package_id), list()).append(h)
+                if h.date == last_dates.get((h.machine_id, h.package_id)):
+                    latest[(h.machine_id, h.package_id)] = h
+
+            to_delete = list()
+            to_create = list()
+            to_update = list()
+            for index, m, p, status in valid:
+                key = (m.id, p.id)
+                pair_rows = rows.setdefault(key, list())
+                cv = custom_variables(m, p, commands=True)
+                command = templates.render(p.command, cv) if len(cv) > 0 else p.command
+                # Remove last record if it history status is 'Programmed'
+                last = latest.get(key)
+                if last is not None and last.status == 'Programmed':
+                    pair_rows.remove(last)
+                    if last in to_create:
+                        to_create.remove(last)
+                    else:
+                        to_delete.append(last.id)
+                obj = None
+                # Add status history in 'in progress', 'completed' and 'ready' if they are 5 minutes apart
+                if status in window_statuses:
+                    reusable = [h for h in pair_rows if h.command == command and h.status == status and h.date > date_max]
+                    if reusable:
+                        obj = max(reusable, key=lambda h: h.date)
+                # Warning conditions reuses old records to avoid filling the base unnecessarily
+                elif status.startswith('Warning condition:'):
+                    reusable = [h for h in pair_rows if h.command == command and h.status == status]
+                    if reusable:
+                        obj = reusable[0]
+                if obj is None:
+                    obj = packagehistory(machine=m, package=p)
+                    to_create.append(obj)
+                    pair_rows.append(obj)
+                elif obj not in to_create and obj not in to_update:
+                    to_update.append(obj)
+                obj.name = p.name
+                obj.description = p.description
+                obj.command = command
+                obj.packagesum = p.packagesum
+                if p.packagesum != 'nofile':
+                    obj.filename = p.filename.path
+                else:
+                    obj.filename = ''
+                obj.status = status
+                obj.status_code = packagehistory.get_status_code(status)
+                # Keep the order of the statuses of the request
+                obj.date = now + timedelta(microseconds=index)
+                latest[key] = obj
+
+            packagehistory.objects.filter(id__in=to_delete).delete()
+            assign_revisions(to_create + to_update)
+            packagehistory.objects.bulk_create(to_create)
+            packagehistory.objects.bulk_update(to_update, ['revision', 'status', 'status_code', 'date'])
+            update_packagecounters([(obj, True) for obj in to_create] + [(obj, False) for obj in to_update])
+            update_latest_statuses(to_create + to_update)
+            remove_machine_packages(valid)
+    except:
+        error = 'Error when modifying status: %s' % str(sys.exc_info())
+        return [result if result is not None and result.startswith('Error') else error for result in results]
+    return [result if result is not None else 'Status saved' for result in results]
+
+
+def save_buffered_statuses(items):
+    '''Write the statuses of the status buffer (checked when received, errors can only be logged)'''
+    for (mid, pid, status), result in zip(items, save_package_statuses(items)):
+        if result != 'Status saved':
+            logger.warning('Buffered status of machine %s and package %s not saved: %s', mid, pid, result)
+
+
+status_buffer = WriteBehindBuffer('package_status', save_buffered_statuses, 'STATUS_BUFFER')
+
+
+def buffer_package_statuses(items):
+    '''Check the statuses and remove their packages from the machines now, and only defer the write of the
+    history to the status buffer. Return the result of each item, None when the buffer is not enabled'''
+    if not status_buffer.enabled:
+        return None
+    results, valid = check_package_statuses(items)
+    if valid:
+        if not status_buffer.push([items[index] for index, m, p, st in valid]):
+            return None
+        # packages must not be offered again to a machine checking in before the flush
+        remove_machine_packages(valid)
+    return [result if result is not None else 'Status saved' for result in results]
+
+
 def status(xml):
     '''Function that handle status client request'''
     handling = list()
@@ -105,57 +264,31 @@ def status(xml):
         handling.append('<Error>Error etree or find in xml</Error>')
         handling.append('</Response>')
         return handling
+    # Written later by the status buffer if it is enabled (STATUS_BUFFER)
+    results = buffer_package_statuses([(mid, pid, status)]) or save_package_statuses([(mid, pid, status)])
+    handling.append(results[0])
+    handling.append('</Response>')
+    return handling
+
+
+def status_batch(xml):
+    '''Function that handle statusbatch client request: several <Packagestatus> saved at once'''
+    handling = list()
+    handling.append('<Response>')
     try:
-        # Update packagehistory status:
-        m = machine.objects.get(pk=mid)
-        p = package.objects.get(pk=pid)
-        cv = {}
-        for customvar in packagecustomvar.objects.filter(package=p, apply_on_commands=True):
-            cv[customvar.name] = customvar.value
-        if p.use_global_variables == 'yes':
-            cv['username'] = m.username.replace(' (not logged in)', '')
-            cv['hostname'] = m.name
-            cv['domain'] = m.domain
-        if len(cv) > 0:
-            template = django_engine.from_string(p.command)
-            p.command = template.render(cv, request=None)
-        # Remove last record if it history status is 'Programmed'
-        obj = packagehistory.objects.filter(machine=m, package=p)
-        if obj:
-            obj = obj.latest('date')
-            if obj.status == 'Programmed':
-                obj.delete()
-        # Add status history in 'in progress', 'completed' and 'ready' if they are 5 minutes apart
-        if status in ['Install in progress', 'Operation completed', 'Ready to download and execute']:
-            # Use previous record with same status if it is less than 5 minutes old
-            today = datetime.now(timezone.utc)
-            date_max = today - timedelta(minutes=5)
-            obj = packagehistory.objects.filter(machine=m, package=p, command=p.command, status=status, date__gt=date_max)
-            if not obj:
-                obj = packagehistory.objects.create(machine=m, package=p, command=p.command, status=status)
-            else:
-                obj = obj.latest('date')
-        # Warning conditions reuses old records to avoid filling the base unnecessarily
-        elif status.startswith('Warning condition:'):
-            obj, created = packagehistory.objects.get_or_create(machine=m, package=p, command=p.command, status=status)
-        # Add other status like installation errors
-        else:
-            obj = packagehistory.objects.create(machine=m, package=p, command=p.command, status=status)
-        obj.name = p.name
-        obj.description = p.description
-        obj.command = p.command
-        obj.packagesum = p.packagesum
-        if p.packagesum != 'nofile':
-            obj.filename = p.filename.path
-        else:
-            obj.filename = ''
-        obj.status = status
-        obj.save()
-        # remove package from machine
-        m.packages.remove(p)
-        handling.append('Status saved')
+        root = etree.fromstring(xml)
+        items = [(e.find('Mid').text, e.find('Pid').text, e.find('Status').text) for e in root.iter('Packagestatus')]
     except:
-        handling.append('Error when modifying status: %s' % str(sys.exc_info()))
+        handling.append('<Error>Error etree or find in xml</Error>')
+        handling.append('</Response>')
+        return handling
+    results = buffer_package_statuses(items) or save_package_statuses(items)
+    for (mid, pid, status), result in zip(items, results):
+        handling.append('<Packagestatus>' +
+                        '<Mid>' + encodeXMLText(str(mid)) + '</Mid>' +
+                        '<Pid>' + encodeXMLText(str(pid)) + '</Pid>' +
+                        '<Result>' + encodeXMLText(result) + '</Result>' +
+                        '</Packagestatus>')
     handling.append('</Response>')
     return handling
 
@@ -163,19 +296,14 @@ def status(xml):
 def get_extended_conditions(m, pack):
     '''This function get extended conditions of pack deployment package'''
     # Check custom package variables
-    cv = {}
-    for customvar in packagecustomvar.objects.filter(package=pack, apply_on_conditions=True):
-        cv[customvar.name] = customvar.value
-    if pack.use_global_variables == 'yes':
-        cv['username'] = m.username.replace(' (not logged in)', '')
-        cv['hostname'] = m.name
-        cv['domain'] = m.domain
+    cv = custom_variables(m, pack)
 
     handling = list()
-    for condition in pack.conditions.filter(package=pack):
+    for condition in pack.conditions.all():
+        # Conditions may be shared by the packages of a deploy plan: work on a copy
+        condition = copy.copy(condition)
         if len(cv) > 0:
-            template = django_engine.from_string(condition.softwarename)
-            condition.softwarename = template.render(cv, request=None)
+            condition.softwarename = templates.render(condition.softwarename, cv)
         if condition.depends == 'isfile':
             handling.append('<File>' + condition.softwarename + '</File>')
         elif condition.depends == 'notisfile':
@@ -199,16 +327,32 @@ def get_extended_conditions(m, pack):
     return handling
 
 
-def check_conditions(m, pack, xml=None):
-    '''This function check conditions of pack deployment package'''
+def render_condition(condition, cv):
+    '''Return a copy of a basic condition (conditions may be shared by the packages of a deploy plan)
+    with custom variables applied and values normalized for compile_condition'''
+    condition = copy.copy(condition)
+    if len(cv) > 0:
+        condition.softwarename = templates.render(condition.softwarename, cv)
+        condition.softwareversion = templates.render(condition.softwareversion, cv)
+
+    # Empty softwareversion is allowed
+    if condition.depends in ('notinstalled', 'installed', 'system_is', 'system_not') and \
+            condition.softwareversion is None:
+        condition.softwareversion = ''
+    if condition.depends in HISTORY_CONDITIONS and condition.softwarename is not None:
+        condition.softwarename = condition.softwarename.lower()
+    return condition
+
+
+def check_conditions(m, pack, xml=None, facts=None, results=None):
+    '''This function check conditions of pack deployment package.
+    Basic conditions are evaluated with compiled predicates over the machine facts
+    (loaded once when facts is shared by the packages of a request).
+    Results of the facts-only conditions are read from and added to results (stored deploy plan)'''
+    if facts is None:
+        facts = MachineFacts(m)
     # Check custom package variables
-    cv = {}
-    for customvar in packagecustomvar.objects.filter(package=pack, apply_on_conditions=True):
-        cv[customvar.name] = customvar.value
-    if pack.use_global_variables == 'yes':
-        cv['username'] = m.username.replace(' (not logged in)', '')
-        cv['hostname'] = m.name
-        cv['domain'] = m.domain
+    cv = custom_variables(m, pack)
 
     # All types of conditions are checked one by one
     install = True
@@ -224,396 +368,17 @@ def check_conditions(m, pack, xml=None):
 
     # Check basic conditions
     if install is True:
-        depends_filter = ['notinstalled', 'installed', 'is_W64_bits', 'is_W32_bits', 'system_is', 'system_not',
-                          'language_is', 'lower', 'higher', 'hostname_in', 'hostname_not', 'username_in',
-                          'username_not', 'ipaddr_in', 'ipaddr_not', 'vendor_in', 'vendor_not', 'product_in',
-                          'product_not', 'type_in', 'type_not', 'executetimes', 'installtimes', 'executedelay',
-                          'installdelay']
-        for condition in pack.conditions.filter(package=pack, depends__in=depends_filter):
-            if len(cv) > 0:
-                template = django_engine.from_string(condition.softwarename)
-                condition.softwarename = template.render(cv, request=None)
-                template = django_engine.from_string(condition.softwareversion)
-                condition.softwareversion = template.render(cv, request=None)
-
-            # Software not installed (wildcards can be used for condition name)
-            if condition.depends == 'notinstalled':
-                nameregex = '^' + re.escape(condition.softwarename).replace('\\*', '.*') + '$'
-                # Empty softwareversion is allowed (else django filter error!)
-                if condition.softwareversion is None:
-                    condition.softwareversion = ''
-                # Check name exists
-                if software.objects.filter(host_id=m.id, name__iregex=nameregex,
-                                           version=condition.softwareversion).exists():
-                    install = False
-
-            # Software installed (wildcards can be used for condition name)
-            elif condition.depends == 'installed':
-                nameregex = '^' + re.escape(condition.softwarename).replace('\\*', '.*') + '$'
-                # Empty softwareversion is allowed (else django filter error!)
-                if condition.softwareversion is None:
-                    condition.softwareversion = ''
-                # Check name exists
-                if not software.objects.filter(host_id=m.id, name__iregex=nameregex,
-                                               version=condition.softwareversion).exists():
-                    install = False
-
-            # OS architecture is Windows 64bits
-            elif condition.depends == 'is_W64_bits':
-                if not osdistribution.objects.filter(host_id=m.id, name__icontains='Windows',
-                                                     arch__contains='64').exists():
-                    install = False
-
-            # OS architecture is Windows 32bits
-            elif condition.depends == 'is_W32_bits':
-                if not osdistribution.objects.filter(host_id=m.id, name__icontains='Windows',
-                                                     arch__contains='32').exists() and not osdistribution.objects.filter(
-                    host_id=m.id, name__icontains='Windows', arch__contains='undefined').exists():
-                    install = False
-
-            # System name is (wildcards can be used)
-            elif condition.depends == 'system_is':
-                nameregex = re.escape(condition.softwarename).replace('\\*', '.*')
-                # Empty softwareversion is allowed to check an empty version
-                if condition.softwareversion is None:
-                    condition.softwareversion = ''
-                # Check name + version
-                if condition.softwareversion != 'undefined':
-                    if not osdistribution.objects.filter(host_id=m.id, name__iregex=nameregex,
-                                                         version__icontains=condition.softwareversion).exists():
-                        install = False
-                # Check name
-                else:
-                    if not osdistribution.objects.filter(host_id=m.id, name__iregex=nameregex).exists():
-                        install = False
-
-            # System name is not (wildcards can be used)
-            elif condition.depends == 'system_not':
-                nameregex = re.escape(condition.softwarename).replace('\\*', '.*')
-                # Empty softwareversion is allowed to check an empty version
-                if condition.softwareversion is None:
-                    condition.softwareversion = ''
-                # Check name + version
-                if condition.softwareversion != 'undefined':
-                    if osdistribution.objects.filter(host_id=m.id, name__iregex=nameregex,
-                                                     version__icontains=condition.softwareversion).exists():
-                        install = False
-                # Check name
-                else:
-                    if osdistribution.objects.filter(host_id=m.id, name__iregex=nameregex).exists():
-                        install = False
-
-            # Default system language is (ex: fr_FR)
-            elif condition.depends == 'language_is':
-                if m.language.upper() != condition.softwarename.upper():
-                    install = False
-
-            # Software not installed or version lower than (wildcards can be used for condition name)
-            elif condition.depends == 'lower':
-                nameregex = '^' + re.escape(condition.softwarename).replace('\\*', '.*') + '$'
-                # Check if name exists
-                if software.objects.filter(host_id=m.id, name__iregex=nameregex).exists():
-                    # Empty softwareversion is useful to ignore the version and only check not installed
-                    if condition.softwareversion is None:
-                        install = False
-                    else:
-                        # Check if at least one of the versions is greater than condition
-                        softtab = software.objects.filter(host_id=m.id, name__iregex=nameregex)
-                        for s in softtab:
-                            if compare_versions(s.version, condition.softwareversion) >= 0:
-                                install = False
-                                break
-
-            # Software installed and version higher than (wildcards can be used for condition name)
-            elif condition.depends == 'higher':
-                nameregex = '^' + re.escape(condition.softwarename).replace('\\*', '.*') + '$'
-                # Check if name exists
-                if software.objects.filter(host_id=m.id, name__iregex=nameregex).exists():
-                    # Empty softwareversion is useful to ignore the version and only check installed
-                    if condition.softwareversion is not None:
-                        # Check if all of the versions are lower than condition
-                        softtab = software.objects.filter(host_id=m.id, name__iregex=nameregex)
-                        for s in softtab:
-                            if compare_versions(s.version, condition.softwareversion) <= 0:
-                                install = False
-                            else:
-                                install = True
-                                break
-                else:
-                    install = False
-                    pass
-
-            # Hostname is in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'hostname_in':
-                try:
-                    # Check the list
-                    hosts = condition.softwarename.split(',')
-                    for hostname in hosts:
-                        if not hostname:
-                            continue
-                        nameregex = '^' + re.escape(hostname).replace('\\*', '.*') + '$'
-                        if re.match(nameregex, m.name, re.IGNORECASE):
-                            install = True
-                            break
-                        else:
-                            install = False
-                except:
-                    install = False
-                    pass
-
-            # Hostname is NOT in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'hostname_not':
-                try:
-                    # Check the list
-                    hosts = condition.softwarename.split(',')
-                    for hostname in hosts:
-                        if not hostname:
-                            continue
-                        nameregex = '^' + re.escape(hostname).replace('\\*', '.*') + '$'
-                        if re.match(nameregex, m.name, re.IGNORECASE):
-                            install = False
-                            break
-                except:
-                    install = False
-                    pass
-
-            # Username is in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'username_in':
-                try:
-                    # Check the list
-                    users = condition.softwarename.split(',')
-                    for username in users:
-                        if not username:
-                            continue
-                        nameregex = '^' + re.escape(username).replace('\\*', '.*') + '$'
-                        if re.match(nameregex, m.username, re.IGNORECASE):
-                            install = True
-                            break
-                        else:
-                            install = False
-                except:
-                    install = False
-                    pass
-
-            # Username is NOT in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'username_not':
-                try:
-                    # Check the list
-                    users = condition.softwarename.split(',')
-                    for username in users:
-                        if not username:
-                            continue
-                        nameregex = '^' + re.escape(username).replace('\\*', '.*') + '$'
-                        if re.match(nameregex, m.username, re.IGNORECASE):
-                            install = False
-                            break
-                except:
-                    install = False
-                    pass
-
-            # IP address is in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'ipaddr_in':
-                try:
-                    host_ip = net.objects.filter(host_id=m.id).values_list('ip', flat=True)
-                    for host_ip_addr in host_ip:
-                        host_ip_addr = ''.join(host_ip_addr)
-                        networks = condition.softwarename.split(',')
-                        for network in networks:
-                            if not network:
-                                continue
-                            if IPAddress(host_ip_addr) in IPNetwork(network):
-                                install = True
-                                break
-                            else:
-                                install = False
-                        if install is True:
-                            break
-                except:
-                    install = False
-                    pass
-
-            # IP address is NOT in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'ipaddr_not':
-                try:
-                    host_ip = net.objects.filter(host_id=m.id).values_list('ip', flat=True)
-                    for host_ip_addr in host_ip:
-                        host_ip_addr = ''.join(host_ip_addr)
-                        networks = condition.softwarename.split(',')
-                        for network in networks:
-                            if not network:
-                                continue
-                            if IPAddress(host_ip_addr) in IPNetwork(network):
-                                install = False
-                                break
-                        if install is False:
-                            break
-                except:
-                    install = False
-                    pass
-
-            # Vendor is in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'vendor_in':
-                try:
-                    # Check the list
-                    vendors = condition.softwarename.split(',')
-                    for vendor in vendors:
-                        if not vendor:
-                            continue
-                        nameregex = '^' + re.escape(vendor).replace('\\*', '.*') + '$'
-                        if re.match(nameregex, m.vendor, re.IGNORECASE):
-                            install = True
-                            break
-                        else:
-                            install = False
-                except:
-                    install = False
-                    pass
-
-            # Vendor is NOT in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'vendor_not':
-                try:
-                    # Check the list
-                    vendors = condition.softwarename.split(',')
-                    for vendor in vendors:
-                        if not vendor:
-                            continue
-                        nameregex = '^' + re.escape(vendor).replace('\\*', '.*') + '$'
-                        if re.match(nameregex, m.vendor, re.IGNORECASE):
-                            install = False
-                            break
-                except:
-                    install = False
-                    pass
-
-            # Product is in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'product_in':
-                try:
-                    # Check the list
-                    products = condition.softwarename.split(',')
-                    for product in products:
-                        if not product:
-                            continue
-                        nameregex = '^' + re.escape(product).replace('\\*', '.*') + '$'
-                        if re.match(nameregex, m.product, re.IGNORECASE):
-                            install = True
-                            break
-                        else:
-                            install = False
-                except:
-                    install = False
-                    pass
-
-            # Product is NOT in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'product_not':
-                try:
-                    # Check the list
-                    products = condition.softwarename.split(',')
-                    for product in products:
-                        if not product:
-                            continue
-                        nameregex = '^' + re.escape(product).replace('\\*', '.*') + '$'
-                        if re.match(nameregex, m.product, re.IGNORECASE):
-                            install = False
-                            break
-                except:
-                    install = False
-                    pass
-
-            # Machine type is in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'type_in':
-                try:
-                    # Check the list
-                    typemachines = condition.softwarename.split(',')
-                    for typemachine in typemachines:
-                        if not typemachine:
-                            continue
-                        nameregex = '^' + re.escape(typemachine).replace('\\*', '.*') + '$'
-                        if re.match(nameregex, str(m.typemachine), re.IGNORECASE):
-                            install = True
-                            break
-                        else:
-                            install = False
-                except:
-                    install = False
-                    pass
-
-            # Machine type is NOT in the list (comma separated list, wildcards can be used for condition name)
-            elif condition.depends == 'type_not':
-                try:
-                    # Check the list
-                    typemachines = condition.softwarename.split(',')
-                    for typemachine in typemachines:
-                        if not typemachine:
-                            continue
-                        nameregex = '^' + re.escape(typemachine).replace('\\*', '.*') + '$'
-                        if re.match(nameregex, str(m.typemachine), re.IGNORECASE):
-                            install = False
-                            break
-                except:
-                    install = False
-                    pass
-
-            # Installation executed or completed a maximum of X times per day/week/month (calendar period, not duration)
-            elif condition.depends == 'executetimes' or condition.depends == 'installtimes':
-                try:
-                    # For 'executetimes' we consider both 'Ready to download and execute' and
-                    # 'Install in progress' as executions (tests create 'Install in progress').
-                    if condition.depends == 'executetimes':
-                        search_statuses = ['Ready to download and execute', 'Install in progress']
-                    else:
-                        search_statuses = ['Operation completed']
-                    condition.softwarename = condition.softwarename.lower()
-                    today = datetime.now(timezone.utc)
-                    max_times_per_period = int(condition.softwareversion)
-                    if condition.softwarename in ['day', 'jour']:
-                        obj_in_period = packagehistory.objects.filter(machine_id=m.id, package_id=pack.id,
-                                                                      status__in=search_statuses, date__year=today.year,
-                                                                      date__month=today.month, date__day=today.day)
-                    elif condition.softwarename in ['week', 'semaine']:
-                        monday = today - timedelta(days=today.weekday())
-                        sunday = today + timedelta(days=6 - today.weekday())
-                        obj_in_period = packagehistory.objects.filter(machine_id=m.id, package_id=pack.id,
-                                                                      status__in=search_statuses,
-                                                                      date__range=(monday, sunday))
-                    elif condition.softwarename in ['month', 'mois']:
-                        obj_in_period = packagehistory.objects.filter(machine_id=m.id, package_id=pack.id,
-                                                                      status__in=search_statuses, date__year=today.year,
-                                                                      date__month=today.month)
-                    else:
-                        install = False
-
-                    if install is True:
-                        if len(obj_in_period) >= max_times_per_period:
-                            install = False
-                except:
-                    install = False
-                    pass
-
-            # Installation executed or completed ta minimum interval of X minutes/hours/days (duration)
-            elif condition.depends == 'executedelay' or condition.depends == 'installdelay':
-                try:
-                    search_status = 'Ready to download and execute' if condition.depends == 'executedelay' else 'Operation completed'
-                    condition.softwarename = condition.softwarename.lower()
-                    today = datetime.now(timezone.utc)
-                    interval = int(condition.softwareversion)
-                    if condition.softwarename in ['minutes']:
-                        date_max = today - timedelta(minutes=interval)
-                    elif condition.softwarename in ['hours', 'heures']:
-                        date_max = today - timedelta(hours=interval)
-                    elif condition.softwarename in ['days', 'jours']:
-                        date_max = today - timedelta(days=interval)
-                    else:
-                        install = False
-
-                    if install is True:
-                        obj_in_period = packagehistory.objects.filter(machine_id=m.id, package_id=pack.id,
-                                                                      status=search_status, date__gt=date_max)
-                        if len(obj_in_period) > 0:
-                            install = False
-                except:
-                    install = False
-                    pass
-
+        for condition in [c for c in pack.conditions.all() if c.depends in BASIC_CONDITIONS]:
+            condition = render_condition(condition, cv)
+            predicate = compile_condition(condition.id, condition.depends, condition.softwarename,
+                                          condition.softwareversion)
+            if results is not None and condition.depends not in HISTORY_CONDITIONS:
+                key = '%d:%d' % (pack.id, condition.id)
+                if key not in results:
+                    results[key] = predicate(facts, pack)
+                install = results[key]
+            else:
+                install = predicate(facts, pack)
             if install is False:
                 break
 
@@ -628,14 +393,11 @@ def check_conditions(m, pack, xml=None):
         except:
             pass
 
-        depends_filter = ['isfile', 'notisfile', 'isdir', 'notisdir', 'isfiledir', 'notisfiledir', 'hashis', 'hashnot',
-                          'exitcodeis', 'exitcodenot']
-        for condition in pack.conditions.filter(package=pack, depends__in=depends_filter):
+        for condition in [c for c in pack.conditions.all() if c.depends in EXTENDED_CONDITIONS]:
+            condition = copy.copy(condition)
             if len(cv) > 0:
-                template = django_engine.from_string(condition.softwarename)
-                condition.softwarename = template.render(cv, request=None)
-                template = django_engine.from_string(condition.softwareversion)
-                condition.softwareversion = template.render(cv, request=None)
+                condition.softwarename = templates.render(condition.softwarename, cv)
+                condition.softwareversion = templates.render(condition.softwareversion, cv)
 
             # File exists
             if condition.depends == 'isfile':
@@ -836,215 +598,304 @@ def check_conditions(m, pack, xml=None):
     return install
 
 
-def inventory(xml):
-    '''This function handle client inventory request'''
-    handling = list()
-    handling.append('<Response>')
-    try:
-        root = etree.fromstring(xml)
-        s = root.find('SerialNumber').text
-        n = root.find('Hostname').text
-        v = root.find('Manufacturer').text
-        p = root.find('Product').text
-        c = root.find('Chassistype').text
-
-        try:
-            u = root.find('Uuid').text
-        except:
-            u = 'Unknown'
+def field_values(obj):
+    '''Return a snapshot of the concrete field values of obj'''
+    return {f.attname: getattr(obj, f.attname) for f in obj._meta.concrete_fields}
 
-        try:
-            un = root.find('UserName').text
-        except:
-            un = 'Unknown'
 
-        try:
-            d = root.find('Domain').text
-        except:
-            d = 'Unknown'
+def changed_fields(obj, previous):
+    '''Return the names of the fields of obj modified since the previous snapshot'''
+    return [f.name for f in obj._meta.concrete_fields
+            if not f.primary_key and getattr(obj, f.attname) != previous[f.attname]]
 
-        try:
-            l = root.find('Language').text
-        except:
-            l = 'Unknown'
 
-        try:
-            clientversion = root.find('ClientVersion').text
-        except:
-            clientversion = 'Unknown'
+def bulk_create_rows(model, rows):
+    '''Insert rows with a single query. If it fails, rows are inserted one by one
+    to keep the valid ones. Return the list of rows that could not be created'''
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(rows)
+        return list()
+    except:
+        failed = list()
+        for row in rows:
+            try:
+                with transaction.atomic():
+                    row.save()
+            except:
+                failed.append(row)
+        return failed
+
+
+def sync_software(m, slist):
+    '''Synchronize the inventoried softwares of machine m with slist, a list of
+    (name, version, uninstall) tuples. Only new softwares are inserted and
+    removed ones are deleted. Return the (inserted, deleted) counts'''
+    wanted = Counter(slist)
+    to_delete = list()
+    with transaction.atomic():
+        for sid, name, version, uninstall in software.objects.filter(
+                host_id=m.id, manualy_created='no').values_list('id', 'name', 'version', 'uninstall'):
+            key = (name, version, uninstall)
+            if wanted[key] > 0:
+                wanted[key] -= 1
+            else:
+                to_delete.append(sid)
+        if to_delete:
+            software.objects.filter(id__in=to_delete).delete()
+        to_insert = [software(name=name, version=version, uninstall=uninstall, host_id=m.id, manualy_created='no')
+                     for (name, version, uninstall), count in wanted.items() for i in range(count)]
+        software.objects.bulk_create(to_insert)
+    return len(to_insert), len(to_delete)
+
+
+class InventoryTooLarge(Exception):
+    pass
+
+
+class LimitedStream(object):
+    '''File-like wrapper raising InventoryTooLarge when more than limit bytes are read'''
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.size = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            # Read everything by chunks so that the limit is checked before the whole body is in memory
+            chunks = list()
+            chunk = self.read(65536)
+            while chunk:
+                chunks.append(chunk)
+                chunk = self.read(65536)
+            return b''.join(chunks)
+        data = self.stream.read(size)
+        self.size += len(data)
+        if self.limit and self.size > self.limit:
+            raise InventoryTooLarge()
+        return data
+
+
+class InventoryData(object):
+    '''Compact representation of an inventory: header fields and lists of tuples
+    for systems, softwares and networks'''
+    def __init__(self):
+        self.fields = dict()
+        self.systems = list()
+        self.softwares = list()
+        self.networks = list()
+
+    def add(self, elem):
+        '''Read elem, a direct child of the inventory root element'''
+        if not isinstance(elem.tag, str):
+            return
+        if elem.tag == 'Osdistribution':
+            self.systems.append((elem.find('Name').text, elem.find('Version').text, elem.find('Arch').text,
+                                 elem.find('Systemdrive').text))
+        elif elem.tag == 'Software':
+            try:
+                softname = elem.find('Name').text
+                if softname is None:
+                    softname = 'Not defined'
+                self.softwares.append((softname, elem.find('Version').text, elem.find('Uninstall').text))
+            except:
+                pass
+        elif elem.tag == 'Network':
+            self.networks.append((elem.find('Ip').text, elem.find('Mask').text, elem.find('Mac').text))
+        elif elem.tag not in self.fields:
+            self.fields[elem.tag] = elem.text
+
+
+def read_inventory(xml):
+    '''Read an inventory from a xml string or, in streaming mode, from a file-like object.
+    In streaming mode elements are read as they arrive and cleared after use'''
+    data = InventoryData()
+    if not hasattr(xml, 'read'):
+        for elem in etree.fromstring(xml):
+            data.add(elem)
+        return data
+    stream = LimitedStream(xml, getattr(settings, 'INVENTORY_MAX_SIZE', 0))
+    for event, elem in etree.iterparse(stream, events=('end',), resolve_entities=False):
+        parent = elem.getparent()
+        # Only handle direct children of the root element
+        if parent is None or parent.getparent() is not None:
+            continue
+        data.add(elem)
+        elem.clear()
+        while elem.getprevious() is not None:
+            del parent[0]
+    return data
 
-        softsum = root.find('Softsum').text
-        ossum = root.find('Ossum').text
-        netsum = root.find('Netsum').text
 
+def inventory(xml):
+    '''This function handle client inventory request'''
+    handling = list()
+    handling.append('<Response>')
+    try:
+        data = read_inventory(xml)
+        s = data.fields['SerialNumber']
+        n = data.fields['Hostname']
+        v = data.fields['Manufacturer']
+        p = data.fields['Product']
+        c = data.fields['Chassistype']
+        u = data.fields.get('Uuid', 'Unknown')
+        un = data.fields.get('UserName', 'Unknown')
+        d = data.fields.get('Domain', 'Unknown')
+        l = data.fields.get('Language', 'Unknown')
+        clientversion = data.fields.get('ClientVersion', 'Unknown')
+        softsum = data.fields['Softsum']
+        ossum = data.fields['Ossum']
+        netsum = data.fields['Netsum']
+    except InventoryTooLarge:
+        handling.append('<Error>Inventory exceeds the maximum size</Error>')
+        handling.append('</Response>')
+        return handling
     except:
         handling.append('<Error>Error etree or find in xml</Error>')
         handling.append('</Response>')
         return handling
     try:
         # Load default config
-        config = deployconfig.objects.get(pk=1)
+        config = get_deployconfig()
 
-        # Typemachine import:
-        ch, created = typemachine.objects.get_or_create(name=c)
+        with transaction.atomic():
+            # Typemachine import:
+            ch, created = typemachine.objects.get_or_create(name=c)
 
-        # Machine import
-        if s is None:
-            s = 'undefined'
-        m, created = machine.objects.get_or_create(serial=s, name=n)
-        m.vendor = v
-        m.product = p
-        m.uuid = u
-        if un != 'Unknown' or m.username == 'Unknown':
-            m.username = un
-        if un == 'Unknown' and not ' (not logged in)' in m.username:
-            m.username += ' (not logged in)'
-        m.domain = d
-        m.language = l
-        m.typemachine_id = ch.id
-        m.manualy_created = 'no'
-        m.lastsave = datetime.now(timezone.utc)
-
-        if created:
-            m.entity = config.entity
-            if config.entity is not None and config.entity.packageprofile is not None and config.packageprofile is None:
-                m.packageprofile = config.entity.packageprofile
-            else:
-                m.packageprofile = config.packageprofile
-            if config.entity is not None and config.entity.timeprofile is not None and config.timeprofile is None:
-                m.timeprofile = config.entity.timeprofile
-            else:
-                m.timeprofile = config.timeprofile
-        if not created:
-            if m.entity is not None and m.entity.packageprofile is not None and m.entity.force_packageprofile == 'yes':
-                m.packageprofile = m.entity.packageprofile
-
-            if m.entity is not None and m.entity.timeprofile is not None and m.entity.force_timeprofile == 'yes':
-                m.timeprofile = m.entity.timeprofile
-        # System info import
-        if ossum != m.ossum:
+            # Machine import
+            if s is None:
+                s = 'undefined'
+            try:
+                m = machine.objects.get(serial=s, name=n)
+                created = False
+            except machine.DoesNotExist:
+                m = machine(serial=s, name=n)
+                created = True
+            previous = field_values(m)
+            m.vendor = v
+            m.product = p
+            m.uuid = u
+            if un != 'Unknown' or m.username == 'Unknown':
+                m.username = un
+            if un == 'Unknown' and not ' (not logged in)' in m.username:
+                m.username += ' (not logged in)'
+            m.domain = d
+            m.language = l
+            m.typemachine_id = ch.id
+            m.manualy_created = 'no'
+            m.lastsave = datetime.now(timezone.utc)
+
+            if created:
+                m.entity = config.entity
+                if config.entity is not None and config.entity.packageprofile is not None and config.packageprofile is None:
+                    m.packageprofile = config.entity.packageprofile
+                else:
+                    m.packageprofile = config.packageprofile
+                if config.entity is not None and config.entity.timeprofile is not None and config.timeprofile is None:
+                    m.timeprofile = config.entity.timeprofile
+                else:
+                    m.timeprofile = config.timeprofile
+            if not created:
+                if m.entity is not None and m.entity.packageprofile is not None and m.entity.force_packageprofile == 'yes':
+                    m.packageprofile = m.entity.packageprofile
+
+                if m.entity is not None and m.entity.timeprofile is not None and m.entity.force_timeprofile == 'yes':
+                    m.timeprofile = m.entity.timeprofile
+
+            # Checksums are saved with the machine, the children are updated below
+            ossum_changed = ossum != m.ossum
+            softsum_changed = softsum != m.softsum
+            netsum_changed = netsum != m.netsum
             m.ossum = ossum
-            m.save()
-            osdistribution.objects.filter(host_id=m.id, manualy_created='no').delete()
-            for os in root.findall('Osdistribution'):
-                osname = os.find('Name').text
-                osversion = os.find('Version').text
-                osarch = os.find('Arch').text
-                ossystemdrive = os.find('Systemdrive').text
-                try:
-                    osdistribution.objects.create(name=osname, version=osversion, arch=osarch,
-                                                  systemdrive=ossystemdrive, host_id=m.id, manualy_created='no')
-                except:
-                    handling.append('<Warning>Creation of System: ' + osname + ' -- ' + osversion + ' failed</Warning>')
-
-        # Software import
-        if softsum != m.softsum:
-            # if software checksum has change:
-            # delete all soft belonging to this machine and create new according to xml.
             m.softsum = softsum
-            m.save()
-            software.objects.filter(host_id=m.id, manualy_created='no').delete()
-            slist = list()
-            for soft in root.findall('Software'):
-                try:
-                    softname = soft.find('Name').text
-                    if softname is None:
-                        softname = 'Not defined'
-                    softversion = soft.find('Version').text
-                    softuninstall = soft.find('Uninstall').text
-                    slist.append(software(name=softname, version=softversion, uninstall=softuninstall, host_id=m.id,
-                                          manualy_created='no'))
-                except:
-                    pass
-            try:
-                software.objects.bulk_create(slist)
-            except Exception as inst:
-                handling.append('<Warning>Error saving software list: ' + str(inst) + '</Warning>')
-
-        # Network import
-        # Delete all network information belonging to this machine and create new according to xml.
-        if netsum != m.netsum:
             m.netsum = netsum
-            m.save()
-            net.objects.filter(host_id=m.id, manualy_created='no').delete()
-            for iface in root.findall('Network'):
-                netip = iface.find('Ip').text
-                netmask = iface.find('Mask').text
-                netmac = iface.find('Mac').text
+
+            # Save the machine only once, with the modified fields
+            try:
+                with transaction.atomic():
+                    if created:
+                        m.save()
+                    else:
+                        m.save(update_fields=changed_fields(m, previous))
+                machine_saved = True
+            except:
+                handling.append('<Error>can\'t save machine!</Error>')
+                machine_saved = False
+            if created and not machine_saved:
+                # Nothing to import or to deploy without the machine
+                handling.append('</Response>')
+                return handling
+
+            # System info import
+            if machine_saved and ossum_changed:
+                osdistribution.objects.filter(host_id=m.id, manualy_created='no').delete()
+                oslist = list()
+                for osname, osversion, osarch, ossystemdrive in data.systems:
+                    oslist.append(osdistribution(name=osname, version=osversion, arch=osarch,
+                                                 systemdrive=ossystemdrive, host_id=m.id, manualy_created='no'))
+                for os in bulk_create_rows(osdistribution, oslist):
+                    handling.append('<Warning>Creation of System: %s -- %s failed</Warning>' % (os.name, os.version))
+
+            # Software import
+            software_sync = None
+            if machine_saved and softsum_changed:
+                # if software checksum has change:
+                # only insert new softwares and delete removed ones according to xml.
                 try:
-                    net.objects.create(ip=netip, mask=netmask, mac=netmac, host_id=m.id, manualy_created='no')
-                except:
-                    handling.append('<Warning>Creation of Network: ' + netip + ' -- ' + netmask + ' failed</Warning>')
-        try:
-            m.save()
-            handling.append('<Import>Import ok</Import>')
-        except:
-            handling.append('<Error>can\'t save machine!</Error>')
+                    software_sync = sync_software(m, data.softwares)
+                except Exception as inst:
+                    handling.append('<Warning>Error saving software list: ' + str(inst) + '</Warning>')
+
+            # Network import
+            # Delete all network information belonging to this machine and create new according to xml.
+            if machine_saved and netsum_changed:
+                net.objects.filter(host_id=m.id, manualy_created='no').delete()
+                netlist = list()
+                for netip, netmask, netmac in data.networks:
+                    netlist.append(net(ip=netip, mask=netmask, mac=netmac, host_id=m.id, manualy_created='no'))
+                for iface in bulk_create_rows(net, netlist):
+                    handling.append('<Warning>Creation of Network: %s -- %s failed</Warning>' % (iface.ip, iface.mask))
+
+            if machine_saved:
+                handling.append('<Import>Import ok</Import>')
+                if software_sync is not None:
+                    handling.append('<Import>Software: %d inserted, %d deleted</Import>' % software_sync)
 
         # Delete duplicated machines
-        main_config = globalconfig.objects.get(pk=1)
-        if main_config.remove_duplicate == 'yes':
-            remove_duplicates()
+        main_config = get_globalconfig()
+        if main_config.remove_duplicate == 'yes' and remove_duplicates(m.name):
+            m.refresh_from_db(fields=['packageprofile', 'timeprofile', 'comment'])
 
         # Automatically set the entity
         if m.entity_id is not None:
-            # get all ip addresses of the client
-            host_ip = net.objects.filter(host_id=m.id).values_list('ip', flat=True)
-            is_ip_matched = False  # Test to stop search after an ip matching an entity
-            for host_ip_addr in host_ip:
-                if is_ip_matched:
-                    break
-                host_ip_addr = ''.join(host_ip_addr)
-
-                # get only entities with an ip_range value
-                for entity_obj in entity.objects.exclude(ip_range__isnull=True).exclude(ip_range__exact=''):
-                    network = entity_obj.ip_range.split(',')
-                    # check client IP with all comma separated IP/CIDR networks (could be simple a IP Address)
-                    for network_range in network:
-                        try:
-                            if not network_range:
-                                continue
-                            if IPAddress(host_ip_addr) in IPNetwork(network_range):
-                                if m.entity_id != entity_obj.id:
-                                    host_previous_entity = entity.objects.filter(id=m.entity_id)[0]
-                                    handling.append('<Info>Entity updated for %s from \'%s\' to \'%s\'</Info>' % (
-                                        m.name, host_previous_entity.name, entity_obj.name))
-                                    m.entity_id = entity_obj.id
-                                    m.entity.redistrib_url = entity_obj.redistrib_url
-                                    m.save()
-                                is_ip_matched = True
-                                break
-                        except:
-                            handling.append('<Error>Invalid network in ip range for entity \'%s\' : \'%s\'</Error>' % (
-                                entity_obj.name, network_range))
-                            pass
-                    if is_ip_matched:
-                        break
+            ranges = entity_ranges.get()
+            for entity_name, network_range in ranges.errors:
+                handling.append('<Error>Invalid network in ip range for entity \'%s\' : \'%s\'</Error>' % (
+                    entity_name, network_range))
+            # get all ip addresses of the client, the first one matching an entity is used
+            entity_id = ranges.find(net.objects.filter(host_id=m.id).values_list('ip', flat=True))
+            if entity_id is not None and entity_id != m.entity_id:
+                handling.append('<Info>Entity updated for %s from \'%s\' to \'%s\'</Info>' % (
+                    m.name, m.entity.name, ranges.names[entity_id]))
+                m.entity_id = entity_id
+                m.save(update_fields=['entity'])
 
         # packages program
         # check if it's the time to deploy and if it's authorized
         period_to_deploy = is_deploy_authorized(m, handling)
-        config = deployconfig.objects.get(pk=1)
-        # Use a set and not a list to automaticly remove duplicates
-        package_to_deploy = set()
+        config = get_deployconfig()
         if config.activate_deploy == 'yes':
-            # Packages programmed manualy on machine
-            for pack in m.packages.all().order_by('name'):
-                package_to_deploy.add(pack)
-
-            # Packages included in machine profilepackage
-            if m.packageprofile:
-                for pack in m.packageprofile.get_soft():
-                    package_to_deploy.add(pack)
-            else:
+            # Packages programmed manualy on machine and included in machine profilepackage
+            plan = DeployPlanContext(m)
+            if not m.packageprofile:
                 handling.append('<Warning>No package profile set</Warning>')
 
             # Prepare list of extended conditions
             extended_conditions = list()
             if clientversion != 'Unknown':
-                for pack in sorted(package_to_deploy, key=lambda package: package.name):
+                for pack in plan:
                     if (period_to_deploy or pack.ignoreperiod == 'yes'):
-                        if check_conditions(m, pack, b'BASIC_CHECK'):
+                        if check_conditions(m, pack, b'BASIC_CHECK', plan.facts, plan.results):
                             extended_conditions += get_extended_conditions(m, pack)
                 if len(extended_conditions) > 0:
                     extended_conditions = list(set(extended_conditions))  # remove duplicates
@@ -1053,19 +904,12 @@ def inventory(xml):
                     handling += extended_conditions
             # Prepare response to Updatengine client
             if len(extended_conditions) == 0:
-                for pack in sorted(package_to_deploy, key=lambda package: package.name):
+                for pack in plan:
                     if period_to_deploy or pack.ignoreperiod == 'yes':
-                        cv = {}
-                        for customvar in packagecustomvar.objects.filter(package=pack, apply_on_commands=True):
-                            cv[customvar.name] = customvar.value
-                        if pack.use_global_variables == 'yes':
-                            cv['username'] = m.username.replace(' (not logged in)', '')
-                            cv['hostname'] = m.name
-                            cv['domain'] = m.domain
+                        cv = custom_variables(m, pack, commands=True)
                         if len(cv) > 0:
-                            template = django_engine.from_string(pack.command)
-                            pack.command = template.render(cv, request=None)
-                        if check_conditions(m, pack):
+                            pack.command = templates.render(pack.command, cv)
+                        if check_conditions(m, pack, facts=plan.facts, results=plan.results):
                             # Proceed 'install_timeout' option
                             option_timeout = '\ninstall_timeout_' + str(pack.install_timeout)
                             pack.command += option_timeout
@@ -1091,7 +935,7 @@ def inventory(xml):
                                 if m.entity is not None and m.entity.redistrib_url:
                                     packurl = str(m.entity.redistrib_url) + str(pack.filename)
                                 else:
-                                    packurl = pack.filename.url
+                                    packurl = pack.download_url(m)
                             else:
                                 packurl = ''
                             pack.name = encodeXMLText(pack.name)
@@ -1107,6 +951,7 @@ def inventory(xml):
                                             '<Packagehash>' + pack.packagehash + '</Packagehash>' +
                                             '<Url>' + packurl + '</Url>' +
                                             '</Package>')
+            plan.save()
         else:
             handling.append('<Info>Deployment function is not active</Info>')
     except:
@@ -1115,6 +960,79 @@ def inventory(xml):
     return handling
 
 
+def queue_inventory(payload, wait=None):
+    '''Validate a client inventory and store it in the inventory queue (queued mode).
+    The response of the worker is returned if it is available within wait seconds
+    (INVENTORY_QUEUE_WAIT by default), otherwise the client is told the inventory is queued'''
+    handling = list()
+    handling.append('<Response>')
+    try:
+        if hasattr(payload, 'read'):
+            payload = LimitedStream(payload, getattr(settings, 'INVENTORY_MAX_SIZE', 0)).read()
+        elif isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        data = read_inventory(payload)
+        for field in ('SerialNumber', 'Hostname', 'Manufacturer', 'Product', 'Chassistype', 'Softsum', 'Ossum',
+                      'Netsum'):
+            data.fields[field]
+    except InventoryTooLarge:
+        handling.append('<Error>Inventory exceeds the maximum size</Error>')
+        handling.append('</Response>')
+        return handling
+    except:
+        handling.append('<Error>Error etree or find in xml</Error>')
+        handling.append('</Response>')
+        return handling
+
+    item = inventoryqueue.objects.create(xml=payload)
+    if wait is None:
+        wait = getattr(settings, 'INVENTORY_QUEUE_WAIT', 0)
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        time.sleep(min(0.2, max(deadline - time.monotonic(), 0)))
+        response = inventoryqueue.objects.filter(pk=item.pk, status__in=('done', 'error')).values_list(
+            'response', flat=True).first()
+        if response is not None:
+            inventoryqueue.objects.filter(pk=item.pk).delete()
+            return json.loads(response)
+    handling.append('<Info>Inventory queued</Info>')
+    handling.append('</Response>')
+    return handling
+
+
+def claim_queued_inventories(batch_size):
+    '''Mark at most batch_size pending inventories as processing and return their ids.
+    Each row is claimed with a conditional update so that concurrent workers never get the same inventory'''
+    now = datetime.now(timezone.utc)
+    claimed = list()
+    for item_id in inventoryqueue.objects.filter(status='pending').order_by('id').values_list('id', flat=True)[
+            :batch_size]:
+        if inventoryqueue.objects.filter(id=item_id, status='pending').update(status='processing', claimed=now):
+            claimed.append(item_id)
+    return claimed
+
+
+def process_queued_inventories(ids):
+    '''Import claimed inventories, each one in its own transaction with its response for the waiting client.
+    An inventory which cannot be imported is marked as error and the others are still imported'''
+    items = list(inventoryqueue.objects.filter(id__in=ids, status='processing'))
+    for item in items:
+        try:
+            with transaction.atomic():
+                item.response = json.dumps(inventory(bytes(item.xml)))
+                item.status = 'done'
+                item.save(update_fields=['status', 'response'])
+        except Exception:
+            logger.exception('Queued inventory %s not imported', item.id)
+            # A new connection is opened if the error left this one unusable
+            connection.close_if_unusable_or_obsolete()
+            item.response = json.dumps(['<Response>', 'Error when importing inventory: %s' % str(sys.exc_info()),
+                                        '</Response>'])
+            item.status = 'error'
+            item.save(update_fields=['status', 'response'])
+    return len(items)
+
+
 def inventory_extended(xml):
     '''This function handle client extended inventory request'''
     handling = list()
@@ -1141,32 +1059,18 @@ def inventory_extended(xml):
         # packages program
         # check if it's the time to deploy and if it's authorized
         period_to_deploy = is_deploy_authorized(m, handling)
-        config = deployconfig.objects.get(pk=1)
-        package_to_deploy = set()  # Use a set and not a list to automaticly remove duplicates
+        config = get_deployconfig()
         if config.activate_deploy == 'yes':
-            # Packages programmed manualy on machine
-            for pack in m.packages.all().order_by('name'):
-                package_to_deploy.add(pack)
-
-            # Packages included in machine profilepackage
-            if m.packageprofile:
-                for pack in m.packageprofile.get_soft():
-                    package_to_deploy.add(pack)
+            # Packages programmed manualy on machine and included in machine profilepackage
+            plan = DeployPlanContext(m)
 
             # Prepare response to Updatengine client
-            for pack in sorted(package_to_deploy, key=lambda package: package.name):
+            for pack in plan:
                 if period_to_deploy or pack.ignoreperiod == 'yes':
-                    if check_conditions(m, pack, xml):
-                        cv = {}
-                        for customvar in packagecustomvar.objects.filter(package=pack, apply_on_commands=True):
-                            cv[customvar.name] = customvar.value
-                        if pack.use_global_variables == 'yes':
-                            cv['username'] = m.username.replace(' (not logged in)', '')
-                            cv['hostname'] = m.name
-                            cv['domain'] = m.domain
+                    if check_conditions(m, pack, xml, plan.facts, plan.results):
+                        cv = custom_variables(m, pack, commands=True)
                         if len(cv) > 0:
-                            template = django_engine.from_string(pack.command)
-                            pack.command = template.render(cv, request=None)
+                            pack.command = templates.render(pack.command, cv)
                         # Proceed 'no_break_on_error' and 'download_no_restart' options
                         if pack.no_break_on_error == 'yes' or (pack.no_break_on_error == '' and config.no_break_on_error == 'yes'):
                             if '\nno_break_on_error' not in pack.command:
@@ -1194,7 +1098,7 @@ def inventory_extended(xml):
                             if m.entity is not None and m.entity.redistrib_url:
                                 packurl = str(m.entity.redistrib_url) + str(pack.filename)
                             else:
-                                packurl = pack.filename.url
+                                packurl = pack.download_url(m)
                         else:
                             packurl = ''
                         pack.name = encodeXMLText(pack.name)
@@ -1210,6 +1114,7 @@ def inventory_extended(xml):
                                         '<Packagehash>' + pack.packagehash + '</Packagehash>' +
                                         '<Url>' + packurl + '</Url>' +
                                         '</Package>')
+            plan.save()
         else:
             handling.append('<Info>Deployment function is not active</Info>')
     except:
@@ -1225,25 +1130,26 @@ def public_soft_list(pack=None):
         slist = package.objects.filter(public='yes')
     else:
         slist = package.objects.filter(id=pack, public='yes')
+    slist = slist.prefetch_related('packagecustomvar_set')
 
     for pack in slist:
         if pack.packagesum != 'nofile':
-            packurl = pack.filename.url
+            packurl = pack.download_url()
         else:
             packurl = ''
         pack.name = encodeXMLText(pack.name)
         pack.description = encodeXMLText(pack.description)
         cv = {}
-        for customvar in packagecustomvar.objects.filter(package=pack, apply_on_commands=True):
-            cv[customvar.name] = customvar.value
+        for customvar in pack.packagecustomvar_set.all():
+            if customvar.apply_on_commands:
+                cv[customvar.name] = customvar.value
         if pack.use_global_variables == 'yes':  # Ignored pack
             # cv['username'] = m.username.replace(' (not logged in)', '')
             # cv['hostname'] = m.name
             # cv['domain'] = m.domain
             continue
         if len(cv) > 0:
-            template = django_engine.from_string(pack.command)
-            pack.command = template.render(cv, request=None)
+            pack.command = templates.render(pack.command, cv)
         pack.command = encodeXMLText(pack.command)
         handling.append('<Package>' +
                         '<Pid>' + str(pack.id) + '</Pid>' +
@@ -1263,11 +1169,22 @@ def post(request):
     to dedicated functions'''
     handling = list()
 
+    # Streaming mode: the inventory is sent as raw xml body, the action in the query string
+    if request.content_type in ('application/xml', 'text/xml') and request.GET.get('action') == 'inventory':
+        if getattr(settings, 'INVENTORY_QUEUE', False):
+            handling = queue_inventory(request)
+        else:
+            handling = inventory(request)
+        return render(request, 'response_xml.html', {'list': handling}, content_type='application/xhtml+xml')
+
     if (request.POST.get('action')):
         action = request.POST.get('action')
         if (action == 'inventory') and (request.POST.get('xml')):
             xml = request.POST.get('xml')
-            handling = inventory(xml)
+            if getattr(settings, 'INVENTORY_QUEUE', False):
+                handling = queue_inventory(xml)
+            else:
+                handling = inventory(xml)
             response = render(request, 'response_xml.html', {'list': handling}, content_type='application/xhtml+xml')
         elif (action == 'extended') and (request.POST.get('xml')):
             xml = request.POST.get('xml')
@@ -1277,6 +1194,10 @@ def post(request):
             xml = request.POST.get('xml')
             handling = status(xml)
             response = render(request, 'response_xml.html', {'list': handling})
+        elif action == 'statusbatch':
+            xml = request.POST.get('xml')
+            handling = status_batch(xml)
+            response = render(request, 'response_xml.html', {'list': handling})
         elif action == 'softlist':
             if request.POST.get('pack') is not None:
                 handling = public_soft_list(request.POST.get('pack'))
@@ -1295,23 +1216,44 @@ def encodeXMLText(text):
     return text.replace('&', '&amp;').replace(">", "&gt;").replace("<", "&lt;")
 
 
-def remove_duplicates():
-    '''Remove all duplicated machines when an inventory is received (more recent entry is keeped)'''
-    '''order_by is useful to set the more recent packageprofile if there are many duplicates for one machine'''
-    duplicates = machine.objects.values('name').annotate(count=Count('id'), max_lastsave=Max('lastsave')).filter(
-        count__gt=1)
-
-    for duplicate in duplicates:
-        current_host_obj = machine.objects.filter(name=duplicate['name'], lastsave=duplicate['max_lastsave'])[0]
-        for host_obj in machine.objects.filter(name=duplicate['name']).exclude(lastsave=duplicate['max_lastsave']):
-            # Set packageprofile to newest machine
-            current_host_obj.packageprofile = host_obj.packageprofile
-            current_host_obj.timeprofile = host_obj.timeprofile
-            current_host_obj.comment = host_obj.comment
-            current_host_obj.save()
-            # Delete all entries
-            software.objects.filter(host_id=host_obj.id).delete()
-            osdistribution.objects.filter(host_id=host_obj.id).delete()
-            net.objects.filter(host_id=host_obj.id).delete()
-            packagehistory.objects.filter(machine_id=host_obj.id).delete()
-            machine.objects.filter(id=host_obj.id).delete()
+def remove_duplicates(name=None):
+    '''Remove duplicated machines (more recent entry is keeped) and return the number of removed machines.
+    Hostnames are compared without case. With name only the machines with this hostname are checked
+    (inventory request), otherwise all the duplicates are resolved in batch with set-based deletes'''
+    hosts = machine.objects.only('id', 'name', 'lastsave', 'packageprofile', 'timeprofile', 'comment').annotate(
+        lower_name=Lower('name'))
+    if name is not None:
+        hosts = hosts.filter(name__iexact=name)
+    else:
+        names = machine.objects.annotate(lower_name=Lower('name')).values('lower_name').annotate(
+            count=Count('id')).filter(count__gt=1).values('lower_name')
+        hosts = hosts.filter(lower_name__in=names)
+    # Sorted on the grouping key whatever the collation of the database
+    hosts = hosts.order_by('lower_name', F('lastsave').asc(nulls_first=True), 'id')
+
+    kept = list()
+    removed_ids = list()
+    for hostname, group in groupby(hosts, key=lambda host: host.lower_name):
+        group = list(group)
+        if len(group) < 2:
+            continue
+        # Set packageprofile, timeprofile and comment of the more recent duplicate to newest machine
+        current_host_obj = group[-1]
+        current_host_obj.packageprofile_id = group[-2].packageprofile_id
+        current_host_obj.timeprofile_id = group[-2].timeprofile_id
+        current_host_obj.comment = group[-2].comment
+        kept.append(current_host_obj)
+        removed_ids.extend(host.id for host in group[:-1])
+    if not removed_ids:
+        return 0
+
+    with transaction.atomic():
+        machine.objects.bulk_update(kept, ['packageprofile', 'timeprofile', 'comment'], batch_size=500)
+        for i in range(0, len(removed_ids), 500):
+            ids = removed_ids[i:i + 500]
+            software.objects.filter(host_id__in=ids).delete()
+            osdistribution.objects.filter(host_id__in=ids).delete()
+            net.objects.filter(host_id__in=ids).delete()
+            packagehistory.objects.filter(machine_id__in=ids).delete()
+            machine.objects.filter(id__in=ids).delete()
+    return len(removed_ids)
@@ -8,12 +8,10 @@
 #
 # Requirement: django-extensions
 #
+# Retention per status, archives and chunk size: see python manage.py purge_history --help
+#
 
-import datetime
-from deploy.models import *
-from django.utils.timezone import utc
+from django.core.management import call_command
 
-def run():
-    dt = datetime.datetime.utcnow().replace(tzinfo=utc)-datetime.timedelta(days=90)
-    for p in packagehistory.objects.filter(date__lt=dt):
-        p.delete()
+def run(*args):
+    call_command('purge_history', days=90)
@@ -3,12 +3,18 @@ import csv
 import os
 from inventory.models import machine, entity, net, osdistribution, software
 from deploy.models import packagehistory
+from inventory.views import remove_duplicates as inventory_remove_duplicates
 from django.db.models import Count, Max
 from netaddr import IPNetwork, IPAddress
 
 
-def run():
-	remove_duplicates()
+def run(*args):
+	# python manage.py runscript verif_duplicates --script-args apply
+	# resolves all duplicates in batch (set-based deletes), otherwise they are only listed
+	if 'apply' in args:
+		print("%d duplicated machines removed" % inventory_remove_duplicates())
+	else:
+		remove_duplicates()
 
 
 def remove_duplicates():
@@ -0,0 +1,244 @@
+###############################################################################
+# UpdatEngine - Software Packages Deployment and Administration tool          #
+#                                                                             #
+# Copyright (C) Yves Guimard - yves.guimard@gmail.com                         #
+# Copyright (C) Noël Martinon - noel.martinon@gmail.com                       #
+#                                                                             #
+# This program is free software; you can redistribute it and/or               #
+# modify it under the terms of the GNU General Public License                 #
+# as published by the Free Software Foundation; either version 2              #
+# of the License, or (at your option) any later version.                      #
+#                                                                             #
+# This program is distributed in the hope that it will be useful,             #
+# but WITHOUT ANY WARRANTY; without even the implied warranty of              #
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the               #
+# GNU General Public License for more details.                                #
+#                                                                             #
+# You should have received a copy of the GNU General Public License           #
+# along with this program; if not, write to the Free Software Foundation,     #
+# Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.         #
+###############################################################################
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction, connection
+from collections import OrderedDict
+import atexit
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessCache(object):
+    '''Value computed by build() and kept in the process memory.
+    invalidate() drops the value in the current process and changes a version key in the
+    shared cache (Redis) so that the other processes rebuild it within check_interval seconds'''
+    def __init__(self, key, build, check_interval=1.0):
+        self.key = 'process_cache:%s' % key
+        self.build = build
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.value = None
+        self.version = None
+        self.generation = 0
+        self.built_generation = None
+        self.checked = 0
+
+    def get(self):
+        now = time.monotonic()
+        if self.built_generation == self.generation and now - self.checked < self.check_interval:
+            return self.value
+        version = cache.get(self.key)
+        with self.lock:
+            if self.built_generation != self.generation or version != self.version:
+                generation = self.generation
+                self.value = self.build()
+                self.version = version
+                self.built_generation = generation
+            self.checked = now
+            return self.value
+
+    def invalidate(self):
+        self.generation += 1
+        # Other processes must not rebuild the value before the modification is committed
+        transaction.on_commit(self.publish)
+
+    def publish(self):
+        cache.set(self.key, uuid.uuid4().hex, None)
+
+
+class TemplateCache(object):
+    '''LRU cache of compiled templates keyed on the hash of their source text,
+    with hits and misses counters'''
+    def __init__(self, engine, maxsize=1024):
+        self.engine = engine
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.templates = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, source):
+        if not isinstance(source, str):
+            return self.engine.from_string(source)
+        key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+        with self.lock:
+            template = self.templates.get(key)
+            if template is not None:
+                self.templates.move_to_end(key)
+                self.hits += 1
+                return template
+        template = self.engine.from_string(source)
+        with self.lock:
+            self.misses += 1
+            self.templates[key] = template
+            if len(self.templates) > self.maxsize:
+                self.templates.popitem(last=False)
+        return template
+
+    def render(self, source, context):
+        return self.get(source).render(context, request=None)
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+class WriteBehindBuffer(object):
+    '''Items written later in batches by apply(items) instead of being written by each request.
+    The backend is chosen by the <setting> setting:
+    - 'memory': items are kept in the process and written by a background thread every
+      <setting>_INTERVAL ms or as soon as <setting>_SIZE items are buffered. NOT crash-safe: the items
+      are lost if the process is killed, so this backend is refused unless <setting>_ALLOW_LOSS is True
+    - 'redis': items are pushed to a Redis list and written by flush() in another process
+      (manage.py flush_status_buffer). Items being written are kept in a second list until apply()
+      returns, so they are written again after a crash of the flusher
+    - '' (default): no buffer, push() returns False and the caller writes the items itself'''
+    MOVE_SCRIPT = '''
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('LTRIM', KEYS[1], #items, -1)
+    redis.call('RPUSH', KEYS[2], unpack(items))
+end
+return items
+'''
+
+    def __init__(self, key, apply, setting):
+        self.key = 'write_behind:%s' % key
+        self.processing_key = 'write_behind:%s:processing' % key
+        self.apply = apply
+        self.setting = setting
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.items = list()
+        self.thread = None
+        self.pid = None
+        self.refused = False
+
+    @property
+    def backend(self):
+        return getattr(settings, self.setting, '')
+
+    @property
+    def interval(self):
+        return getattr(settings, self.setting + '_INTERVAL', 500) / 1000.0
+
+    @property
+    def size(self):
+        return getattr(settings, self.setting + '_SIZE', 500)
+
+    @property
+    def enabled(self):
+        backend = self.backend
+        if backend == 'memory' and not getattr(settings, self.setting + '_ALLOW_LOSS', False):
+            if not self.refused:
+                self.refused = True
+                logger.warning("Write-behind buffer %s: memory backend is not crash-safe and needs %s_ALLOW_LOSS, "
+                               "items written directly", self.key, self.setting)
+            return False
+        return backend in ('memory', 'redis')
+
+    def redis(self):
+        from django_redis import get_redis_connection
+        return get_redis_connection('default')
+
+    def push(self, items):
+        '''Add items to the buffer. Return False if items are not buffered'''
+        if not self.enabled:
+            return False
+        backend = self.backend
+        if backend == 'redis':
+            try:
+                self.redis().rpush(self.key, *[json.dumps(item) for item in items])
+                return True
+            except Exception:
+                logger.warning('Write-behind buffer %s unavailable, items written directly', self.key, exc_info=True)
+                return False
+        elif backend == 'memory':
+            with self.lock:
+                self.items.extend(items)
+                full = len(self.items) >= self.size
+            self.start()
+            if full:
+                self.event.set()
+            return True
+        return False
+
+    def start(self):
+        '''Start the flusher thread of the process (again after a fork)'''
+        if self.thread is None or self.pid != os.getpid():
+            with self.lock:
+                if self.thread is None or self.pid != os.getpid():
+                    if self.pid is None:
+                        atexit.register(self.flush)
+                    self.pid = os.getpid()
+                    self.thread = threading.Thread(target=self.run, name=self.key, daemon=True)
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            self.event.wait(self.interval)
+            self.event.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Write-behind buffer %s flush failed', self.key)
+            finally:
+                connection.close()
+
+    def flush(self):
+        '''Write the buffered items (memory backend) or the items of the Redis list (redis backend)
+        synchronously. Return the number of written items'''
+        if self.backend == 'redis':
+            return self.flush_redis()
+        count = 0
+        while True:
+            with self.lock:
+                items = self.items[:self.size]
+                del self.items[:self.size]
+            if not items:
+                return count
+            self.apply(items)
+            count += len(items)
+
+    def flush_redis(self):
+        redis = self.redis()
+        # Items left by a crashed flusher first
+        count = 0
+        items = redis.lrange(self.processing_key, 0, -1)
+        while True:
+            if items:
+                self.apply([json.loads(item) for item in items])
+                count += len(items)
+            redis.delete(self.processing_key)
+            items = redis.eval(self.MOVE_SCRIPT, 2, self.key, self.processing_key, self.size)
+            if not items:
+                return count
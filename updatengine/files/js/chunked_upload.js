@@ -0,0 +1,124 @@
+/*
+ * UpdatEngine - chunked upload of package files
+ *
+ * The file selected in the package form is sent by chunks to the upload
+ * endpoint before the form is submitted. An interrupted upload (network error,
+ * timeout, page reload) is resumed from the offset known by the server.
+ */
+(function () {
+    'use strict';
+
+    var CHUNK_SIZE = 8 * 1024 * 1024;
+    var MAX_RETRIES = 10;
+
+    function csrfToken(form) {
+        var input = form.querySelector('input[name=csrfmiddlewaretoken]');
+        return input ? input.value : '';
+    }
+
+    function storageKey(file) {
+        return 'updatengine-upload:' + [file.name, file.size, file.lastModified].join(':');
+    }
+
+    function request(method, url, form, body) {
+        return fetch(url, {
+            method: method,
+            credentials: 'same-origin',
+            headers: {'X-CSRFToken': csrfToken(form)},
+            body: body
+        }).then(function (response) {
+            return response.json().then(function (data) {
+                if (!response.ok && response.status !== 409) {
+                    throw new Error(data.error || response.statusText);
+                }
+                return data;
+            });
+        });
+    }
+
+    function start(url, form, file) {
+        var token = window.localStorage.getItem(storageKey(file));
+        var created = function () {
+            var data = new FormData();
+            data.append('name', file.name);
+            data.append('size', file.size);
+            return request('POST', url, form, data);
+        };
+        if (!token) {
+            return created();
+        }
+        // Resume the previous upload of the same file
+        return request('GET', url + token + '/', form).catch(created);
+    }
+
+    function send(url, form, file, upload, progress, retries) {
+        window.localStorage.setItem(storageKey(file), upload.token);
+        if (upload.completed) {
+            window.localStorage.removeItem(storageKey(file));
+            return Promise.resolve(upload);
+        }
+        progress(upload.offset, upload.size);
+        var chunk = file.slice(upload.offset, Math.min(upload.offset + CHUNK_SIZE, upload.size));
+        return request('POST', url + upload.token + '/?offset=' + upload.offset, form, chunk).then(function (data) {
+            return send(url, form, file, data, progress, MAX_RETRIES);
+        }, function (error) {
+            if (retries <= 0) {
+                throw error;
+            }
+            // Ask the server where to resume
+            return new Promise(function (resolve) { setTimeout(resolve, 2000); }).then(function () {
+                return request('GET', url + upload.token + '/', form);
+            }).then(function (data) {
+                return send(url, form, file, data, progress, retries - 1);
+            }, function () {
+                return send(url, form, file, upload, progress, retries - 1);
+            });
+        });
+    }
+
+    document.addEventListener('DOMContentLoaded', function () {
+        var token = document.getElementById('id_upload');
+        var input = document.getElementById('id_filename');
+        if (!token || !input || !window.fetch) {
+            return;
+        }
+        var form = input.form;
+        var url = token.getAttribute('data-url');
+        var status = document.createElement('p');
+        status.className = 'help';
+        input.parentNode.appendChild(status);
+
+        form.addEventListener('submit', function (event) {
+            if (!input.files || !input.files.length) {
+                return;
+            }
+            event.preventDefault();
+            var file = input.files[0];
+            var buttons = form.querySelectorAll('input[type=submit]');
+            var submitter = event.submitter;
+            buttons.forEach(function (button) { button.disabled = true; });
+            var progress = function (offset, size) {
+                status.textContent = file.name + ' : ' + (size ? Math.floor(offset * 100 / size) : 100) + ' %';
+            };
+            start(url, form, file).then(function (upload) {
+                return send(url, form, file, upload, progress, MAX_RETRIES);
+            }).then(function (upload) {
+                progress(upload.size, upload.size);
+                token.value = upload.token;
+                input.value = '';
+                buttons.forEach(function (button) { button.disabled = false; });
+                if (submitter && submitter.name) {
+                    var hidden = document.createElement('input');
+                    hidden.type = 'hidden';
+                    hidden.name = submitter.name;
+                    hidden.value = submitter.value;
+                    form.appendChild(hidden);
+                }
+                form.submit();
+            }).catch(function (error) {
+                buttons.forEach(function (button) { button.disabled = false; });
+                status.textContent = file.name + ' : ' + error.message;
+            });
+        });
+    });
+})();
@@ -21,6 +21,7 @@
 from django.urls import include, path, re_path, reverse_lazy
 from django.contrib import admin
 from inventory.views import post
+from deploy.views import package_download, mirror_manifest_view
 from django.contrib.admin import site
 import adminactions.actions as actions
 from .views import check_version, ChangePasswordView, ChangePasswordDoneView
@@ -40,6 +41,8 @@ urlpatterns = [
     re_path(r'^admin/', admin.site.urls),
     re_path(r'^check_version/', check_version),
     re_path(r'^post/', post),
+    re_path(r'^download/(?P<token>[^/]+)/(?P<name>[^/]+)$', package_download, name='package_download'),
+    path('mirror/<int:entity_id>/manifest', mirror_manifest_view, name='mirror_manifest'),
 
     # Auth
     re_path(r'^password_change/$', ChangePasswordView.as_view(), name='password_change'),
@@ -7,7 +7,7 @@ from django.utils import timezone
 from datetime import timedelta
 from django.core.paginator import Paginator
 from inventory.models import machine, entity, software, net, osdistribution
-from deploy.models import package, packagehistory, packageprofile
+from deploy.models import package, packagehistory, packageprofile, packagestatuslatest
 
 # ---------------------------------------------------------------------------
 # Helpers
@@ -32,9 +32,9 @@ def dashboard(request):
         .select_related('machine', 'package')
         .order_by('-date')[:10]
     )
-    success_count = packagehistory.objects.filter(date__gte=since_24h, status='Operation completed').count()
-    error_count = packagehistory.objects.filter(date__gte=since_24h, status__startswith='Error').count()
-    inprogress_count = packagehistory.objects.filter(date__gte=since_24h, status='Install in progress').count()
+    success_count = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.COMPLETED).count()
+    error_count = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.ERROR).count()
+    inprogress_count = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.PROGRESS).count()
     top_entities = (
         entity.objects
         .annotate(machine_count=Count('machine'))
@@ -66,8 +66,8 @@ def htmx_dashboard_stats(request):
     total_machines = machine.objects.count()
     online_machines = machine.objects.filter(lastsave__gte=cutoff).count()
     since_24h = timezone.now() - timedelta(hours=24)
-    success_count = packagehistory.objects.filter(date__gte=since_24h, status='Operation completed').count()
-    error_count = packagehistory.objects.filter(date__gte=since_24h, status__startswith='Error').count()
+    success_count = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.COMPLETED).count()
+    error_count = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.ERROR).count()
     context = {
         'total_machines': total_machines,
         'online_machines': online_machines,
@@ -186,17 +186,17 @@ def api_machine_search(request):
 def deploy_overview(request):
     since_24h = timezone.now() - timedelta(hours=24)
     recent_history = packagehistory.objects.filter(date__gte=since_24h).select_related('machine', 'package').order_by('-date')[:20]
-    success_count = packagehistory.objects.filter(date__gte=since_24h, status='Operation completed').count()
-    error_count = packagehistory.objects.filter(date__gte=since_24h, status__startswith='Error').count()
+    success_count = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.COMPLETED).count()
+    error_count = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.ERROR).count()
     context = {'recent_history': recent_history, 'success_count': success_count, 'error_count': error_count, 'total_packages': package.objects.count()}
     return render(request, 'modern/deploy.html', context)
 
-def _classify_alert(status, date, cutoff):
+def _classify_alert(status, date, cutoff, status_code=None):
     s = (status or '').lower()
-    if 'error' in s or 'fail' in s: return 'critical', 'Erreur deploiement'
-    if 'timeout' in s: return 'critical', 'Timeout installation'
-    if 'progress' in s: return 'warning', 'Installation en cours'
-    if 'completed' in s or 'success' in s: return 'success', 'Succes'
+    if status_code is None: status_code = packagehistory.get_status_code(status)
+    if status_code == packagehistory.ERROR: return 'critical', 'Timeout installation' if 'timeout' in s else 'Erreur deploiement'
+    if status_code in (packagehistory.READY, packagehistory.PROGRESS): return 'warning', 'Installation en cours'
+    if status_code == packagehistory.COMPLETED: return 'success', 'Succes'
     return 'info', status or 'Inconnu'
 
 @login_required
@@ -204,19 +204,19 @@ def alerts_view(request):
     cutoff = _online_cutoff()
     since_24h = timezone.now() - timedelta(hours=24)
     since_7d = timezone.now() - timedelta(days=7)
-    critical_errors = packagehistory.objects.filter(date__gte=since_24h, status__startswith='Error').select_related('machine', 'package').order_by('-date')[:50]
+    critical_errors = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.ERROR).select_related('machine', 'package').order_by('-date')[:50]
     stale_machines = machine.objects.filter(Q(lastsave__lt=since_7d) | Q(lastsave__isnull=True)).select_related('entity').order_by('lastsave')[:30]
     stuck_cutoff = timezone.now() - timedelta(hours=2)
-    stuck_deployments = packagehistory.objects.filter(status='Install in progress', date__lte=stuck_cutoff).select_related('machine', 'package').order_by('date')[:20]
-    total_errors_24h = packagehistory.objects.filter(date__gte=since_24h, status__startswith='Error').count()
-    total_errors_7d = packagehistory.objects.filter(date__gte=since_7d, status__startswith='Error').count()
+    stuck_deployments = packagestatuslatest.objects.filter(status_code=packagehistory.PROGRESS, date__lte=stuck_cutoff).select_related('machine', 'package').order_by('date')[:20]
+    total_errors_24h = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.ERROR).count()
+    total_errors_7d = packagehistory.objects.filter(date__gte=since_7d, status_code=packagehistory.ERROR).count()
     total_stale = stale_machines.count()
     total_stuck = stuck_deployments.count()
     total_critical = total_errors_24h + total_stuck
     severity_filter = request.GET.get('severity', '')
     alerts = []
     for ph in critical_errors:
-        severity, label = _classify_alert(ph.status, ph.date, cutoff)
+        severity, label = _classify_alert(ph.status, ph.date, cutoff, ph.status_code)
         if severity_filter and severity_filter != severity: continue
         alerts.append({'severity': severity, 'label': label, 'machine': ph.machine, 'package': ph.package, 'status': ph.status, 'date': ph.date, 'type': 'deploy_error'})
     for ph in stuck_deployments:
@@ -229,7 +229,7 @@ def alerts_view(request):
 def htmx_alert_badge(request):
     since_24h = timezone.now() - timedelta(hours=24)
     stuck_cutoff = timezone.now() - timedelta(hours=2)
-    count = packagehistory.objects.filter(date__gte=since_24h, status__startswith='Error').count() + packagehistory.objects.filter(status='Install in progress', date__lte=stuck_cutoff).count()
+    count = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.ERROR).count() + packagestatuslatest.objects.filter(status_code=packagehistory.PROGRESS, date__lte=stuck_cutoff).count()
     return render(request, 'modern/partials/alert_badge.html', {'count': count})
 
 @login_required
@@ -237,11 +237,11 @@ def htmx_alerts_rows(request):
     cutoff = _online_cutoff()
     since_24h = timezone.now() - timedelta(hours=24)
     stuck_cutoff = timezone.now() - timedelta(hours=2)
-    critical_errors = packagehistory.objects.filter(date__gte=since_24h, status__startswith='Error').select_related('machine', 'package').order_by('-date')[:50]
-    stuck_deployments = packagehistory.objects.filter(status='Install in progress', date__lte=stuck_cutoff).select_related('machine', 'package').order_by('date')[:20]
+    critical_errors = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.ERROR).select_related('machine', 'package').order_by('-date')[:50]
+    stuck_deployments = packagestatuslatest.objects.filter(status_code=packagehistory.PROGRESS, date__lte=stuck_cutoff).select_related('machine', 'package').order_by('date')[:20]
     alerts = []
     for ph in critical_errors:
-        severity, label = _classify_alert(ph.status, ph.date, cutoff)
+        severity, label = _classify_alert(ph.status, ph.date, cutoff, ph.status_code)
         alerts.append({'severity': severity, 'label': label, 'machine': ph.machine, 'package': ph.package, 'status': ph.status, 'date': ph.date, 'type': 'deploy_error'})
     for ph in stuck_deployments: alerts.append({'severity': 'warning', 'label': 'Deploiement bloque', 'machine': ph.machine, 'package': ph.package, 'status': ph.status, 'date': ph.date, 'type': 'stuck'})
     return render(request, 'modern/partials/alerts_rows.html', {'alerts': alerts, 'cutoff': cutoff})
@@ -250,7 +250,7 @@ def htmx_alerts_rows(request):
 def api_alert_count(request):
     since_24h = timezone.now() - timedelta(hours=24)
     stuck_cutoff = timezone.now() - timedelta(hours=2)
-    count = packagehistory.objects.filter(date__gte=since_24h, status__startswith='Error').count() + packagehistory.objects.filter(status='Install in progress', date__lte=stuck_cutoff).count()
+    count = packagehistory.objects.filter(date__gte=since_24h, status_code=packagehistory.ERROR).count() + packagestatuslatest.objects.filter(status_code=packagehistory.PROGRESS, date__lte=stuck_cutoff).count()
 
     # ---------------------------------------------------------------------------
 # Settings